@@ -24,7 +24,20 @@ VERSION = tuple(map(int, __version__.split('.')))
 
 from gerrit import Gerrit
 from repo import Repo, Observation
+from observations import ObservationStore
 from changeset import Changeset, Developer, Patchset, Review
+from developer import AccountRegistry
+from state import State
+from metrics import Metric, MetricRegistry, Breakdown
+from instrumentation import Instrumentation
+from ssh import SSHSession, EventStream, ProjectCache
+from snapshot import Snapshot, SnapshotWriter
+from shards import Partition, Shard, Partials
+from router import Router
+from writer import DatasetWriter
+from realtime import EventProcessor
+from evaluation import Evaluation
+from spill import MemoryBudget, SpilledRuns
 from stats import main
 
 
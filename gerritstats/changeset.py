@@ -19,16 +19,9 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
-from copy import deepcopy
-
-from utils import determine_yesterday
+from utils import determine_yesterday, intern_string
 from developer import Developer
 
-try:
-    from collections import OrderedDict
-except:
-    from ordereddict import OrderedDict
-
 
 class Changeset(object):
     '''
@@ -55,10 +48,12 @@ class Changeset(object):
     @param last_updated_on: timestamp of the last action on this changeset
     @type: datetime
     
-    @param change_key: internal Gerrit change key
+    @param change_key: internal Gerrit change key, not loaded from the
+    database, only set for changesets created from gerrit stream-events
     @type: string
     
-    @param subject: subject of the changeset
+    @param subject: subject of the changeset, not loaded from the database,
+    only set for changesets created from gerrit stream-events
     @type: string 
     
     @param nbr_patch_sets: total number of patchsets that belong to this
@@ -69,13 +64,30 @@ class Changeset(object):
     like 'M' for merged and 'A' for abandoned. Lower case status can change like
     'd' for draft. 
     @type: string
+
+    @param author: the Developer who owns this changeset, usually a shared
+    instance from the AccountRegistry. If omitted, a new Developer is created
+    from the account columns in kwargs.
+    @type author: Developer
+
+    @param clock: the Clock of the run, open changesets are counted up to its
+    yesterday. Defaults to the current date.
+    @type clock: Clock
     
     '''
-    def __init__(self, **kwargs):
+    __slots__ = ('created_on', 'owner_account_id', 'dest_project_name',
+                 'dest_branch_name', 'change_id', 'last_updated_on',
+                 'change_key', 'subject', 'nbr_patch_sets', 'status',
+                 'patch_sets', 'open', 'merged', 'self_review',
+                 'repo_has_review', 'yesterday', 'waiting_first_review',
+                 'waiting_plus2', 'merge_review', 'all_positive_reviews',
+                 'author')
+
+    def __init__(self, author=None, clock=None, **kwargs):
         self.created_on = kwargs.get('created_on')
         self.owner_account_id = kwargs.get('owner_account_id')
-        self.dest_project_name = kwargs.get('dest_project_name')
-        self.dest_branch_name = kwargs.get('dest_branch_name')
+        self.dest_project_name = intern_string(kwargs.get('dest_project_name'))
+        self.dest_branch_name = intern_string(kwargs.get('dest_branch_name'))
         self.change_id = kwargs.get('change_id')
         self.last_updated_on = kwargs.get('last_updated_on')
         self.change_key = kwargs.get('change_key')
@@ -83,22 +95,33 @@ class Changeset(object):
         self.nbr_patch_sets = kwargs.get('nbr_patch_sets')
         self.status = kwargs.get('status')
 
-        self.patch_sets = OrderedDict()
+        self.patch_sets = {}
         self.open = True if kwargs.get('open') == 'Y' else False
         self.merged = True if kwargs.get('status') == 'M' else False
         self.self_review = False
         self.repo_has_review = True
 
-        self.yesterday = determine_yesterday()
+        self.yesterday = clock.yesterday if clock else determine_yesterday()
         self.waiting_first_review = self.yesterday  # wait time between creation and first review
         self.waiting_plus2 = self.yesterday  # wait time between first plus 1 and plus 2
         self.merge_review = None  # this will become an instance of Review
         self.all_positive_reviews = None
-        self.author = Developer(**kwargs)  # this will become an instance of Developer
+        if author is None:
+            author = Developer(**kwargs)
+        self.author = author
 
     def __str__(self):
         return '%s:%s' % (self.change_id, self.subject)
 
+    def evaluate(self):
+        '''
+        Determine the review metrics of this changeset.
+        '''
+        self.is_all_positive_reviews()
+        self.calculate_wait_first_review()
+        self.calculate_wait_plus2()
+        self.is_self_reviewed()
+
     def is_self_reviewed(self):
         '''
         Determine whether this changeset was reviewed by the developer who
@@ -116,94 +139,59 @@ class Changeset(object):
         '''
         only consider the most recent patch_set to determine whether all reviews were positive.
         '''
-        values = [True if review.value > 0 else False for review in self.patch_sets[self.nbr_patch_sets].reviews.itervalues()]
-        if all(values) and len(values) > 0:
-            self.all_positive_reviews = True
-        else:
-            self.all_positive_reviews = False
+        self.all_positive_reviews = self.patch_sets[self.nbr_patch_sets].reviews.all_positive
 
     def get_first_review_by_review_value(self, value):
         '''
-        self.reviews is an ordereddict that is sorted by timestamp, so the first hit is the oldest.
+        Return the oldest code review with @value of the most recent patch_set,
+        or None if there is no such review.
         '''
-        for review in self.patch_sets[self.nbr_patch_sets].reviews.itervalues():
-            if review.value == value and review.reviewer.human is True and review.category_id == 'CRVW':
-                return deepcopy(review)
-        #this commit does not have a review with value 'value', return None
-        return None
+        return self.patch_sets[self.nbr_patch_sets].reviews.get_first('CRVW', value)
 
     def get_merge_review(self):
         if self.merged is True:
-            merge_review = self.get_first_review_by_review_value(2)
-            if merge_review:
-                self.merge_review = merge_review
-            else:
-                #commit was merged but there was no review
-                self.merge_review = None
-
-    def get_review(self, review_age):
-        '''
-        Valid values for review_age are min and max.
-        '''
-        dates = self.patch_sets[self.nbr_patch_sets].reviews.keys()
-        try:
-            first_date = review_age(dates)
-            return self.patch_sets[self.nbr_patch_sets].reviews.get(first_date)
-        except ValueError:
-            return None
+            #None if the commit was merged but there was no review
+            self.merge_review = self.get_first_review_by_review_value(2)
 
     def calculate_wait_plus2(self):
-        if self.merged and self.patch_sets[self.nbr_patch_sets].reviews != {}:
-            #commit was merged with reviews
-            try:
-                review = self.get_first_review_by_review_value(2)
-                if not review:
-                    #commit was merged but there was no +2 made by a human developer.
-                    review = Review(granted=self.last_updated_on)
-            except (AttributeError, ValueError):
-                #although there are reviews, there is no +2 review
-                #second guess the merge date by using last_updated_on field
-                review = Review(granted=self.last_updated_on)
-        elif self.merged and self.patch_sets[self.nbr_patch_sets].reviews == {}:
-            #commit was merged but there were no reviews
-            #second guess the merge date by using last_updated_on field
-            #this means that rerunning gerrit-stats over time can change the
-            #count as this number is not set in stone. 
-            review = Review(granted=self.last_updated_on)
-        else:
+        '''
+        waiting_plus2 is the timestamp of the first +2 review. If the commit
+        was merged without a +2 made by a human developer then the merge date
+        is second guessed using the last_updated_on field, this means that
+        rerunning gerrit-stats over time can change the count as this number
+        is not set in stone.
+        '''
+        review = self.get_first_review_by_review_value(2)
+        if self.merged and review:
+            self.waiting_plus2 = review.granted
+        elif self.merged:
+            self.waiting_plus2 = self.last_updated_on
+        elif self.all_positive_reviews is True:
             #commit is not merged, but all the reviews are positive
-            if self.all_positive_reviews is True:
-                # always deduct 1 day as we only run the counts for complete days
-                review = Review(granted=self.yesterday)
-            else:
-                #commit is not yet ready to be merged, ignore for stats
-                review = Review(granted=self.last_updated_on)
-        self.waiting_plus2 = review
+            # always deduct 1 day as we only run the counts for complete days
+            self.waiting_plus2 = self.yesterday
+        else:
+            #commit is not yet ready to be merged, ignore for stats
+            self.waiting_plus2 = self.last_updated_on
 
     def calculate_wait_first_review(self):
-        values = [-2, -1, 1]
-        reviews = {}
-        for value in values:
-            review = self.get_first_review_by_review_value(value)
-            if review:
-                reviews[review.granted] = review
-        if reviews != {}:
-            review = reviews[min(reviews.keys())]
-            review.granted = determine_yesterday(review.granted)
+        granted = [review.granted for review in
+                   [self.get_first_review_by_review_value(value) for value in (-2, -1, 1)]
+                   if review]
+        if granted:
+            self.waiting_first_review = determine_yesterday(min(granted))
+        elif self.merged is True:
+            self.waiting_first_review = determine_yesterday(self.last_updated_on)
         else:
-            if self.merged is True:
-                review = Review(granted=self.last_updated_on)
-                review.granted = determine_yesterday(self.last_updated_on)
-            else:
-                review = Review(granted=self.yesterday)
-        self.waiting_first_review = review
+            self.waiting_first_review = self.yesterday
 
 
 class Patchset(object):
     '''
     A Patchset belongs to a Changeset and can be thought of as a commit in Git.
 
-    @param revison: the git reference to a commit
+    @param revison: the git reference to a commit, not loaded from the
+    database, only set for patch sets created from gerrit stream-events
     @type revison: string
 
     @param uploader_account_id: the id of the developer who uploaded the 
@@ -223,17 +211,13 @@ class Patchset(object):
     @param draft: Flag to indicate whether patchset is a draft or not.
     @type draft: string
 
-    @param change_open: Flag to indicate whether the patchset is still open or 
-    not.
-    @type change_open: string
-
-    @param change_sort_key: a key that assists Gerrit in sorting
-    @type change_sort_key: string
-
-    @param reviews: instance of OrderedDict that keeps track of all the @Review
-    objects that belong to this @Patchset.
-    @type reviews: OrderedDict
+    @param reviews: summary of the @Review objects that belong to this
+    @Patchset.
+    @type reviews: ReviewSummary
     '''
+    __slots__ = ('revision', 'uploader_account_id', 'created_on', 'change_id',
+                 'patch_set_id', 'draft', 'reviews')
+
     def __init__(self, **kwargs):
         self.revision = kwargs.get('revision')
         self.uploader_account_id = kwargs.get('uploader_account_id')
@@ -241,9 +225,52 @@ class Patchset(object):
         self.change_id = kwargs.get('change_id')
         self.patch_set_id = kwargs.get('patch_set_id')
         self.draft = kwargs.get('draft')
-        self.change_open = kwargs.get('change_open')
-        self.change_sort_key = kwargs.get('change_sort_key')
-        self.reviews = OrderedDict()
+        self.reviews = ReviewSummary()
+
+
+class ReviewSummary(object):
+    '''
+    The reviews of a patchset are only needed to determine when a certain
+    review was made for the first time, who made the first +2 review and
+    whether all reviews were positive. Instead of keeping all the reviews,
+    this summary is updated as the reviews are loaded. The reviews have to be
+    added in the order they were granted.
+
+    @param first: a dictionary where the key is a (category_id, value) tuple
+    and the value the oldest @Review with that category and value.
+    @type first: dict
+
+    @param count: the number of reviews.
+    @type count: integer
+
+    @param all_positive: True if there is at least one review and all reviews
+    have a positive value.
+    @type all_positive: boolean
+    '''
+    __slots__ = ('first', 'count', 'all_positive')
+
+    def __init__(self):
+        self.first = {}
+        self.count = 0
+        self.all_positive = False
+
+    def __len__(self):
+        return self.count
+
+    def add(self, review):
+        self.all_positive = (self.all_positive or self.count == 0) and review.value > 0
+        self.count += 1
+        if review.reviewer.human is not True:
+            return
+        key = (review.category_id, review.value)
+        first = self.first.get(key)
+        # reviews that were granted at the same time with the same category
+        # and value are one and the same review, the last one loaded wins.
+        if first is None or first.granted == review.granted:
+            self.first[key] = review
+
+    def get_first(self, category_id, value):
+        return self.first.get((category_id, value))
 
 
 class Review(object):
@@ -270,15 +297,25 @@ class Review(object):
 
     @param category_id: whether this review was a CodeReview of a Review
     @type category_id: str
+
+    @param reviewer: the Developer who made this review, usually a shared
+    instance from the AccountRegistry. If omitted, a new Developer is created
+    from the account columns in kwargs.
+    @type reviewer: Developer
     '''
-    def __init__(self, **kwargs):
+    __slots__ = ('change_id', 'granted', 'value', 'account_id', 'patch_set_id',
+                 'category_id', 'reviewer')
+
+    def __init__(self, reviewer=None, **kwargs):
         self.change_id = kwargs.get('change_id')
         self.granted = kwargs.get('granted')
         self.value = kwargs.get('value')
         self.account_id = kwargs.get('account_id')
         self.patch_set_id = kwargs.get('patch_set_id')
-        self.category_id = kwargs.get('category_id')
-        self.reviewer = Developer(**kwargs)
+        self.category_id = intern_string(kwargs.get('category_id'))
+        if reviewer is None:
+            reviewer = Developer(**kwargs)
+        self.reviewer = reviewer
 
     def __str__(self):
         return '%s:%s:%s:%s' % (self.change_id, self.patch_set_id,
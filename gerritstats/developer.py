@@ -19,6 +19,8 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+# These defaults are used when settings.yaml does not define staff_emails,
+# staff_domains or bots.
 whitelist = set([
                 'niklas.laxstrom@gmail.com',
                 'roan.kattouw@gmail.com',
@@ -30,14 +32,103 @@ whitelist = set([
                 'hashar@free.fr'
                 ])
 
+staff_domains = ['wikimedia.org']
+
+non_human_reviewers = ['jenkins-bot', 'L10n-bot', 'gerrit2']
+
+
+class AccountRegistry(object):
+    '''
+    The AccountRegistry keeps a single Developer instance per account_id, so
+    every account is only classified once no matter how many changesets and
+    reviews refer to it. The staff and bot rules are read from the settings
+    and compiled into sets once, so classifying an account depends on the
+    length of its email address but not on the number of rules.
+
+    @param staff_emails: email addresses of staff members that do not use a
+    staff email domain.
+    @type staff_emails: set
+
+    @param staff_domains: email domains of staff members, an email address
+    that ends with one of these domains belongs to a staff member.
+    @type staff_domains: set
+
+    @param bots: full names of accounts that are not human.
+    @type bots: set
+
+    @param developers: a dictionary where the key is the account_id and the
+    value an instance of Developer.
+    @type developers: dict
+
+    @param emails: a dictionary where the key is a lower case email address
+    and the value an instance of Developer, only built when find is used.
+    @type emails: dict
+    '''
+    def __init__(self, settings=None):
+        settings = settings or {}
+        # an empty key in settings.yaml is None
+        self.staff_emails = set(settings.get('staff_emails', whitelist) or [])
+        self.staff_domains = set(settings.get('staff_domains', staff_domains) or [])
+        self.bots = set(settings.get('bots', non_human_reviewers) or [])
+        self.developers = {}
+        self.emails = None
+        self.unknown = 0
+
+    def __len__(self):
+        return len(self.developers)
+
+    def add(self, **kwargs):
+        developer = Developer(registry=self, **kwargs)
+        self.developers[developer.account_id] = developer
+        if self.emails is not None:
+            self.emails[developer.preferred_email.lower()] = developer
+        return developer
+
+    def find(self, full_name=None, email=None):
+        '''
+        Return the Developer with @email. The events of gerrit stream-events
+        identify accounts by name and email instead of by account_id.
+        Accounts that are not known yet are added with a negative account_id.
+        '''
+        if self.emails is None:
+            self.emails = dict((developer.preferred_email.lower(), developer)
+                               for developer in self.developers.itervalues())
+        developer = self.emails.get(email.lower()) if email else None
+        if developer is None:
+            self.unknown += 1
+            developer = self.add(account_id=-self.unknown, full_name=full_name,
+                                 preferred_email=email)
+        return developer
+
+    def get(self, account_id):
+        return self.developers.get(account_id)
+
+    def is_staff(self, email):
+        if email in self.staff_emails:
+            return True
+        # look up every suffix of the email address, this is the same as
+        # email.endswith(domain) for every domain
+        return any(email[x:] in self.staff_domains for x in xrange(len(email) + 1))
+
+    def is_human(self, full_name):
+        return full_name not in self.bots
+
+
+default_registry = AccountRegistry()
+
 
 class Developer(object):
     '''
-    The Developer object matches to a row in the accounts table in Gerrit.
+    The Developer object matches to a row in the accounts table in Gerrit. The
+    staff and human classification is done by @registry, which defaults to the
+    built-in rules.
 
 
     '''
-    def __init__(self, **kwargs):
+    __slots__ = ('full_name', 'preferred_email', 'registered_on', 'account_id',
+                 'staff', 'human')
+
+    def __init__(self, registry=None, **kwargs):
         self.full_name = kwargs.get('full_name')
         self.preferred_email = kwargs.get('preferred_email', '')
         self.registered_on = kwargs.get('registered_on')
@@ -45,26 +136,17 @@ class Developer(object):
 
         self.fix_email()
 
-        self.staff = self.is_staff()
-        self.human = self.is_human()
+        self.staff = self.is_staff(registry)
+        self.human = self.is_human(registry)
 
     def __str__(self):
         return self.full_name
 
-    def is_staff(self):
-        if self.preferred_email in whitelist:
-            return True
-        elif self.preferred_email.endswith('wikimedia.org'):
-            return True
-        else:
-            return False
-
-    def is_human(self):
-        non_human_reviewers = ['jenkins-bot', 'L10n-bot', 'gerrit2']
-        if self.full_name in non_human_reviewers:
-            return False
-        else:
-            return True
+    def is_staff(self, registry=None):
+        return (registry or default_registry).is_staff(self.preferred_email)
+
+    def is_human(self, registry=None):
+        return (registry or default_registry).is_human(self.full_name)
 
     def fix_email(self):
         if self.preferred_email is None:
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Evaluating the changesets, determining their review metrics and the days on
+which they are counted, is pure CPU work. With more than one worker the
+changesets are split into chunks that are evaluated by a pool of processes.
+The workers inherit the changesets when they are forked and write the
+evaluation of every changeset as a fixed number of integers to arrays in
+shared memory, so no changesets have to be sent back. The counts are then
+added to the repos by this process.
+'''
+
+import ctypes
+import logging
+import traceback
+import multiprocessing
+
+import numpy as np
+
+from metrics import registry
+from router import SkippedChangesets
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+# Evaluating fewer changesets per worker does not make up for forking it.
+min_chunk_size = 1000
+
+# A worker that is killed, for example by the OOM killer, is replaced by the
+# pool but its chunk is lost and its result never arrives. After this many
+# seconds the pool is given up on and the work is done in this process.
+pool_timeout = 4 * 3600
+
+# The worker processes are forked after the Evaluation is created, so they
+# inherit the changesets and the shared arrays through this dictionary.
+worker_context = {}
+
+
+def create_shared_array(rows, columns=1):
+    '''
+    Return an int32 array of shape (@rows, @columns) in shared memory, the
+    writes of forked worker processes are visible to this process.
+    '''
+    size = rows * columns
+    shared = multiprocessing.RawArray(ctypes.c_int32, max(size, 1))
+    return np.frombuffer(shared, dtype=np.int32)[:size].reshape(rows, columns)
+
+
+class Evaluation(object):
+    '''
+    The evaluation of the changesets in @change_ids, row x describes the
+    changeset change_ids[x] with a column per metric of the schema.
+
+    @param metrics: the compiled event and interval metrics.
+    @type metrics: list
+
+    @param names: the names of the repos, the id of a repo is its position.
+    @type names: list
+
+    @param repo: the id of the repo of every changeset, -1 if the changeset
+    does not belong to a repo.
+    @type repo: numpy.ndarray
+
+    @param first: the ordinal of the first day on which a metric counts a
+    changeset.
+    @type first: numpy.ndarray
+
+    @param days: the number of days that a metric counts a changeset, see
+    Repo.count_days. Event metrics count a changeset for a single day.
+    @type days: numpy.ndarray
+
+    @param columns: the columns of a metric that count a changeset as a
+    bitmask, the n-th bit is the n-th column of the metric. Zero if the
+    metric does not count the changeset.
+    @type columns: numpy.ndarray
+    '''
+    def __init__(self, gerrit, change_ids):
+        schema = registry.compile()
+        self.metrics = schema.events + schema.intervals
+        self.bits = [dict((column, 1 << x) for x, column in enumerate(metric.columns))
+                     for metric in self.metrics]
+        self.names = sorted(gerrit.repos.keys())
+        self.ids = dict((name, x) for x, name in enumerate(self.names))
+        self.change_ids = change_ids
+        self.repo = create_shared_array(len(change_ids))[:, 0]
+        self.first = create_shared_array(len(change_ids), len(self.metrics))
+        self.days = create_shared_array(len(change_ids), len(self.metrics))
+        self.columns = create_shared_array(len(change_ids), len(self.metrics))
+
+    def __len__(self):
+        return len(self.change_ids)
+
+    def evaluate(self, gerrit, changesets, start, end):
+        '''
+        Evaluate the changesets in rows @start up to @end, this is what
+        Repo.determine_intervals does for a single changeset.
+        '''
+        for x in xrange(start, end):
+            changeset = changesets[self.change_ids[x]]
+            changeset.evaluate()
+            repo = gerrit.router.route(changeset.dest_project_name).repo
+            if repo is None:
+                self.repo[x] = -1
+                continue
+            self.repo[x] = self.ids[repo.name]
+            for y, metric in enumerate(self.metrics):
+                if not metric.is_counted(changeset):
+                    continue
+                start_date = metric.get_start_date(changeset)
+                days = 1
+                if metric.metric.kind == 'interval':
+                    days = repo.count_days(start_date, metric.get_end_date(changeset), changeset.merged)
+                    if days == 0:
+                        continue
+                bits = self.bits[y]
+                self.first[x, y] = start_date.date().toordinal()
+                self.days[x, y] = days
+                self.columns[x, y] = sum([bits[column] for column in metric.determine_columns(changeset)])
+
+    def determine_changes(self):
+        '''
+        Return the deltas of the evaluated changesets as the arrays (repos,
+        ordinals, columns, values) sorted by repo: a +1 on the first day and a
+        -1 on the day after the last day that a column counts a changeset.
+        Returns None if no changeset is counted.
+        '''
+        index = registry.compile().index
+        repos, days, columns, values = [], [], [], []
+        for y, metric in enumerate(self.metrics):
+            for column, bit in self.bits[y].iteritems():
+                rows = np.flatnonzero(self.columns[:, y] & bit)
+                if not len(rows):
+                    continue
+                first = self.first[rows, y]
+                for day, value in ((first, 1), (first + self.days[rows, y], -1)):
+                    repos.append(self.repo[rows])
+                    days.append(day)
+                    columns.append(np.repeat(index[column], len(rows)))
+                    values.append(np.repeat(value, len(rows)))
+        if not repos:
+            return None
+        repos, days, columns, values = [np.concatenate(array) for array in (repos, days, columns, values)]
+        order = np.argsort(repos, kind='mergesort')
+        return repos[order], days[order], columns[order], values[order]
+
+    def count(self, gerrit):
+        '''
+        Add the counts of the evaluated changesets to the observations of
+        their repos. These are the deltas that Repo.apply_intervals records,
+        but they are accumulated straight from the arrays without recording
+        them in Repo.deltas, those are only needed by incremental and
+        real-time runs which evaluate the changesets serially.
+        '''
+        changes = self.determine_changes()
+        if changes is None:
+            return
+        repos, days, columns, values = changes
+        ids, starts = np.unique(repos, return_index=True)
+        ends = np.append(starts[1:], len(repos))
+        for repo, start, end in zip(ids.tolist(), starts.tolist(), ends.tolist()):
+            store = gerrit.repos[self.names[repo]].store
+            store.accumulate_changes(days[start:end], columns[start:end], values[start:end])
+
+    def determine_skipped(self, gerrit, changesets, skipped=None):
+        if skipped is None:
+            skipped = SkippedChangesets()
+        for x in np.flatnonzero(self.repo == -1).tolist():
+            skipped.add(gerrit.router.route(changesets[self.change_ids[x]].dest_project_name))
+        return skipped
+
+
+def evaluate_worker(chunk):
+    try:
+        worker_context['evaluation'].evaluate(worker_context['gerrit'], worker_context['changesets'], *chunk)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def evaluate_in_pool(evaluation, gerrit, changesets, workers):
+    '''
+    Fill @evaluation using a pool of @workers processes. Returns False if
+    there are too few changesets to split, if the pool failed or if it did
+    not finish within pool_timeout seconds, the changesets then have to be
+    evaluated in this process.
+    '''
+    chunk_size = max(min_chunk_size, len(evaluation) / (workers * 4) + 1)
+    chunks = [(start, min(start + chunk_size, len(evaluation)))
+              for start in xrange(0, len(evaluation), chunk_size)]
+    if len(chunks) < 2:
+        return False
+
+    worker_context['gerrit'] = gerrit
+    worker_context['changesets'] = changesets
+    worker_context['evaluation'] = evaluation
+    try:
+        pool = multiprocessing.Pool(min(workers, len(chunks)))
+    except (OSError, ImportError), e:
+        logging.warning('Could not start %s worker processes, evaluating changesets serially. Error: %s' % (workers, e))
+        worker_context.clear()
+        return False
+    logging.info('Evaluating %s changesets in %s chunks using %s worker processes.' % (len(evaluation), len(chunks), workers))
+    try:
+        errors = [error for error in pool.map_async(evaluate_worker, chunks).get(pool_timeout) if error]
+    except multiprocessing.TimeoutError:
+        pool.terminate()
+        pool.join()
+        worker_context.clear()
+        logging.warning('The worker processes did not finish within %s seconds, evaluating changesets serially.' % pool_timeout)
+        return False
+    pool.close()
+    pool.join()
+    worker_context.clear()
+    if errors:
+        logging.warning('Could not evaluate changesets in the worker processes, evaluating them serially. Error:\n%s' % errors[0])
+        return False
+    return True
+
+
+def evaluate_concurrently(gerrit, changesets, workers):
+    '''
+    Evaluate @changesets using a pool of @workers processes and record their
+    deltas in their repos. The changesets of this process are not evaluated,
+    only their counts end up in the repos. Returns the SkippedChangesets, or
+    None if there are too few changesets to split or if the pool failed, the
+    changesets then have to be evaluated serially.
+    '''
+    if len(changesets) <= min_chunk_size:
+        return None
+    evaluation = Evaluation(gerrit, changesets.keys())
+    if not evaluate_in_pool(evaluation, gerrit, changesets, workers):
+        return None
+    evaluation.count(gerrit)
+    return evaluation.determine_skipped(gerrit, changesets)
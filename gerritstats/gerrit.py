@@ -20,13 +20,17 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
 import os
-import fnmatch
 import logging
 import paramiko
 
 
 from repo import Repo
-from utils import unsuccessful_exit
+from router import Router
+from writer import DatasetWriter
+from ssh import SSHSession, EventStream, ProjectCache, CommandError
+from snapshot import Snapshot, SnapshotWriter
+from shards import Shard, Partials
+from utils import Clock, Window, unsuccessful_exit
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -46,77 +50,154 @@ class Gerrit(object):
     def __init__(self, args, settings):
         self.dataset = args.datasets
         self.my_cnf = args.sql
+        self.stream = args.stream
+        self.batch_size = args.batch_size if args.stream else None
         self.csv_location, self.yaml_location = self.init_locations()
+        self.writer = DatasetWriter([self.csv_location, self.yaml_location])
         self.toolkit = args.toolkit
+        self.engine = args.engine
+        self.incremental = args.incremental
+        self.append = args.append
+        self.rewrite_days = args.rewrite_days
+        self.workers = args.workers
+        self.memory_budget = args.memory_budget * 1048576 if args.memory_budget else None
+        self.realtime = args.realtime
+        self.flush_interval = args.flush_interval
+        self.concurrent = args.concurrent
         self.ssh_username = args.ssh_username
         self.ssh_identity = args.ssh_identity
         self.ssh_password = args.ssh_password
+        self.projects_ttl = args.projects_ttl
+        self.session = None
+        self.snapshot = self.init_snapshot(args)
         self.host = settings.get('host')
         self.port = settings.get('port')
         self.ignore_repos = settings.get('ignore_repos')
         self.parents = settings.get('parents')
+        self.router = Router(self.ignore_repos, self.parents)
         self.creation_date = settings.get('creation_date')
+        self.clock = Clock(args.as_of)
+        self.backfill = self.init_backfill(args)
+        self.shard, self.partials = self.init_shards(args)
         self.repos = {}
         self.is_valid_path(self.yaml_location)
         self.is_valid_path(self.csv_location)
-        self.is_valid_path(self.my_cnf)
-        self.remove_old_datasets()
+        if not (self.snapshot and self.snapshot.offline or self.partials):
+            self.is_valid_path(self.my_cnf)
 
     def __str__(self):
         return 'Gerrit-stats general settings object.'
 
     def run_query(self, query):
-        ssh = paramiko.SSHClient()
-        #ssh.load_system_host_keys()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        return self.run_queries([query])[0]
+
+    def run_queries(self, queries):
+        '''
+        Run @queries on the Gerrit server at the same time over a single SSH
+        connection, the connection stays open for subsequent queries.
+        '''
+        if self.session is None:
+            self.session = SSHSession(self.host, self.port,
+                                      username=self.ssh_username,
+                                      key_filename=self.ssh_identity,
+                                      password=self.ssh_password)
         try:
-            ssh.connect(self.host, port=self.port,
-                    username=self.ssh_username,
-                    key_filename=self.ssh_identity,
-                    password=self.ssh_password,
-                    allow_agent=False)
+            return self.session.run_many(queries)
         except paramiko.PasswordRequiredException, e:
             logging.warning('Please specify on the command line the ssh-password parameter correctly.')
             unsuccessful_exit()
+        except CommandError, e:
+            logging.warning('Could not run %s on the Gerrit server. Error %s' % (e.command, e.error.strip()))
+            unsuccessful_exit()
         except Exception, e:
             logging.warning('Encountered error:\n %s' % e)
             unsuccessful_exit()
 
-        stdin, stdout, stderr = ssh.exec_command(query)
-        data = stdout.readlines()
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+    def open_event_stream(self):
+        '''
+        Subscribe to gerrit stream-events over a connection of its own, so
+        that the stream stays open when the connection for the queries is
+        closed. The events that arrive while the changesets are loaded from
+        the database are buffered by the server connection.
+        '''
+        session = SSHSession(self.host, self.port,
+                             username=self.ssh_username,
+                             key_filename=self.ssh_identity,
+                             password=self.ssh_password)
         try:
-            error = stderr.readlines()
-        except IOError:
-            pass
+            return EventStream(session).open()
+        except paramiko.PasswordRequiredException, e:
+            logging.warning('Please specify on the command line the ssh-password parameter correctly.')
+            unsuccessful_exit()
+        except Exception, e:
+            logging.warning('Could not subscribe to gerrit stream-events. Error:\n %s' % e)
+            unsuccessful_exit()
 
-        if error:
-            logging.warning('Could not retrieve list with Gerrit repositories. Error %s' % error.strip())
+    def init_snapshot(self, args):
+        '''
+        With --from-snapshot the reviewdb tables and the list of repositories
+        are read from a snapshot instead of from the database and the Gerrit
+        server, with --snapshot they are saved to a snapshot while loading.
+        '''
+        if args.from_snapshot:
+            try:
+                return Snapshot(args.from_snapshot)
+            except (IOError, ValueError), e:
+                logging.error('Could not open snapshot %s. Error: %s' % (args.from_snapshot, e))
+                unsuccessful_exit()
+        elif args.snapshot:
+            return SnapshotWriter(args.snapshot)
+        return None
+
+    def init_backfill(self, args):
+        '''
+        With --since, --until or --as-of only the observations of a window of
+        days are recomputed and merged into the existing datafiles. The
+        window ends at the yesterday of the clock at the latest.
+        '''
+        if not (args.since or args.until or args.as_of):
+            return None
+        first = args.since or self.creation_date
+        last = args.until or self.clock.yesterday.date()
+        if last > self.clock.yesterday.date():
+            logging.error('--until %s is not before --as-of %s, observations are only counted for full days.' % (last, self.clock))
+            unsuccessful_exit()
+        if first is None or first > last:
+            logging.error('The window %s - %s does not contain any days.' % (first, last))
+            unsuccessful_exit()
+        return Window(first, last)
+
+    def init_shards(self, args):
+        '''
+        With --shard this run is one of the workers of a sharded run and only
+        saves the observations of the repos of its shard to
+        --shard-directory, with --merge-shards the observations that all
+        workers saved there are merged and the datasets are written. Returns
+        a (Shard, Partials) tuple, either of which is None.
+        '''
+        if not (args.shard or args.merge_shards):
+            return None, None
+        if args.shard and args.merge_shards:
+            logging.error('A run is either a worker (--shard) or the merge step (--merge-shards) of a sharded run.')
             unsuccessful_exit()
-        return data
+        if not args.shard_directory:
+            logging.error('Specify the directory that is shared by the workers and the merge step of a sharded run using --shard-directory.')
+            unsuccessful_exit()
+        self.is_valid_path(args.shard_directory)
+        if args.shard:
+            index, count = args.shard
+            return Shard(index, count, args.shard_directory), None
+        return None, Partials(args.shard_directory)
 
     def init_locations(self):
         csv = os.path.join(self.dataset, 'datafiles')
         yaml = os.path.join(self.dataset, 'datasources')
         return csv, yaml
 
-    def walk_directory(self, folder, pattern):
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, pattern):
-                yield os.path.join(root, filename)
-
-    def remove_old_datasets(self):
-        sources = [self.csv_location, self.yaml_location]
-        for source in sources:
-            for filename in self.walk_directory(source, '*.*'):
-                logging.info('Removing %s...' % (
-                    os.path.join(source, filename)))
-                try:
-                    os.unlink(filename)
-                except OSError, e:
-                    logging.warning('Failed to remove %s but get error %s' % (os.path.join(source, filename), e))
-                    unsuccessful_exit()
-            logging.info('Successfully removed %s' % source)
-
     def is_valid_path(self, path):
         if path.startswith('~'):
             path = os.path.expanduser(path)
@@ -143,9 +224,7 @@ class Gerrit(object):
             repo = repo.strip()
             description = description.strip()
 
-            tests = [repo.startswith(ignore_repo)
-                     is False for ignore_repo in self.ignore_repos]
-            if all(tests):
+            if not self.router.is_ignored(repo):
                 rp = Repo(repo, description, self)
                 self.repos[rp.name] = rp
 
@@ -154,7 +233,19 @@ class Gerrit(object):
                 self.repos[repo['name']] = Repo(repo['name'],
                                                 repo['description'], self, is_parent=True)
 
+        for repo in self.repos.itervalues():
+            self.router.add(repo)
+
     def list_repos(self):
+        if self.snapshot and self.snapshot.offline:
+            return self.snapshot.projects
         query = 'gerrit ls-projects -d'
-        repos = self.run_query(query)
+        cache = ProjectCache(os.path.join(self.dataset, 'gerrit-stats.projects'),
+                             self.projects_ttl, self.host, self.port, query)
+        repos = cache.load()
+        if repos is None:
+            repos = self.run_query(query)
+            cache.save(repos)
+        if self.snapshot:
+            self.snapshot.projects = repos
         return repos
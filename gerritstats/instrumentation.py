@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import gc
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+
+from writer import write_atomically
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+
+def determine_cpu_time():
+    '''
+    User plus system time of this process and of its (finished) worker
+    processes, in seconds.
+    '''
+    cpu = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        cpu += usage.ru_utime + usage.ru_stime
+    return cpu
+
+
+def determine_peak_rss():
+    '''
+    The highest resident set size of this process or any of its worker
+    processes, in bytes. Linux reports ru_maxrss in kilobytes, OS X in bytes.
+    '''
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+def determine_rss():
+    '''
+    The current resident set size of this process in bytes. Only Linux
+    reports it, elsewhere this falls back to the peak resident set size.
+    '''
+    try:
+        fh = open('/proc/self/statm')
+        pages = int(fh.read().split()[1])
+        fh.close()
+    except (IOError, IndexError, ValueError):
+        return determine_peak_rss()
+    return pages * resource.getpagesize()
+
+
+class Phase(object):
+    '''
+    The measurements of a single phase of a run.
+
+    @param rows: the number of database rows that were fetched during the
+    phase.
+    @type rows: int
+
+    @param objects: the growth of the number of objects tracked by the garbage
+    collector, this is roughly the number of objects created by the phase that
+    are still alive.
+    @type objects: int
+
+    @param peak_rss: the peak resident set size in bytes at the end of the
+    phase, this never decreases during a run.
+    @type peak_rss: int
+    '''
+    __slots__ = ['name', 'wall', 'cpu', 'rows', 'objects', 'peak_rss']
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.rows = 0
+        self.objects = 0
+        self.peak_rss = 0
+
+    def __str__(self):
+        return '%s: %.3fs wall, %.3fs cpu, %s rows, %s objects, peak rss %.1f MB' % (
+            self.name, self.wall, self.cpu, self.rows, self.objects, self.peak_rss / 1048576.0)
+
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+
+class Instrumentation(object):
+    '''
+    Records the wall time, cpu time, number of fetched rows, number of created
+    objects and peak memory of every phase of a run. At the end of a run the
+    measurements are written to a JSON run report and, optionally, to a file
+    for the textfile collector of the Prometheus node exporter so that slow
+    nightly runs can be alerted on.
+    '''
+    def __init__(self):
+        self.phases = []
+        self.rows = 0
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.success = False
+
+    def count_rows(self, rows):
+        # rows can be fetched by several threads at the same time
+        with self.lock:
+            self.rows += rows
+
+    def measure(self, name, func, *args, **kwargs):
+        '''
+        Run func(*args, **kwargs) as phase @name and return its result.
+        '''
+        phase = Phase(name)
+        rows = self.rows
+        objects = len(gc.get_objects())
+        cpu = determine_cpu_time()
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            phase.wall = time.time() - start
+            phase.cpu = determine_cpu_time() - cpu
+            phase.rows = self.rows - rows
+            phase.objects = len(gc.get_objects()) - objects
+            phase.peak_rss = determine_peak_rss()
+            self.phases.append(phase)
+            logging.info('Phase %s' % phase)
+
+    def to_dict(self):
+        return {
+            'started': self.started,
+            'wall': time.time() - self.started,
+            'cpu': determine_cpu_time(),
+            'peak_rss': determine_peak_rss(),
+            'success': self.success,
+            'phases': [phase.to_dict() for phase in self.phases],
+        }
+
+    def write_report(self, path):
+        write_atomically(path, json.dumps(self.to_dict(), indent=2, sort_keys=True) + '\n')
+        logging.info('Wrote run report to %s' % path)
+
+    def write_prometheus(self, path):
+        report = self.to_dict()
+        lines = []
+        metrics = [
+            ('wall_seconds', 'wall', 'Wall clock time of a gerrit-stats phase.'),
+            ('cpu_seconds', 'cpu', 'CPU time (user + system) of a gerrit-stats phase.'),
+            ('rows', 'rows', 'Number of database rows fetched during a gerrit-stats phase.'),
+            ('objects', 'objects', 'Growth of the number of live objects during a gerrit-stats phase.'),
+            ('peak_rss_bytes', 'peak_rss', 'Peak resident set size at the end of a gerrit-stats phase.'),
+        ]
+        for metric, key, description in metrics:
+            lines.append('# HELP gerrit_stats_phase_%s %s' % (metric, description))
+            lines.append('# TYPE gerrit_stats_phase_%s gauge' % metric)
+            for phase in report['phases']:
+                lines.append('gerrit_stats_phase_%s{phase="%s"} %s' % (metric, phase['name'], phase[key]))
+
+        metrics = [
+            ('run_wall_seconds', report['wall'], 'Wall clock time of the last gerrit-stats run.'),
+            ('run_cpu_seconds', report['cpu'], 'CPU time of the last gerrit-stats run.'),
+            ('run_peak_rss_bytes', report['peak_rss'], 'Peak resident set size of the last gerrit-stats run.'),
+            ('run_success', int(report['success']), 'Whether the last gerrit-stats run was successful.'),
+            ('run_timestamp_seconds', report['started'], 'Start time of the last gerrit-stats run.'),
+        ]
+        for metric, value, description in metrics:
+            lines.append('# HELP gerrit_stats_%s %s' % (metric, description))
+            lines.append('# TYPE gerrit_stats_%s gauge' % metric)
+            lines.append('gerrit_stats_%s %s' % (metric, value))
+        write_atomically(path, '\n'.join(lines) + '\n')
+        logging.info('Wrote Prometheus metrics to %s' % path)
+
+
+# The instrumentation of the current run, fetch_rows in stats.py counts the
+# rows it fetches here.
+instrumentation = Instrumentation()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+The metrics that gerrit-stats calculates. Every metric is declared once in a
+MetricRegistry, the registry compiles the metrics into a Schema: the fixed
+column layout of the datafiles that is used for counting, aggregating and
+writing. To add a metric, register it in create_registry.
+'''
+
+
+class Breakdown(object):
+    '''
+    A Breakdown splits a metric in a column per group of changesets, for
+    example the changesets of staff and of volunteers.
+
+    @param name: the suffix of the column.
+    @type name: str
+
+    @param applies: function that determines whether a changeset belongs to
+    this group.
+    @type applies: function
+    '''
+    __slots__ = ('name', 'applies')
+
+    def __init__(self, name, applies):
+        self.name = name
+        self.applies = applies
+
+    def __str__(self):
+        return self.name
+
+
+breakdowns = {
+    'total': Breakdown('total', lambda changeset: True),
+    'staff': Breakdown('staff', lambda changeset: changeset.author.staff is True),
+    'volunteer': Breakdown('volunteer', lambda changeset: changeset.author.staff is False),
+}
+
+
+class Metric(object):
+    '''
+    @param name: the name of the metric, the columns are named
+    <name>_<breakdown> or just <name> if there are no breakdowns.
+    @type name: str
+
+    @param kind: 'event' metrics count a changeset once, on the day of the
+    @start attribute. 'interval' metrics count a changeset on every day from
+    the @start attribute up to the @end attribute, see Repo.count_days.
+    @type kind: str
+
+    @param start: the name of the Changeset attribute that contains the
+    (first) day, either a datetime or an object with a granted attribute.
+    @type start: str
+
+    @param end: the name of the Changeset attribute that contains the last
+    day of an interval metric.
+    @type end: str
+
+    @param condition: function that determines whether a changeset is counted
+    at all, None means always.
+    @type condition: function
+
+    @param ignore_statuses: the statuses of changesets that are not counted.
+    @type ignore_statuses: tuple
+
+    @param label: the label of the column in the datafile, only for metrics
+    without breakdowns, defaults to @name.
+    @type label: str
+    '''
+    kinds = ('event', 'interval')
+
+    def __init__(self, name, kind, start, end=None, breakdowns=None,
+                 condition=None, ignore_statuses=(), label=None):
+        if kind not in self.kinds:
+            raise ValueError('Metric %s has unknown kind %s, valid kinds are: %s' % (name, kind, ', '.join(self.kinds)))
+        if kind == 'interval' and end is None:
+            raise ValueError('Interval metric %s requires an end attribute.' % name)
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.breakdowns = sorted(breakdowns or [], key=lambda breakdown: breakdown.name)
+        self.condition = condition
+        self.ignore_statuses = tuple(ignore_statuses)
+        self.label = label or name
+
+    def __str__(self):
+        return self.name
+
+    def determine_columns(self):
+        if not self.breakdowns:
+            return [self.name]
+        return ['%s_%s' % (self.name, breakdown.name) for breakdown in self.breakdowns]
+
+    def get_date(self, changeset, attribute):
+        value = getattr(changeset, attribute)
+        return getattr(value, 'granted', value)
+
+    def get_start_date(self, changeset):
+        return self.get_date(changeset, self.start)
+
+    def get_end_date(self, changeset):
+        return self.get_date(changeset, self.end)
+
+
+class CompiledMetric(object):
+    '''
+    A metric together with its precomputed columns, so that counting a
+    changeset does not have to construct column names.
+    '''
+    __slots__ = ('metric', 'columns', 'breakdowns', 'name', 'condition',
+                 'ignore_statuses')
+
+    def __init__(self, metric):
+        self.metric = metric
+        self.name = metric.name
+        self.condition = metric.condition
+        self.ignore_statuses = metric.ignore_statuses
+        self.columns = tuple(metric.determine_columns())
+        self.breakdowns = [(breakdown.applies, column) for breakdown, column in
+                           zip(metric.breakdowns, self.columns)]
+
+    def is_counted(self, changeset):
+        if changeset.status in self.ignore_statuses:
+            return False
+        return self.condition is None or self.condition(changeset)
+
+    def determine_columns(self, changeset):
+        '''
+        The columns in which @changeset is counted.
+        '''
+        if not self.breakdowns:
+            return self.columns
+        return tuple([column for applies, column in self.breakdowns if applies(changeset)])
+
+    def get_start_date(self, changeset):
+        return self.metric.get_start_date(changeset)
+
+    def get_end_date(self, changeset):
+        return self.metric.get_end_date(changeset)
+
+
+class Schema(object):
+    '''
+    The fixed column layout of the datafiles, compiled from a MetricRegistry.
+
+    @param columns: the names of the counters in the order in which they are
+    stored and written (sorted by name).
+    @type columns: list
+
+    @param labels: the header of the datafile, starting with date.
+    @type labels: list
+
+    @param events: the compiled event metrics.
+    @type events: list
+
+    @param intervals: the compiled interval metrics, sorted by name.
+    @type intervals: list
+    '''
+    def __init__(self, metrics):
+        compiled = [CompiledMetric(metric) for metric in sorted(metrics, key=lambda metric: metric.name)]
+        self.events = [metric for metric in compiled if metric.metric.kind == 'event']
+        self.intervals = [metric for metric in compiled if metric.metric.kind == 'interval']
+        labels = {}
+        for metric in compiled:
+            for column in metric.columns:
+                if column in labels:
+                    raise ValueError('Column %s is defined by more than one metric.' % column)
+                labels[column] = metric.metric.label if not metric.breakdowns else column
+        self.columns = sorted(labels.keys())
+        self.index = dict((column, x) for x, column in enumerate(self.columns))
+        self.labels = ['date'] + [labels[column] for column in self.columns]
+        self.header = ','.join(self.labels)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __eq__(self, other):
+        return isinstance(other, Schema) and self.columns == other.columns
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class MetricRegistry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.schema = None
+
+    def __iter__(self):
+        return self.metrics.itervalues()
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('Metric %s is already registered.' % metric.name)
+        self.metrics[metric.name] = metric
+        self.schema = None
+        return metric
+
+    def compile(self):
+        if self.schema is None:
+            self.schema = Schema(self.metrics.values())
+        return self.schema
+
+
+def create_registry():
+    registry = MetricRegistry()
+    registry.register(Metric('changesets', 'event', 'created_on', label='commits'))
+    registry.register(Metric('self_review', 'event', 'created_on',
+                             condition=lambda changeset: changeset.self_review is True))
+    staff = [breakdowns['total'], breakdowns['staff'], breakdowns['volunteer']]
+    # wait time between creation and first review
+    registry.register(Metric('waiting_first_review', 'interval', 'created_on',
+                             'waiting_first_review', breakdowns=staff,
+                             ignore_statuses=('A', 'd')))
+    # wait time between first review and plus 2
+    registry.register(Metric('waiting_plus2', 'interval', 'waiting_first_review',
+                             'waiting_plus2', breakdowns=staff,
+                             ignore_statuses=('A', 'd')))
+    return registry
+
+
+registry = create_registry()
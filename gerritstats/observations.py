@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+from datetime import date, datetime
+
+import numpy as np
+
+
+class ObservationStore(object):
+    '''
+    The ObservationStore keeps the daily counters of a repo in a single integer
+    array with one row per day and one column per metric. Row x contains the
+    counters of the day with ordinal start + x.
+
+    @param columns: the names of the counters, in the order they are written
+    to the datafile.
+    @type columns: list
+
+    @param index: a dictionary that maps the name of a counter to its column.
+    @type index: dict
+
+    @param start: the ordinal (see datetime.date.toordinal) of the first row.
+    @type start: int
+
+    @param values: the counters, an array of shape (days, columns).
+    @type values: numpy.ndarray
+
+    @param present: flags whether a day has an observation, days without an
+    observation are not written to the datafile.
+    @type present: numpy.ndarray
+
+    @param touched: flags whether the observation of a day is the result of
+    an actual observation instead of being added by fill.
+    @type touched: numpy.ndarray
+
+    @param changeset_ids: a dictionary where the key is the ordinal of a day
+    and the value a set of the change_ids that were waiting for a first review
+    on that day. Only used by the daterange engine.
+    @type changeset_ids: dict
+    '''
+    dtype = np.int32
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.index = dict((column, x) for x, column in enumerate(self.columns))
+        self.start = None
+        self.values = np.zeros((0, len(self.columns)), dtype=self.dtype)
+        self.present = np.zeros(0, dtype=bool)
+        self.touched = np.zeros(0, dtype=bool)
+        self.changeset_ids = {}
+
+    def __len__(self):
+        return int(self.present.sum())
+
+    def __str__(self):
+        return '%s observations' % len(self)
+
+    def end(self):
+        '''
+        The ordinal of the day after the last row.
+        '''
+        if self.start is None:
+            return None
+        return self.start + len(self.present)
+
+    def reserve(self, first, last):
+        '''
+        Make sure that there are rows for the days with ordinals first up to,
+        but not including, last. The array grows geometrically so that adding
+        days one at a time is cheap.
+        '''
+        if last <= first:
+            return
+        if self.start is None:
+            self.start = first
+            self.resize(0, last - first)
+            return
+        end = self.end()
+        size = len(self.present)
+        before = after = 0
+        if first < self.start:
+            before = max(self.start - first, size)
+        if last > end:
+            after = max(last - end, size)
+        if before or after:
+            self.resize(before, after)
+
+    def resize(self, before, after):
+        columns = len(self.columns)
+        self.values = np.concatenate([np.zeros((before, columns), dtype=self.dtype),
+                                      self.values,
+                                      np.zeros((after, columns), dtype=self.dtype)])
+        self.present = np.concatenate([np.zeros(before, dtype=bool), self.present,
+                                       np.zeros(after, dtype=bool)])
+        self.touched = np.concatenate([np.zeros(before, dtype=bool), self.touched,
+                                       np.zeros(after, dtype=bool)])
+        self.start -= before
+
+    def row(self, day):
+        return day.toordinal() - self.start
+
+    def contains(self, day):
+        if self.start is None:
+            return False
+        x = self.row(day)
+        return 0 <= x < len(self.present) and bool(self.present[x])
+
+    def create(self, day, touched=True):
+        '''
+        Add an observation for @day unless it already exists.
+        '''
+        ordinal = day.toordinal()
+        self.reserve(ordinal, ordinal + 1)
+        x = ordinal - self.start
+        if not self.present[x]:
+            self.present[x] = True
+            self.touched[x] = touched
+
+    def remove(self, day):
+        if self.contains(day):
+            x = self.row(day)
+            self.present[x] = False
+            self.touched[x] = False
+            self.values[x] = 0
+            self.changeset_ids.pop(day.toordinal(), None)
+
+    def dates(self):
+        if self.start is None:
+            return []
+        return [date.fromordinal(self.start + x) for x in np.flatnonzero(self.present)]
+
+    def get(self, day, column):
+        return int(self.values[self.row(day), self.index[column]])
+
+    def set(self, day, column, value):
+        self.values[self.row(day), self.index[column]] = value
+
+    def add(self, first_day, days, columns, value=1):
+        '''
+        Add @value to @columns for @days days starting at @first_day. Days
+        without an observation get a new (touched) observation.
+        '''
+        if days <= 0:
+            return
+        first = first_day.toordinal()
+        self.reserve(first, first + days)
+        x = first - self.start
+        indexes = [self.index[column] for column in columns]
+        self.values[x:x + days, indexes] += value
+        self.mark(x, x + days, np.ones(days, dtype=bool))
+
+    def mark(self, x, y, rows, touched=True):
+        '''
+        Rows x up to y for which @rows is True get an observation, rows that
+        did not have an observation yet get @touched as touched flag.
+        '''
+        new = rows & ~self.present[x:y]
+        if touched is True:
+            self.touched[x:y] |= new
+        elif touched is not False:
+            self.touched[x:y][new] = touched[new]
+        self.present[x:y] |= rows
+
+    def accumulate(self, deltas):
+        '''
+        Add the running sum of @deltas, a dictionary of date -> {column:
+        delta}, to the counters. Days on which all running sums are zero do not
+        get an observation.
+        '''
+        if not deltas:
+            return
+        ordinals, columns, values = [], [], []
+        for day, delta in deltas.iteritems():
+            for column, value in delta.iteritems():
+                ordinals.append(day.toordinal())
+                columns.append(self.index[column])
+                values.append(value)
+        self.accumulate_changes(np.array(ordinals), np.array(columns), np.array(values))
+
+    def accumulate_changes(self, ordinals, columns, values):
+        '''
+        Like accumulate, but the deltas are given as arrays: @values[x] is the
+        change of the column with index @columns[x] on the day with ordinal
+        @ordinals[x]. The changes of the same day and column are added up.
+        '''
+        if not len(ordinals):
+            return
+        first = int(ordinals.min())
+        last = int(ordinals.max())
+        changes = np.zeros((last - first + 1, len(self.columns)), dtype=self.dtype)
+        np.add.at(changes, (ordinals - first, columns), values)
+        running = np.cumsum(changes[:-1], axis=0, dtype=self.dtype)
+        self.reserve(first, last)
+        x = first - self.start
+        y = x + len(running)
+        self.values[x:y] += running
+        self.mark(x, y, running.any(axis=1))
+
+    def fill(self, first_day, days):
+        '''
+        Add an untouched observation for every day in the @days days starting
+        at @first_day that does not have an observation yet.
+        '''
+        if days <= 0:
+            return
+        first = first_day.toordinal()
+        self.reserve(first, first + days)
+        x = first - self.start
+        self.mark(x, x + days, np.ones(days, dtype=bool), False)
+
+    def determine_first_commit(self, before):
+        '''
+        Return the date of the last untouched observation preceding the first
+        touched observation, only observations before @before are considered.
+        Returns None if there is no such observation.
+        '''
+        if self.start is None:
+            return None
+        present = np.flatnonzero(self.present)
+        touched = np.flatnonzero(self.present & self.touched)
+        if len(touched):
+            present = present[present < touched[0]]
+        present = present[present + self.start < before.toordinal()]
+        if not len(present):
+            return None
+        return date.fromordinal(self.start + int(present[-1]))
+
+    def prune(self, first_day):
+        '''
+        Remove all observations before @first_day.
+        '''
+        if self.start is None:
+            return
+        x = first_day.toordinal() - self.start
+        if x <= 0:
+            return
+        self.values = self.values[x:].copy()
+        self.present = self.present[x:].copy()
+        self.touched = self.touched[x:].copy()
+        self.start += x
+        for ordinal in self.changeset_ids.keys():
+            if ordinal < self.start:
+                del self.changeset_ids[ordinal]
+
+    def merge(self, other):
+        '''
+        Add the counters of @other to the counters of this store in place. A
+        day is touched if it is touched in either store, so the result does not
+        depend on the order in which stores are merged.
+        '''
+        if other.start is None:
+            return
+        if other.columns != self.columns:
+            raise ValueError('Cannot merge observations with different columns.')
+        self.reserve(other.start, other.end())
+        x = other.start - self.start
+        y = x + len(other.present)
+        self.values[x:y] += other.values
+        self.touched[x:y] |= other.present & other.touched
+        self.present[x:y] |= other.present
+
+    def select_rows(self, since=None, until=None):
+        if self.start is None:
+            return np.zeros(0, dtype=np.intp)
+        rows = np.flatnonzero(self.present)
+        if since is not None:
+            rows = rows[rows + self.start > since.toordinal()]
+        if until is not None:
+            rows = rows[rows + self.start <= until.toordinal()]
+        return rows
+
+    def iterrows(self, since=None, until=None):
+        '''
+        Iterate over (date, values) of all the observations in chronological
+        order. Observations on or before @since and after @until are omitted.
+        '''
+        rows = self.select_rows(since, until)
+        values = self.values[rows].tolist()
+        for x, row in enumerate(rows.tolist()):
+            yield date.fromordinal(self.start + row), values[x]
+
+    def iterblocks(self, since=None, until=None, block_size=1024):
+        '''
+        Like iterrows, but iterate over (ordinals, values) of blocks of at
+        most @block_size observations, where values is an array with a row
+        per ordinal. Only a single block is copied out of the store at a time.
+        '''
+        rows = self.select_rows(since, until)
+        for x in xrange(0, len(rows), block_size):
+            block = rows[x:x + block_size]
+            yield (block + self.start).tolist(), self.values[block]
+
+    def first_date(self):
+        if self.start is None or not self.present.any():
+            return None
+        return date.fromordinal(self.start + int(np.flatnonzero(self.present)[0]))
+
+    def last_date(self):
+        if self.start is None or not self.present.any():
+            return None
+        return date.fromordinal(self.start + int(np.flatnonzero(self.present)[-1]))
+
+
+def convert_to_date(day):
+    if type(day) == datetime:
+        return day.date()
+    else:
+        return day
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+The real-time mode keeps the changesets of a run in memory and applies the
+events of gerrit stream-events to them. Every flush interval the changesets
+that were touched by an event are evaluated again and the datasets of the
+repos they belong to are rewritten, so the datasets are minutes old instead
+of a day old without querying the database again.
+'''
+
+import json
+import time
+import logging
+
+from datetime import datetime
+
+from changeset import Changeset, Patchset, Review
+from utils import intern_string
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+# The review categories as they are named in the events of different Gerrit
+# versions and in the reviewdb.
+categories = {
+    'CRVW': 'CRVW',
+    'Code-Review': 'CRVW',
+    'VRIF': 'VRIF',
+    'Verified': 'VRIF',
+}
+
+
+def to_datetime(timestamp):
+    return datetime.utcfromtimestamp(int(timestamp))
+
+
+def to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class EventProcessor(object):
+    '''
+    Applies the events of gerrit stream-events to @changesets.
+
+    @param update: function that evaluates the changesets that were touched
+    by events and rewrites the affected datasets, see stats.update_datasets.
+    @type update: function
+
+    @param dirty: the change_ids of the changesets that were touched since
+    the last flush.
+    @type dirty: set
+
+    @param counts: a dictionary where the key is the type of an event and the
+    value the number of events of that type that were applied.
+    @type counts: dict
+    '''
+    def __init__(self, gerrit, changesets, accounts, state, update, now=time.time):
+        self.gerrit = gerrit
+        self.changesets = changesets
+        self.accounts = accounts
+        self.state = state
+        self.update = update
+        self.now = now
+        self.dirty = set()
+        self.counts = {}
+        self.skipped = 0
+        self.handlers = {
+            'patchset-created': self.patchset_created,
+            'comment-added': self.comment_added,
+            'change-merged': self.change_merged,
+            'change-abandoned': self.change_abandoned,
+            'change-restored': self.change_restored,
+        }
+
+    def __str__(self):
+        return ', '.join(['%s %s' % (count, kind) for kind, count in sorted(self.counts.iteritems())]) or 'no events'
+
+    def apply(self, line):
+        '''
+        Apply a single event, @line is a JSON object. Returns True if the
+        event changed a changeset.
+        '''
+        try:
+            event = json.loads(line)
+        except ValueError, e:
+            logging.warning('Could not parse event %r. Error: %s' % (line, e))
+            return False
+        handler = self.handlers.get(event.get('type'))
+        if handler is None:
+            return False
+        try:
+            changeset = handler(event)
+        except (KeyError, TypeError, ValueError), e:
+            logging.warning('Could not apply %s event %r. Error: %s' % (event.get('type'), line, e))
+            return False
+        if changeset is None:
+            self.skipped += 1
+            return False
+        self.dirty.add(changeset.change_id)
+        self.counts[event['type']] = self.counts.get(event['type'], 0) + 1
+        return True
+
+    def determine_time(self, event, timestamp=None):
+        '''
+        Older Gerrit versions do not add the time to every event, in that
+        case the event happened when it arrived.
+        '''
+        if timestamp is None:
+            timestamp = event.get('eventCreatedOn')
+        if timestamp is None:
+            timestamp = self.now()
+        return to_datetime(timestamp)
+
+    def get_account(self, person):
+        person = person or {}
+        return self.accounts.find(to_str(person.get('name')), to_str(person.get('email')))
+
+    def get_changeset(self, event):
+        return self.changesets.get(int(event['change']['number']))
+
+    def touch(self, changeset, when):
+        if changeset.last_updated_on is None or when > changeset.last_updated_on:
+            changeset.last_updated_on = when
+
+    def patchset_created(self, event):
+        change = event['change']
+        patch_set = event['patchSet']
+        created_on = self.determine_time(event, patch_set.get('createdOn'))
+        patch_set_id = int(patch_set['number'])
+        changeset = self.get_changeset(event)
+        if changeset is None:
+            owner = self.get_account(change.get('owner'))
+            changeset = Changeset(owner, self.gerrit.clock, created_on=created_on,
+                                  owner_account_id=owner.account_id,
+                                  dest_project_name=to_str(change.get('project')),
+                                  dest_branch_name=to_str(change.get('branch')),
+                                  change_id=int(change['number']),
+                                  last_updated_on=created_on,
+                                  change_key=to_str(change.get('id')),
+                                  subject=to_str(change.get('subject')),
+                                  nbr_patch_sets=patch_set_id,
+                                  status='n', open='Y')
+            self.changesets[changeset.change_id] = changeset
+        uploader = self.get_account(patch_set.get('uploader') or event.get('uploader'))
+        changeset.patch_sets[patch_set_id] = Patchset(revision=to_str(patch_set.get('revision')),
+                                                      uploader_account_id=uploader.account_id,
+                                                      created_on=created_on,
+                                                      change_id=changeset.change_id,
+                                                      patch_set_id=patch_set_id,
+                                                      draft='Y' if patch_set.get('isDraft') else 'N')
+        changeset.nbr_patch_sets = max(changeset.nbr_patch_sets, patch_set_id)
+        self.touch(changeset, created_on)
+        return changeset
+
+    def comment_added(self, event):
+        changeset = self.get_changeset(event)
+        if changeset is None:
+            return None
+        granted = self.determine_time(event)
+        reviewer = self.get_account(event.get('author'))
+        patch_set_id = int(event['patchSet']['number'])
+        patch_set = changeset.patch_sets.get(patch_set_id)
+        # bot reviews are dropped, just like in stats.create_reviews
+        if patch_set is not None and reviewer.human is True:
+            for approval in event.get('approvals') or []:
+                category_id = categories.get(approval.get('type'))
+                # newer Gerrit versions list every vote of the author, the
+                # unchanged votes have the same oldValue and value
+                if category_id is None or str(approval.get('oldValue')) == str(approval['value']):
+                    continue
+                review = Review(reviewer, change_id=changeset.change_id,
+                                granted=self.determine_time(event, approval.get('grantedOn')),
+                                value=int(approval['value']),
+                                account_id=reviewer.account_id,
+                                patch_set_id=patch_set_id,
+                                category_id=intern_string(category_id))
+                patch_set.reviews.add(review)
+        self.touch(changeset, granted)
+        return changeset
+
+    def change_status(self, event, status):
+        changeset = self.get_changeset(event)
+        if changeset is None:
+            return None
+        changeset.status = status
+        changeset.open = status in ('n', 'd')
+        changeset.merged = status == 'M'
+        self.touch(changeset, self.determine_time(event))
+        return changeset
+
+    def change_merged(self, event):
+        return self.change_status(event, 'M')
+
+    def change_abandoned(self, event):
+        return self.change_status(event, 'A')
+
+    def change_restored(self, event):
+        return self.change_status(event, 'n')
+
+    def flush(self):
+        '''
+        Evaluate the changesets that were touched since the previous flush and
+        rewrite the datasets of their repos. When a new day has started, the
+        open changesets are counted up to the new yesterday and all datasets
+        are rewritten.
+        '''
+        changesets = dict((change_id, self.changesets[change_id]) for change_id in self.dirty)
+        if self.gerrit.clock.advance():
+            yesterday = self.gerrit.clock.yesterday
+            logging.info('A new day has started, counting open changesets up to %s.' % yesterday)
+            for changeset in self.changesets.itervalues():
+                if changeset.open:
+                    changeset.yesterday = yesterday
+                    changesets[changeset.change_id] = changeset
+            for repo in self.gerrit.repos.itervalues():
+                repo.yesterday = yesterday
+            self.state.affected.update(self.gerrit.repos.keys())
+        if not changesets and not self.state.affected:
+            return 0
+        rewritten = self.update(self.gerrit, changesets, self.state)
+        logging.info('Applied %s (%s events skipped), rewrote the datasets of %s repos.' % (self, self.skipped, rewritten))
+        self.dirty.clear()
+        self.counts.clear()
+        self.skipped = 0
+        return rewritten
+
+    def run(self, stream, flush_interval, duration=None, reconnect=True):
+        '''
+        Read events from @stream and flush every @flush_interval seconds,
+        for @duration seconds or forever. If the stream is closed, it is
+        opened again unless @reconnect is False, the events in between are
+        missed until the next batch run.
+        '''
+        next_flush = self.now() + flush_interval
+        stop = self.now() + duration if duration else None
+        delay = 1
+        while stop is None or self.now() < stop:
+            try:
+                lines = stream.read(max(0.1, min(next_flush - self.now(), 1.0)))
+                delay = 1
+            except EOFError, e:
+                if not reconnect:
+                    break
+                logging.warning('%s, subscribing again in %s seconds.' % (e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+                try:
+                    stream.open()
+                except Exception, e:
+                    logging.warning('Could not subscribe to %s. Error: %s' % (stream, e))
+                continue
+            for line in lines:
+                self.apply(line)
+            if self.now() >= next_flush:
+                self.flush()
+                next_flush = self.now() + flush_interval
+        self.flush()
@@ -22,18 +22,14 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import os
 import logging
 
-from datetime import date, datetime, timedelta
-from cStringIO import StringIO
-from itertools import product
-
-try:
-    from collections import OrderedDict
-except:
-    from ordereddict import OrderedDict
+from datetime import date, timedelta
 
 from yamlconfig import YamlConfig
+from observations import ObservationStore, convert_to_date
 from extensions import extensions
-from utils import determine_yesterday
+from metrics import registry
+from writer import DatafileTail
+from serializer import iterate_rows
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -55,18 +51,19 @@ class Repo(object):
     information on how to connect to the Gerrit server
     @type name: Gerrit class
 
-    @param observations: an instance of OrderedDict where the key is an instance
-    of datetime.date and the value is an instance of the Observation class
-    @type observations: OrderedDict
+    @param store: an instance of ObservationStore that contains the daily
+    counters of this repo.
+    @type store: ObservationStore
 
-    @param headings: an instance of OrderedDict that contains the headings that
-    will be used in the Yaml configuration file.
-    @type headings: OrderedDict
+    @param observations: a dictionary-like view on @store where the key is an
+    instance of datetime.date and the value is an instance of the Observation
+    class
+    @type observations: Observations
 
-    @param file_contents: an instance of StringIO that contains the actual
-    contents of a datafile. This datafile is sorted by date and contains for
-    each date the observations for the defined metrics.
-    @type file_contents: StringIO
+    @param deltas: a dictionary where the key is an instance of datetime.date
+    and the value a dictionary with the change of each metric on that date.
+    Only used by the sweep engine, see accumulate_deltas.
+    @type deltas: dict
 
     @param first_commit: an instance of datetime.date on when the first commit
     was made in this project. The default value is set to the installation date
@@ -76,14 +73,10 @@ class Repo(object):
     aggregation of one or more Gerrit projects.
     @type is_parent: boolean
 
-    @param metrics: a list of the metrics that will be calculated for this
-    Gerrit project
-    @type metrics: list
-
-    @param suffixes: a list of the different variants that will be calculated
-    for each metric. Total number of metrics in a dataset is N x M where N is
-    number of elements in @metrics and M is number of elements in @suffixes.
-    @type suffixes: list
+    @param schema: the compiled metrics that will be calculated for this
+    Gerrit project, it determines the columns of the datafile. See metrics.py
+    for how to add a metric.
+    @type schema: Schema
 
     @param filename: the canonical filename of the datafile and datasource for
     this Gerrit project.
@@ -100,14 +93,13 @@ class Repo(object):
         self.description = description
         self.name = name
         self.gerrit = gerrit
-        self.observations = OrderedDict()
-        self.headings = OrderedDict(date='date')
-        self.file_contents = StringIO()
+        self.deltas = {}
         self.first_commit = gerrit.creation_date
         self.is_parent = is_parent
 
-        self.metrics = ['waiting_first_review', 'waiting_plus2']
-        self.suffixes = ['total', 'staff', 'volunteer']
+        self.schema = registry.compile()
+        self.store = ObservationStore(self.determine_columns())
+        self.observations = Observations(self)
 
         self.filename = ('%s.csv' % (self.determine_filename()))
         self.csv_directory = self.determine_directory(gerrit.csv_location)
@@ -115,8 +107,7 @@ class Repo(object):
         self.full_csv_path = os.path.join(self.csv_directory, self.filename)
         self.full_yaml_path = os.path.join(self.yaml_directory, self.filename)
 
-        self.create_path()
-        self.yesterday = determine_yesterday()
+        self.yesterday = gerrit.clock.yesterday
 
         self.wmf_extension = self.is_wikimedia_extension()
         self.extension = self.is_extension()
@@ -125,44 +116,31 @@ class Repo(object):
     def __str__(self):
         return self.name
 
-    def create_dataset(self):
-        headings = self.generate_headings()
-        self.file_contents.write(headings)
-        self.file_contents.write('\n')
-
-        dates = self.observations.keys()
-        dates.sort()
-        today = datetime.today()
-        last_date = dates[-1]
-        if last_date.year == today.year and last_date.month == today.month and last_date.day == today.day:
-            dates.pop(dates.index(last_date))
-
-        for date in dates:
-            observation = self.observations.get(date)
-            values = observation.get_values()
-            values.insert(0, date.strftime('%Y/%m/%d'))
-            values = ','.join(['%s' % value for value in values])
-            self.file_contents.write(values)
-            self.file_contents.write('\n')
-
-    def create_headings(self):
-        self.metrics.sort()
-        self.suffixes.sort()
-        iterator = product(self.metrics, self.suffixes)
-        for it in iterator:
-            yield self.merge_keys(it[0], it[1])
-
-    def create_path(self):
-        folders = [self.yaml_directory, self.csv_directory]
-        for folder in folders:
-            if folder != '':
-                try:
-                    os.makedirs(folder)
-                    logging.info('Created %s' % folder)
-                except OSError:
-                    pass
+    def create_dataset(self, since=None):
+        '''
+        Generate the contents of the datafile, a block of rows at a time. When
+        @since is set, only the observations after @since are added and the
+        headings are omitted so the result can be appended to an existing
+        datafile.
+        '''
+        if since is None:
+            yield self.generate_headings() + '\n'
 
-    def daterange(self, start_date, end_date, merged=True):
+        for rows in iterate_rows(self.store.iterblocks(since, self.yesterday.date())):
+            yield rows
+
+    def determine_directories(self):
+        '''
+        The directories this repo writes to, they are created by the
+        DatasetWriter right before the datasets are written.
+        '''
+        return [folder for folder in [self.yaml_directory, self.csv_directory] if folder != '']
+
+    def count_days(self, start_date, end_date, merged=True):
+        '''
+        Return the number of calendar days, starting at @start_date, that a
+        changeset should be counted for a metric.
+        '''
         if end_date.year == start_date.year and end_date.month == start_date.month and end_date.day == start_date.day:
             if merged:
                 dt = 0
@@ -178,9 +156,19 @@ class Repo(object):
         '''
         if dt < 0:
             dt = 0
-        for n in range(dt):
+        return dt
+
+    def daterange(self, start_date, end_date, merged=True):
+        for n in range(self.count_days(start_date, end_date, merged)):
             yield start_date + timedelta(n)
 
+    def determine_columns(self):
+        '''
+        The columns of the datafile (except for the date) in the order in which
+        they are written.
+        '''
+        return self.schema.columns
+
     def determine_directory(self, location):
         return os.path.join(location, self.name)
 
@@ -191,9 +179,8 @@ class Repo(object):
         '''
         determine if this repo is part of another Gerrit repo. First, we do
         some hard-coded checks, is the Gerrit repo a (Wikimedia) extension or
-        not then we iterate over all the Gerrit projects and chech whether the
-        name of the current Gerrit project starts with one the known parent
-        Gerrit projects.
+        not then we look up which of the known parent Gerrit projects the name
+        of the current Gerrit project starts with, see Router.
         '''
         parents = []
         if self.extension is True:
@@ -205,12 +192,10 @@ class Repo(object):
             parents.append('mediawiki/core_wmf_extensions')
 
         if self.is_parent is False:
-            for repo in self.gerrit.parents:
-                if self.name != repo['name']:
-                    if self.name.startswith(repo['name']):
-                        parents.append(repo['name'])
-                else:
-                    self.is_parent = True
+            route = gerrit.router.route(self.name)
+            parents.extend(route.ancestors)
+            if route.is_parent:
+                self.is_parent = True
         return parents
 
     def determine_first_commit_date(self):
@@ -220,16 +205,9 @@ class Repo(object):
         for metrics with value zero as we are only interested metrics from the
         day the project was actually started.
         '''
-        tomorrow = date.today() + timedelta(days=1)
-        dates = self.observations.keys()
-        dates.sort()
-        for dt in dates:
-            touched = self.observations[dt].touched
-            if not touched:
-                if dt < tomorrow:
-                    self.first_commit = dt
-            else:
-                break
+        first_commit = self.store.determine_first_commit(self.gerrit.clock.tomorrow)
+        if first_commit:
+            self.first_commit = first_commit
 
     def fill_in_missing_days(self):
         '''
@@ -237,61 +215,123 @@ class Repo(object):
         having missing values that can lead to gaps in line charts, these dates
         are added and all metrics are set to zero.
         '''
-        for date in self.daterange(self.first_commit, self.yesterday.date()):
-            obs = self.observations.get(date, Observation(date, self, False))
-            self.observations[date] = obs
+        days = self.count_days(self.first_commit, self.yesterday.date())
+        self.store.fill(self.first_commit, days)
 
     def generate_headings(self):
-        headings = ['date', 'commits', 'self_review']
-        for heading in self.create_headings():
-            headings.append(heading)
-        return ','.join(headings)
+        return self.schema.header
 
-    def get_review_start_date(self, commit, metric):
-        start_date = getattr(commit, 'created_on') if metric == 'waiting_first_review' else getattr(commit, 'waiting_first_review')
-        try:
-            return getattr(start_date, 'granted')
-        except AttributeError:
-            return start_date
+    def determine_events(self, changeset):
+        '''
+        Determine the columns of the event metrics that count @changeset.
+        Returns a list of (day, columns) tuples, one for every day on which an
+        event metric counts the changeset.
+        '''
+        events = {}
+        for metric in self.schema.events:
+            if metric.is_counted(changeset):
+                day = metric.get_start_date(changeset).date()
+                events.setdefault(day, []).extend(metric.determine_columns(changeset))
+        return sorted(events.iteritems())
 
-    def get_review_end_date(self, commit, metric):
-        try:
-            return getattr(commit, metric).granted
-        except AttributeError:
-            return getattr(commit, metric)
-
-    def increment_number_of_changesets(self, commit):
-        obs = self.observations.get(commit.created_on.date(
-        ), Observation(commit.created_on, self))
-        obs.changesets += 1
-        if commit.self_review is True:
-            obs.self_review += 1
-        self.observations[obs.date] = obs
+    def increment_number_of_changesets(self, changeset):
+        for day, columns in self.determine_events(changeset):
+            self.store.add(day, 1, columns)
 
     def increment(self, changeset):
+        '''
+        Count @changeset for this repo. When the sweep engine is used, the
+        intervals that were recorded for this changeset are returned, see
+        determine_intervals.
+        '''
+        if self.gerrit.engine == 'sweep':
+            intervals = self.determine_intervals(changeset)
+            self.apply_intervals(intervals)
+            return intervals
+
         self.increment_number_of_changesets(changeset)
-        if changeset.status == 'A' or changeset.status == 'd':
+        for metric in self.schema.intervals:
+            if metric.is_counted(changeset):
+                start_date = metric.get_start_date(changeset)
+                end_date = metric.get_end_date(changeset)
+                self.increment_daterange(changeset, metric, start_date, end_date)
+
+    def increment_daterange(self, changeset, metric, start_date, end_date):
+        '''
+        Increment the counters of @metric (a compiled interval metric) for
+        every single day between @start_date and @end_date.
+        '''
+        days = self.count_days(start_date, end_date, changeset.merged)
+        if days == 0:
             return
-        for metric in self.metrics:
-            start_date = self.get_review_start_date(changeset, metric)
-            end_date = self.get_review_end_date(changeset, metric)
-
-            for date in self.daterange(start_date, end_date, changeset.merged):
-                obs = self.observations.get(date.date(
-                ), Observation(date.date(), self))
-                if metric == 'waiting_first_review':
-                    obs.changeset_ids.add(changeset.change_id)
-                for heading in product([metric], self.suffixes):
-                    heading = self.merge_keys(heading[0], heading[1])
-                    value = getattr(obs, heading)
-                    if heading.endswith('staff') and changeset.author.staff is True:
-                        value += 1
-                    elif heading.endswith('volunteer') and changeset.author.staff is False:
-                        value += 1
-                    elif heading.endswith('total'):
-                        value += 1
-                    setattr(obs, heading, value)
-                self.observations[obs.date] = obs
+        self.store.add(start_date.date(), days, metric.determine_columns(changeset))
+        if metric.name == 'waiting_first_review':
+            first_day = start_date.date().toordinal()
+            for ordinal in xrange(first_day, first_day + days):
+                self.store.changeset_ids.setdefault(ordinal, set()).add(changeset.change_id)
+
+    def determine_intervals(self, changeset):
+        '''
+        Determine the days that @changeset should be counted for each heading.
+        Returns a list of (first_day, last_day, headings) tuples, where
+        last_day is the first day that the changeset is no longer counted. The
+        event metrics are counted as an interval of a single day.
+        '''
+        intervals = [(day, day + timedelta(days=1), tuple(columns)) for day, columns
+                     in self.determine_events(changeset)]
+        for metric in self.schema.intervals:
+            if not metric.is_counted(changeset):
+                continue
+            start_date = metric.get_start_date(changeset)
+            end_date = metric.get_end_date(changeset)
+            days = self.count_days(start_date, end_date, changeset.merged)
+            if days == 0:
+                continue
+            first_day = start_date.date()
+            intervals.append((first_day, first_day + timedelta(days), metric.determine_columns(changeset)))
+        return intervals
+
+    def apply_intervals(self, intervals, sign=1):
+        '''
+        Only record a +1 on the first day and a -1 on the last day of each
+        interval. The daily counters are constructed afterwards by
+        accumulate_deltas. Use sign=-1 to back out intervals that were applied
+        before. This engine does not keep track of the changeset_ids of an
+        observation.
+        '''
+        for first_day, last_day, headings in intervals:
+            for heading in headings:
+                self.add_delta(first_day, heading, sign)
+                self.add_delta(last_day, heading, -sign)
+
+    def add_delta(self, day, heading, value):
+        deltas = self.deltas.setdefault(day, {})
+        value += deltas.get(heading, 0)
+        if value:
+            deltas[heading] = value
+        else:
+            deltas.pop(heading, None)
+            if deltas == {}:
+                del self.deltas[day]
+
+    def accumulate_deltas(self):
+        '''
+        Construct the daily observations from the deltas that were recorded by
+        the sweep engine using a single running sum over the recorded dates.
+        Days on which nothing was counted do not get an observation, just like
+        with the daterange engine.
+        '''
+        self.store.accumulate(self.deltas)
+
+    def reset_store(self):
+        '''
+        Start over with empty observations, the deltas are kept. Used by the
+        real-time mode to construct the observations again after the deltas
+        have been updated.
+        '''
+        self.first_commit = self.gerrit.creation_date
+        self.store = ObservationStore(self.determine_columns())
+        self.observations = Observations(self)
 
     def is_wikimedia_extension(self):
         '''
@@ -313,9 +353,6 @@ class Repo(object):
         else:
             return False
 
-    def merge_keys(self, key1, key2):
-        return '%s_%s' % (key1, key2)
-
     def prune_observations(self):
         '''
         Remove observations between the installation date of Gerrit and the
@@ -323,28 +360,213 @@ class Repo(object):
         discard this.
         '''
         self.determine_first_commit_date()
-        for date in self.observations.keys():
-            if date < self.first_commit:
-                del self.observations[date]
+        self.store.prune(self.first_commit)
 
-    def write_dataset(self, gerrit):
+    def determine_window(self, rewrite_days):
+        '''
+        Determine which part of the existing datafile has to be rewritten in
+        append mode: the rows of the last @rewrite_days days of the datafile
+        and the rows of the days that were added since. Only the header, the
+        first row and the tail of the datafile are read. Returns a (since,
+        offset, tail) tuple, see DatafileTail.read_rows, or None if the
+        datafile does not exist or does not match the observations and has to
+        be rewritten completely.
+        '''
+        if not os.path.exists(self.full_csv_path):
+            return None
+        datafile = DatafileTail(self.full_csv_path)
+        try:
+            if datafile.header != self.schema.header:
+                logging.info('The columns of %s have changed, rewriting it.' % datafile)
+                return None
+            if not datafile.is_complete() or datafile.first_date() != self.store.first_date():
+                logging.info('%s does not start on %s, rewriting it.' % (datafile, self.store.first_date()))
+                return None
+            last_day = datafile.last_date()
+            if last_day is None:
+                return None
+            since = last_day - timedelta(days=rewrite_days)
+            offset, tail = datafile.read_rows(since)
+            return since, offset, tail
+        finally:
+            datafile.close()
+
+    def write_dataset(self, gerrit, since=None):
         '''
-        if dataset is empty then there is no need to write it
+        if dataset is empty then there is no need to write it. When @since is
+        set, the observations after @since are appended to the existing
+        datafile. In append mode, only the trailing window of the existing
+        datafile is rewritten, see determine_window. Returns a list of (path,
+        changed) tuples of the files that belong to this repo, see
+        DatasetWriter.
         '''
-        if not self.observations == {}:
-            self.create_dataset()
+        paths = []
+        if len(self.store) > 0:
+            window = None
+            if since is None and gerrit.append:
+                window = self.determine_window(gerrit.rewrite_days)
+            if window:
+                since = window[0]
             yaml = YamlConfig(gerrit, self)
-            yaml.write_file()
+            paths.append(yaml.write_file())
 
-            fh = open(self.full_csv_path, 'w')
-            fh.write(self.file_contents.getvalue())
+            if window:
+                changed = gerrit.writer.replace_tail(self.full_csv_path, window[1], window[2], ''.join(self.create_dataset(since)))
+            elif since is None:
+                changed = gerrit.writer.write(self.full_csv_path, self.create_dataset())
+            else:
+                changed = gerrit.writer.append(self.full_csv_path, ''.join(self.create_dataset(since)))
+            paths.append((self.full_csv_path, changed))
+        return paths
+
+    def determine_backfill_start(self, window):
+        '''
+        A datafile starts the day before the first day on which something was
+        counted. The start of the existing datafile is kept, unless the
+        changesets that were loaded show that the repo started earlier.
+        Returns the first day of the datafile, or None if there is nothing to
+        write for @window.
+        '''
+        starts = []
+        if os.path.exists(self.full_csv_path):
+            datafile = DatafileTail(self.full_csv_path)
+            try:
+                if datafile.header != self.schema.header:
+                    logging.warning('The columns of %s have changed, it can only be rewritten by a run without a window.' % datafile)
+                    return None
+                if datafile.first_date():
+                    starts.append(datafile.first_date())
+            finally:
+                datafile.close()
+        first_date = self.store.first_date()
+        if first_date:
+            starts.append(max(first_date - timedelta(days=1), self.gerrit.creation_date))
+        if not starts:
+            # like prune_observations, a repo without observations only gets
+            # a row for yesterday
+            starts.append(self.yesterday.date())
+        if min(starts) > window.last:
+            return None
+        return min(starts)
+
+    def merge_dataset(self, rows, window):
+        '''
+        Generate the contents of the datafile where the rows of the days in
+        @window are replaced by @rows, the other rows of the existing datafile
+        are kept as they are.
+        '''
+        yield self.generate_headings() + '\n'
+        first = window.first.strftime(DatafileTail.date_format)
+        last = window.last.strftime(DatafileTail.date_format)
+        fh = None
+        line = ''
+        if os.path.exists(self.full_csv_path):
+            fh = open(self.full_csv_path, 'rb')
+            fh.readline()
+            for line in fh:
+                if line[:10] >= first:
+                    break
+                yield line
+            else:
+                line = ''
+        for block in rows:
+            yield block
+        if fh:
+            if line[:10] > last:
+                yield line
+            for line in fh:
+                if line[:10] > last:
+                    yield line
             fh.close()
 
+    def backfill_dataset(self, gerrit, window):
+        '''
+        Fill in the days of @window and merge them into the existing datafile,
+        only the changesets that overlap @window have been counted so the
+        observations outside of it are incomplete and are not written.
+        Returns a list of (path, changed) tuples, see write_dataset.
+        '''
+        first_commit = self.determine_backfill_start(window)
+        if first_commit is None:
+            return []
+        self.first_commit = first_commit
+        start = max(first_commit, window.first)
+        self.store.fill(start, (window.last - start).days + 1)
+        yaml = YamlConfig(gerrit, self)
+        rows = iterate_rows(self.store.iterblocks(start - timedelta(days=1), window.last))
+        changed = gerrit.writer.write(self.full_csv_path, self.merge_dataset(rows, window))
+        return [yaml.write_file(), (self.full_csv_path, changed)]
+
+
+class Observations(object):
+    '''
+    Observations is a dictionary-like view on the ObservationStore of a repo,
+    the key is an instance of datetime.date and the value an instance of
+    Observation. It is kept for compatibility, the counting itself is done
+    directly on the ObservationStore.
+    '''
+    def __init__(self, repo):
+        self.repo = repo
+        self.store = repo.store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, date):
+        return self.store.contains(convert_to_date(date))
+
+    def __getitem__(self, date):
+        if date not in self:
+            raise KeyError(date)
+        return Observation(date, self.repo)
+
+    def __setitem__(self, date, obs):
+        date = convert_to_date(date)
+        if obs.store is self.store and obs.date == date:
+            return
+        self.store.create(date, obs.touched)
+        for prop, value in obs.iteritems():
+            self.store.set(date, prop, value)
+
+    def __delitem__(self, date):
+        if date not in self:
+            raise KeyError(date)
+        self.store.remove(convert_to_date(date))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, date, default=None):
+        if date in self:
+            return Observation(date, self.repo)
+        return default
+
+    def keys(self):
+        return self.store.dates()
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        for date in self.keys():
+            yield Observation(date, self.repo)
+
+    def iteritems(self):
+        for date in self.keys():
+            yield date, Observation(date, self.repo)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
 
 class Observation(object):
     '''
-    Observation keeps track for a specific date the counters for the different
-    defined metrics.
+    Observation is a view on the counters of the different defined metrics for
+    a specific date in the ObservationStore of a repo. Creating an Observation
+    for a date that does not have an observation yet adds it to the store.
 
     @param touched: helper param to determine whether this instance has been
     automatically added or has actually been the result of real observations.
@@ -365,37 +587,44 @@ class Observation(object):
     changesets where observed on this date
     @type changeset_ids: set
     '''
+    ignore = ['touched', 'date', 'ignore', 'changeset_ids']
+
     def __init__(self, date, repo, touched=True):
-        self.touched = touched
-        self.date = self.convert_to_date(date)
-        self.changesets = 0
-        self.self_review = 0
-        self.changeset_ids = set()
-        self.ignore = ['touched', 'date', 'ignore', 'changeset_ids']
-        for heading in repo.create_headings():
-            setattr(self, heading, 0)
+        object.__setattr__(self, 'store', repo.store)
+        object.__setattr__(self, 'date', self.convert_to_date(date))
+        self.store.create(self.date, touched)
 
     def __str__(self):
         return '%s:%s' % (self.date, self.changesets)
 
+    def __getattr__(self, prop):
+        store = self.__dict__['store']
+        if prop in store.index:
+            return store.get(self.date, prop)
+        elif prop == 'touched':
+            return bool(store.touched[store.row(self.date)])
+        elif prop == 'changeset_ids':
+            return store.changeset_ids.setdefault(self.date.toordinal(), set())
+        raise AttributeError(prop)
+
+    def __setattr__(self, prop, value):
+        if prop in self.store.index:
+            self.store.set(self.date, prop, value)
+        elif prop == 'touched':
+            self.store.touched[self.store.row(self.date)] = value
+        else:
+            object.__setattr__(self, prop, value)
+
     def __iter__(self):
         '''
         Customer iterator to loop over all the relevant parameters for a
-        dataset. Ignore fields that are defined in self.ignore or that are
-        private.
+        dataset, these are the columns of the store.
         '''
-        props = self.__dict__
-        props = props.keys()
-        props.sort()
-        for prop in props:
-            if not prop.startswith('__') and prop not in self.ignore:
-                yield prop
+        for prop in self.store.columns:
+            yield prop
 
     def convert_to_date(self, date):
-        if type(date) == datetime:
-            return date.date()
-        else:
-            return date
+        return convert_to_date(date)
 
     def iteritems(self):
         for prop in self:
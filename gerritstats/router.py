@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+
+class Node(object):
+    __slots__ = ('children', 'ignore', 'parent', 'repo')
+
+    def __init__(self):
+        self.children = {}
+        self.ignore = None
+        self.parent = None
+        self.repo = None
+
+
+class Route(object):
+    '''
+    The result of routing the name of a Gerrit project.
+
+    @param repo: the Repo instance with this name or None if it does not exist.
+    @type repo: Repo
+
+    @param ancestors: the names of the parent repos whose name is a prefix of
+    this name, shortest first.
+    @type ancestors: tuple
+
+    @param ignored: the ignore_repos entry that matches this name or None if
+    the project is not ignored.
+    @type ignored: str
+
+    @param is_parent: whether this name is itself one of the parent repos.
+    @type is_parent: boolean
+    '''
+    __slots__ = ('name', 'repo', 'ancestors', 'ignored', 'is_parent')
+
+    def __init__(self, name, repo, ancestors, ignored, is_parent):
+        self.name = name
+        self.repo = repo
+        self.ancestors = ancestors
+        self.ignored = ignored
+        self.is_parent = is_parent
+
+    def __str__(self):
+        return self.name
+
+
+class Router(object):
+    '''
+    A prefix trie, compiled once from the ignore_repos and parents settings,
+    that routes the name of a Gerrit project to its Repo, its parent repos and
+    whether it is ignored. Matching is a plain string prefix match, just like
+    str.startswith, so a lookup takes time proportional to the length of the
+    name no matter how many ignore_repos and parents are configured. Routes
+    are cached as the same handful of names is routed for every changeset.
+    '''
+    def __init__(self, ignore_repos=None, parents=None):
+        self.root = Node()
+        self.routes = {}
+        for ignore_repo in ignore_repos or []:
+            node = self.insert(ignore_repo)
+            if node.ignore is None:
+                node.ignore = ignore_repo
+        for parent in parents or []:
+            self.insert(parent['name']).parent = parent['name']
+
+    def insert(self, name):
+        node = self.root
+        for char in name:
+            node = node.children.setdefault(char, Node())
+        return node
+
+    def add(self, repo):
+        '''
+        Register @repo so that changesets of that project are routed to it.
+        '''
+        self.insert(repo.name).repo = repo
+        self.routes.pop(repo.name, None)
+
+    def route(self, name):
+        route = self.routes.get(name)
+        if route is None:
+            route = self.walk(name)
+            self.routes[name] = route
+        return route
+
+    def walk(self, name):
+        ancestors = []
+        ignored = self.root.ignore
+        node = self.root
+        for char in name:
+            if node.parent is not None:
+                ancestors.append(node.parent)
+            node = node.children.get(char)
+            if node is None:
+                return Route(name, None, tuple(ancestors), ignored, False)
+            if ignored is None:
+                ignored = node.ignore
+        return Route(name, node.repo, tuple(ancestors), ignored, node.parent is not None)
+
+    def is_ignored(self, name):
+        return self.route(name).ignored is not None
+
+
+class SkippedChangesets(object):
+    '''
+    Counts the changesets that could not be routed to a repo, either because
+    their repo is ignored or because it does not exist, so they can be
+    reported in a single summary instead of a log line per changeset.
+    '''
+    def __init__(self):
+        self.counts = {}
+
+    def __len__(self):
+        return sum(self.counts.itervalues())
+
+    def add(self, route):
+        self.counts[route] = self.counts.get(route, 0) + 1
+
+    def log_summary(self, limit=10):
+        if not self.counts:
+            return
+        ignored = sum([count for route, count in self.counts.iteritems() if route.ignored is not None])
+        routes = sorted(self.counts.iteritems(), key=lambda item: (-item[1], item[0].name))
+        details = ['%s (%s, %s)' % (route.name, count, 'ignored by %s' % route.ignored
+                   if route.ignored is not None else 'does not exist') for route, count in routes[:limit]]
+        if len(routes) > limit:
+            details.append('and %s more' % (len(routes) - limit))
+        logging.info('Skipped %s changesets of %s repos, %s because their repo is ignored and %s because their repo does not exist: %s'
+                     % (len(self), len(routes), ignored, len(self) - ignored, ', '.join(details)))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Serializes the observations of a repo to the rows of a datafile. The rows are
+generated a block at a time, so the memory that is needed does not depend on
+the number of days in the datafile.
+'''
+
+import operator
+
+from datetime import date
+
+# All repos write the same days, so every date is only formatted once.
+formatted_dates = {}
+
+
+def format_date(ordinal):
+    '''
+    Format the day with @ordinal as %Y/%m/%d, followed by the separator of
+    the first counter.
+    '''
+    formatted = formatted_dates.get(ordinal)
+    if formatted is None:
+        day = date.fromordinal(ordinal)
+        formatted = '%04d/%02d/%02d,' % (day.year, day.month, day.day)
+        formatted_dates[ordinal] = formatted
+    return formatted
+
+
+def format_block(ordinals, values):
+    '''
+    Format a block of rows, @values is an integer array with a row per
+    ordinal and the counters in the order of the columns of the datafile.
+    Instead of formatting every counter separately, the whole block is
+    converted to a string at once: str() of a list of lists of integers is
+    '[[1, 2], [3, 4]]', without the brackets and spaces and split on '],['
+    these are the rows of the datafile.
+    '''
+    if not ordinals:
+        return ''
+    dates = [formatted_dates.get(ordinal) or format_date(ordinal) for ordinal in ordinals]
+    rows = str(values.tolist())[2:-2].replace(' ', '').split('],[')
+    return '\n'.join(map(operator.add, dates, rows)) + '\n'
+
+
+def iterate_rows(blocks):
+    '''
+    Generate the rows of a datafile, a block at a time, from the (ordinals,
+    values) tuples of ObservationStore.iterblocks.
+    '''
+    for ordinals, values in blocks:
+        yield format_block(ordinals, values)
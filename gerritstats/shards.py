@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+A sharded run spreads the repos over several workers, possibly on different
+hosts. Worker i of N only loads the changesets of the repos whose name hashes
+to shard i and saves the observations of those repos as a partial in a shared
+directory. The merge step adds up the partials of all N workers, creates the
+parent repos and writes the datasets, just like a single run would.
+'''
+
+import os
+import re
+import zlib
+import socket
+import logging
+import cPickle
+
+from utils import unsuccessful_exit
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+partial_filename = 'gerrit-stats.shard-%s-of-%s'
+partial_pattern = re.compile(r'^gerrit-stats\.shard-(\d+)-of-(\d+)$')
+
+
+def determine_shard(name, count):
+    '''
+    Return the shard of the repo @name. This is MOD(CRC32(name), count) in
+    MySQL, so the database selects the changesets of a shard.
+    '''
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xffffffff) % count
+
+
+class Partition(object):
+    '''
+    The repos whose name hashes to @index (counting from 0) of @count, see
+    determine_shard.
+    '''
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    def __str__(self):
+        return '%s/%s' % (self.index + 1, self.count)
+
+    def split(self):
+        '''
+        Return the two partitions of twice as many partitions that together
+        contain the repos of this partition: a name that hashes to i of n
+        hashes to either i or i + n of 2n.
+        '''
+        return [Partition(self.index, self.count * 2),
+                Partition(self.index + self.count, self.count * 2)]
+
+
+class Shard(Partition):
+    '''
+    Worker @index (counting from 0) of the @count workers of a sharded run.
+
+    @param path: the absolute path of the partial of this worker in the
+    shared directory.
+    @type path: str
+    '''
+    def __init__(self, index, count, directory):
+        Partition.__init__(self, index, count)
+        self.directory = directory
+        self.path = os.path.join(directory, partial_filename % (index + 1, count))
+
+    def save(self, gerrit, fingerprint):
+        '''
+        Save the observations of the repos of this shard. A worker whose
+        repos have no changesets still saves an empty partial, so the merge
+        step knows that it has finished.
+        '''
+        stores = dict((name, repo.store) for name, repo in gerrit.repos.iteritems()
+                      if repo.store.start is not None)
+        partial = {
+            'fingerprint': fingerprint,
+            'shard': (self.index, self.count),
+            'yesterday': gerrit.clock.yesterday,
+            'stores': stores,
+        }
+        # the directory is shared, so the temporary name has to be unique
+        # across hosts
+        tmp_path = '%s.%s.%s.tmp' % (self.path, socket.gethostname(), os.getpid())
+        fh = open(tmp_path, 'wb')
+        cPickle.dump(partial, fh, cPickle.HIGHEST_PROTOCOL)
+        fh.close()
+        os.rename(tmp_path, self.path)
+        logging.info('Saved the observations of %s repos of shard %s to %s.' % (len(stores), self, self.path))
+        return len(stores)
+
+
+class Partials(object):
+    '''
+    The partials that the workers of a sharded run saved in @directory.
+
+    @param paths: a dictionary where the key is the index of a shard and the
+    value the path of its partial.
+    @type paths: dict
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.count = None
+        self.paths = {}
+
+    def __str__(self):
+        return self.directory
+
+    def find(self):
+        '''
+        Find the partials of all shards. Exits if a shard is missing or if the
+        directory contains partials of runs with different numbers of shards.
+        '''
+        runs = {}
+        for filename in sorted(os.listdir(self.directory)):
+            match = partial_pattern.match(filename)
+            if match:
+                index, count = int(match.group(1)) - 1, int(match.group(2))
+                runs.setdefault(count, {})[index] = os.path.join(self.directory, filename)
+        if not runs:
+            logging.error('%s does not contain any partials, run the workers with --shard first.' % self)
+            unsuccessful_exit()
+        if len(runs) > 1:
+            logging.error('%s contains the partials of runs with %s shards, remove the partials of the runs that are no longer used.'
+                          % (self, ' and '.join([str(count) for count in sorted(runs)])))
+            unsuccessful_exit()
+        self.count, self.paths = runs.popitem()
+        missing = [str(index + 1) for index in xrange(self.count) if index not in self.paths]
+        if missing:
+            logging.error('The partials of shards %s of %s are missing in %s.' % (', '.join(missing), self.count, self))
+            unsuccessful_exit()
+
+    def load(self, path):
+        try:
+            fh = open(path, 'rb')
+            partial = cPickle.load(fh)
+            fh.close()
+        except (IOError, cPickle.UnpicklingError, EOFError, AttributeError, ValueError), e:
+            logging.error('Could not read partial %s. Error: %s' % (path, e))
+            unsuccessful_exit()
+        return partial
+
+    def merge(self, gerrit, fingerprint):
+        '''
+        Add the observations of the partials to the repos of @gerrit, one
+        partial at a time. Every partial has to be counted with the same
+        settings and up to the same yesterday as this run. Returns the number
+        of repos that have observations.
+        '''
+        self.find()
+        merged = set()
+        unknown = set()
+        for index in sorted(self.paths):
+            partial = self.load(self.paths[index])
+            if partial['fingerprint'] != fingerprint:
+                logging.error('The partial %s was counted with different settings, run the workers again.' % self.paths[index])
+                unsuccessful_exit()
+            if partial['yesterday'] != gerrit.clock.yesterday:
+                logging.error('The partial %s was counted up to %s instead of %s, all workers and the merge step have to run on the same day.'
+                              % (self.paths[index], partial['yesterday'], gerrit.clock.yesterday))
+                unsuccessful_exit()
+            for name, store in partial['stores'].iteritems():
+                repo = gerrit.repos.get(name)
+                if repo is None:
+                    unknown.add(name)
+                    continue
+                repo.store.merge(store)
+                merged.add(name)
+        if unknown:
+            logging.warning('Skipped the observations of %s repos that no longer exist: %s' % (len(unknown), ', '.join(sorted(unknown))))
+        logging.info('Merged the partials of %s shards, %s repos have observations.' % (self.count, len(merged)))
+        return len(merged)
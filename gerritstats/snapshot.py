@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import os
+import json
+import time
+import logging
+import _mysql_exceptions
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from sql_queries import columns, accounts_query, changes_query, patch_sets_query, approvals_query
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+SNAPSHOT_VERSION = 2
+
+# The queries whose results are stored in a snapshot.
+tables = {
+    accounts_query: 'accounts',
+    changes_query: 'changes',
+    patch_sets_query: 'patch_sets',
+    approvals_query: 'patch_set_approvals',
+}
+
+epoch = datetime(1970, 1, 1)
+
+# Marks a missing (NULL) timestamp or string.
+missing = -1
+
+# The number of rows of a snapshot that are converted to Python objects at a
+# time.
+block_size = 10000
+
+
+def to_seconds(value):
+    if value is None:
+        return missing
+    delta = value - epoch
+    return delta.days * 86400 + delta.seconds
+
+
+def from_seconds(value):
+    if value == missing:
+        return None
+    return epoch + timedelta(seconds=value)
+
+
+def determine_kind(values):
+    '''
+    Determine how a column is stored: timestamps as int64 seconds since the
+    epoch, integers as int32 (or int64 when they do not fit) and strings as
+    int32 codes into a dictionary of the distinct strings.
+    '''
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, datetime):
+            return 'datetime', np.int64
+        elif isinstance(value, (int, long)):
+            if all([value is None or -2 ** 31 <= value < 2 ** 31 for value in values]):
+                return 'int', np.int32
+            return 'int', np.int64
+        else:
+            return 'string', np.int32
+    return 'string', np.int32
+
+
+class SnapshotWriter(object):
+    '''
+    Records the rows of the accounts, changes, patch_sets and
+    patch_set_approvals queries while they are loaded from the database and
+    saves them as a snapshot. A snapshot is a directory with one .npy file per
+    column, numeric columns are stored as typed arrays and string columns are
+    dictionary encoded, and a manifest.json that describes the columns and
+    also contains the list of Gerrit repositories.
+    '''
+    offline = False
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = dict((table, []) for table in tables.itervalues())
+        self.projects = []
+
+    def __str__(self):
+        return self.path
+
+    def cursor(self, cur):
+        return RecordingCursor(cur, self)
+
+    def record(self, table, rows):
+        if table is not None:
+            self.rows[table].extend(rows)
+
+    def save(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        manifest = {
+            'version': SNAPSHOT_VERSION,
+            'created_on': time.time(),
+            'projects': self.projects,
+            'tables': {},
+        }
+        for table, rows in self.rows.iteritems():
+            manifest['tables'][table] = {'rows': len(rows), 'columns': {}}
+            for column in columns[table]:
+                values = [row[column] for row in rows]
+                kind, dtype = determine_kind(values)
+                description = {'kind': kind, 'dtype': np.dtype(dtype).name}
+                if kind == 'datetime':
+                    values = [to_seconds(value) for value in values]
+                elif kind == 'string':
+                    dictionary = sorted(set([value for value in values if value is not None]))
+                    codes = dict((value, x) for x, value in enumerate(dictionary))
+                    codes[None] = missing
+                    values = [codes[value] for value in values]
+                    # the database returns bytes that need not be valid
+                    # UTF-8, latin-1 maps every byte to a code point so the
+                    # bytes survive the JSON manifest unchanged
+                    description['dictionary'] = [value.decode('latin-1') for value in dictionary]
+                np.save(self.column_path(table, column), np.array(values, dtype=dtype))
+                manifest['tables'][table]['columns'][column] = description
+
+        tmp_path = os.path.join(self.path, 'manifest.json.tmp')
+        fh = open(tmp_path, 'w')
+        json.dump(manifest, fh)
+        fh.close()
+        os.rename(tmp_path, os.path.join(self.path, 'manifest.json'))
+        logging.info('Saved snapshot to %s (%s)' % (self.path, ', '.join(['%s: %s rows' % (table, len(rows)) for table, rows in sorted(self.rows.iteritems())])))
+
+    def column_path(self, table, column):
+        return os.path.join(self.path, '%s.%s.npy' % (table, column))
+
+
+class RecordingCursor(object):
+    '''
+    Wraps a database cursor and hands the fetched rows to a SnapshotWriter.
+    '''
+    def __init__(self, cur, writer):
+        self.cur = cur
+        self.connection = getattr(cur, 'connection', None)
+        self.writer = writer
+        self.table = None
+
+    def execute(self, query, args=None):
+        self.table = tables.get(query)
+        return self.cur.execute(query, args)
+
+    def fetchall(self):
+        rows = self.cur.fetchall()
+        self.writer.record(self.table, rows)
+        return rows
+
+    def fetchmany(self, size=1):
+        rows = self.cur.fetchmany(size)
+        self.writer.record(self.table, rows)
+        return rows
+
+    def close(self):
+        self.cur.close()
+
+
+class Snapshot(object):
+    '''
+    A snapshot that was saved by SnapshotWriter. The columns are memory mapped
+    so only the pages that are actually read are loaded from disk, and they
+    are converted to Python objects one block of rows at a time.
+    '''
+    offline = True
+
+    def __init__(self, path):
+        self.path = path
+        fh = open(os.path.join(path, 'manifest.json'), 'r')
+        self.manifest = json.load(fh)
+        fh.close()
+        if self.manifest.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('Snapshot %s has version %s, expected version %s.' % (path, self.manifest.get('version'), SNAPSHOT_VERSION))
+        self.projects = [project.encode('utf-8') for project in self.manifest['projects']]
+        self.arrays = {}
+        self.dictionaries = {}
+
+    def __str__(self):
+        return self.path
+
+    def cursor(self, cur=None):
+        return SnapshotCursor(self)
+
+    def array(self, table, column):
+        key = (table, column)
+        if key not in self.arrays:
+            self.arrays[key] = np.load(os.path.join(self.path, '%s.%s.npy' % (table, column)), mmap_mode='r')
+        return self.arrays[key]
+
+    def dictionary(self, table, column):
+        key = (table, column)
+        if key not in self.dictionaries:
+            description = self.manifest['tables'][table]['columns'][column]
+            dictionary = [value.encode('latin-1') for value in description['dictionary']]
+            dictionary.append(None)
+            self.dictionaries[key] = dictionary
+        return self.dictionaries[key]
+
+    def columns(self, table):
+        return sorted(self.manifest['tables'][table]['columns'].keys())
+
+    def column(self, table, column, start=0, stop=None):
+        '''
+        Return the values of rows @start up to @stop of @column as a list of
+        Python objects, just like the database returns them.
+        '''
+        description = self.manifest['tables'][table]['columns'][column]
+        values = self.array(table, column)[start:stop]
+        if description['kind'] == 'datetime':
+            # timestamps repeat a lot (registered_on, granted), convert every
+            # distinct value only once
+            distinct, inverse = np.unique(values, return_inverse=True)
+            converted = [from_seconds(value) for value in distinct.tolist()]
+            return [converted[x] for x in inverse.tolist()]
+        elif description['kind'] == 'string':
+            dictionary = self.dictionary(table, column)
+            return [dictionary[code] for code in values.tolist()]
+        return values.tolist()
+
+    def rows(self, table, columns):
+        count = self.manifest['tables'][table]['rows']
+        for start in xrange(0, count, block_size):
+            values = [self.column(table, column, start, start + block_size) for column in columns]
+            for row in zip(*values):
+                yield dict(zip(columns, row))
+
+
+class SnapshotCursor(object):
+    '''
+    Answers the queries of the loaders in stats.py from a snapshot instead of
+    from the database.
+    '''
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.rows = iter([])
+
+    def execute(self, query, args=None):
+        if query.startswith('SHOW COLUMNS FROM '):
+            table = query.split()[-1]
+            self.rows = iter([{'Field': column} for column in self.snapshot.columns(table)])
+            return
+        table = tables.get(query)
+        if table is None:
+            raise _mysql_exceptions.ProgrammingError('Snapshot %s cannot answer query: %s' % (self.snapshot, query))
+        self.rows = self.snapshot.rows(table, self.snapshot.columns(table))
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def fetchmany(self, size=1):
+        rows = []
+        for row in self.rows:
+            rows.append(row)
+            if len(rows) == size:
+                break
+        return rows
+
+    def close(self):
+        self.rows = iter([])
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+An out-of-core run stays within --memory-budget regardless of the number of
+changesets in Gerrit. The changesets are loaded and evaluated one partition of
+the repos at a time (see Partition in shards.py), a partition whose changesets
+do not fit in the budget is split in two. The deltas of the evaluated
+changesets of a partition are spilled to disk as a run sorted by repo, day
+and column, after which the changesets are dropped. The datasets are then
+written a batch of repos at a time, the observations of a repo are the running
+sum of its deltas in all runs.
+'''
+
+import os
+import shutil
+import logging
+
+import numpy as np
+
+from observations import ObservationStore
+from instrumentation import determine_rss
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+# The changesets of a partition may use this fraction of the memory that is
+# left, the rest is needed to evaluate them.
+headroom = 0.75
+
+# The memory of a changeset with its patch sets and reviews, until the first
+# partition has been loaded and measured.
+default_changeset_size = 4096
+
+# Names with the same CRC32 always end up in the same partition, so partitions
+# are not split any further than this.
+max_partitions = 1 << 16
+
+record_dtype = np.dtype([('repo', np.int32), ('day', np.int32), ('column', np.int32), ('value', np.int32)])
+
+
+class MemoryBudget(object):
+    '''
+    The memory that a run may use.
+
+    @param limit: the budget in bytes.
+    @type limit: int
+
+    @param baseline: the resident set size before any changeset was loaded,
+    the accounts and repos stay in memory for the whole run.
+    @type baseline: int
+
+    @param changeset_size: the estimated number of bytes of a loaded
+    changeset.
+    @type changeset_size: int
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.baseline = determine_rss()
+        self.changeset_size = default_changeset_size
+        self.measured = False
+
+    def __str__(self):
+        return '%.0f MB' % (self.limit / 1048576.0)
+
+    def available(self):
+        return int((self.limit - self.baseline) * headroom)
+
+    def capacity(self):
+        '''
+        Return the number of changesets that can be loaded at the same time.
+        '''
+        return self.available() / self.changeset_size
+
+    def measure(self, changesets, growth):
+        '''
+        Update the estimated size of a changeset after loading @changesets
+        changesets grew the resident set size by @growth bytes. Later
+        partitions reuse the memory that earlier partitions freed, so only the
+        first measurement can lower the estimate.
+        '''
+        if changesets <= 0 or growth <= 0:
+            return
+        size = growth / changesets
+        if self.measured:
+            size = max(size, self.changeset_size)
+        self.changeset_size = size
+        self.measured = True
+
+    def determine_batch_size(self, days, columns):
+        '''
+        Return the number of repos with @days days of @columns counters whose
+        observations can be kept in memory at the same time. Writing a dataset
+        needs about one more copy of the counters.
+        '''
+        store = days * (columns * np.dtype(ObservationStore.dtype).itemsize + 2) * 2
+        return max(1, self.available() / max(store, 1))
+
+
+def combine(repos, days, columns, values):
+    '''
+    Return the deltas as records sorted by repo, day and column, the deltas of
+    the same repo, day and column are added up and zero sums are dropped.
+    '''
+    order = np.lexsort((columns, days, repos))
+    repos, days, columns, values = repos[order], days[order], columns[order], values[order]
+    starts = np.flatnonzero(np.concatenate(([True], (repos[1:] != repos[:-1]) |
+                                            (days[1:] != days[:-1]) |
+                                            (columns[1:] != columns[:-1]))))
+    sums = np.add.reduceat(values, starts)
+    keep = sums != 0
+    records = np.empty(int(keep.sum()), dtype=record_dtype)
+    records['repo'] = repos[starts][keep]
+    records['day'] = days[starts][keep]
+    records['column'] = columns[starts][keep]
+    records['value'] = sums[keep]
+    return records
+
+
+class SpilledRuns(object):
+    '''
+    The runs of deltas that an out-of-core run spilled to @directory. Every
+    run is an array of records (repo, day, column, value) in a .npy file. The
+    deltas of a repo are also spilled for each of its parent repos, so the
+    observations of a parent repo come from the runs just like those of a
+    regular repo.
+
+    @param names: the names of the repos, the id of a repo is its position
+    just like in Evaluation.
+    @type names: list
+
+    @param parents: the ids of the parent repos of every repo.
+    @type parents: list
+
+    @param first: the ordinal of the first day in any run.
+    @type first: int
+    '''
+    def __init__(self, directory, graph):
+        self.directory = directory
+        self.names = sorted(graph.keys())
+        self.ids = dict((name, x) for x, name in enumerate(self.names))
+        self.parents = [[self.ids[parent] for parent in graph[name]] for name in self.names]
+        self.paths = []
+        self.runs = []
+        self.first = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def spill(self, changes):
+        '''
+        Write @changes, the deltas that Evaluation.determine_changes returns,
+        as a new run. Returns the number of records in the run.
+        '''
+        records = combine(*changes)
+        if not len(records):
+            return 0
+        ids, starts = np.unique(records['repo'], return_index=True)
+        ends = np.append(starts[1:], len(records))
+        copies = [records]
+        for repo, start, end in zip(ids.tolist(), starts.tolist(), ends.tolist()):
+            for parent in self.parents[repo]:
+                copy = records[start:end].copy()
+                copy['repo'] = parent
+                copies.append(copy)
+        records = np.concatenate(copies)
+        records = combine(records['repo'], records['day'], records['column'], records['value'])
+        path = os.path.join(self.directory, 'run-%06d.npy' % len(self.paths))
+        np.save(path, records)
+        self.paths.append(path)
+        first = int(records['day'].min())
+        self.first = first if self.first is None else min(self.first, first)
+        return len(records)
+
+    def open(self):
+        self.runs = [np.load(path, mmap_mode='r') for path in self.paths]
+
+    def load(self, name):
+        '''
+        Return the records of the repo @name from all runs, or None if no run
+        contains a delta of the repo.
+        '''
+        repo = self.ids[name]
+        parts = []
+        for run in self.runs:
+            start, end = np.searchsorted(run['repo'], [repo, repo + 1]).tolist()
+            if end > start:
+                parts.append(np.array(run[start:end]))
+        if not parts:
+            return None
+        return np.concatenate(parts)
+
+    def remove(self):
+        self.runs = []
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -19,41 +19,219 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+# The columns that are read by Changeset, Patchset, Review and Developer, the
+# queries only fetch these columns. check_schema in stats.py verifies at
+# startup that these columns exist.
+columns = {
+    'accounts': ['account_id', 'full_name', 'preferred_email',
+                 'registered_on'],
+    'changes': ['change_id', 'created_on', 'last_updated_on',
+                'owner_account_id', 'dest_project_name', 'dest_branch_name',
+                'open', 'status', 'nbr_patch_sets'],
+    'patch_sets': ['change_id', 'patch_set_id', 'uploader_account_id',
+                   'created_on', 'draft'],
+    'patch_set_approvals': ['change_id', 'patch_set_id', 'account_id',
+                            'category_id', 'value', 'granted'],
+}
+
+
+def select_columns(*tables):
+    '''
+    Construct the column list of a SELECT statement. When a column is present
+    in multiple tables, only the column of the first table is selected.
+    '''
+    selected = []
+    seen = set()
+    for table in tables:
+        for column in columns[table]:
+            if column not in seen:
+                seen.add(column)
+                selected.append('%s.%s' % (table, column))
+    return ',\n                    '.join(selected)
+
+
+accounts_query = '''
+                SELECT
+                    %s
+                FROM
+                    accounts;
+                ''' % select_columns('accounts')
+
 changes_query = '''
                 SELECT
-                    *
+                    %s
                 FROM
                     changes
-                INNER JOIN
-                    accounts
-                ON
-                    changes.owner_account_id=accounts.account_id
                 ORDER BY
                     changes.created_on;
-                '''
+                ''' % select_columns('changes')
 
 approvals_query = '''
                 SELECT
-                    *
+                    %s
+                FROM
+                    patch_set_approvals
+                ORDER BY
+                    patch_set_approvals.granted;
+                ''' % select_columns('patch_set_approvals')
+
+patch_sets_query = '''
+                SELECT
+                    %s
+                FROM
+                    patch_sets;
+                ''' % select_columns('patch_sets')
+
+# The queries below only fetch the changesets that were updated since the
+# watermark of the previous run or that are still open, see state.py
+
+changes_since_query = '''
+                SELECT
+                    %s
+                FROM
+                    changes
+                WHERE
+                    changes.last_updated_on >= %%s
+                OR
+                    changes.open = 'Y'
+                ORDER BY
+                    changes.created_on;
+                ''' % select_columns('changes')
+
+approvals_since_query = '''
+                SELECT
+                    %s
                 FROM
                     patch_set_approvals
                 INNER JOIN
-                    accounts
+                    changes
                 ON
-                    patch_set_approvals.account_id=accounts.account_id
+                    patch_set_approvals.change_id=changes.change_id
+                WHERE
+                    changes.last_updated_on >= %%s
+                OR
+                    changes.open = 'Y'
                 ORDER BY
                     patch_set_approvals.granted;
-                '''
+                ''' % select_columns('patch_set_approvals')
 
-patch_sets_query = '''
+patch_sets_since_query = '''
                 SELECT
-                    *
+                    %s
                 FROM
                     patch_sets
-                LEFT JOIN
+                INNER JOIN
+                    changes
+                ON
+                    patch_sets.change_id=changes.change_id
+                WHERE
+                    changes.last_updated_on >= %%s
+                OR
+                    changes.open = 'Y';
+                ''' % select_columns('patch_sets')
+
+# The queries below only fetch the changesets whose intervals can overlap the
+# window of a backfill: the changesets created before the end of the window
+# that are still open or were updated after the start of the window. Closed
+# changesets are not counted after their last update.
+
+changes_window_query = '''
+                SELECT
+                    %s
+                FROM
+                    changes
+                WHERE
+                    changes.created_on < %%s
+                AND
+                    (changes.last_updated_on >= %%s OR changes.open = 'Y')
+                ORDER BY
+                    changes.created_on;
+                ''' % select_columns('changes')
+
+approvals_window_query = '''
+                SELECT
+                    %s
+                FROM
                     patch_set_approvals
+                INNER JOIN
+                    changes
                 ON
-                    patch_sets.change_id=patch_set_approvals.change_id
+                    patch_set_approvals.change_id=changes.change_id
+                WHERE
+                    changes.created_on < %%s
                 AND
-                    patch_sets.patch_set_id=patch_set_approvals.patch_set_id;
+                    (changes.last_updated_on >= %%s OR changes.open = 'Y')
+                ORDER BY
+                    patch_set_approvals.granted;
+                ''' % select_columns('patch_set_approvals')
+
+patch_sets_window_query = '''
+                SELECT
+                    %s
+                FROM
+                    patch_sets
+                INNER JOIN
+                    changes
+                ON
+                    patch_sets.change_id=changes.change_id
+                WHERE
+                    changes.created_on < %%s
+                AND
+                    (changes.last_updated_on >= %%s OR changes.open = 'Y');
+                ''' % select_columns('patch_sets')
+
+# The queries below only fetch the changesets of the repos of a single shard of
+# a sharded run. MOD(CRC32(name), count) is the same as determine_shard in
+# shards.py.
+
+changes_shard_query = '''
+                SELECT
+                    %s
+                FROM
+                    changes
+                WHERE
+                    MOD(CRC32(changes.dest_project_name), %%s) = %%s
+                ORDER BY
+                    changes.created_on;
+                ''' % select_columns('changes')
+
+approvals_shard_query = '''
+                SELECT
+                    %s
+                FROM
+                    patch_set_approvals
+                INNER JOIN
+                    changes
+                ON
+                    patch_set_approvals.change_id=changes.change_id
+                WHERE
+                    MOD(CRC32(changes.dest_project_name), %%s) = %%s
+                ORDER BY
+                    patch_set_approvals.granted;
+                ''' % select_columns('patch_set_approvals')
+
+patch_sets_shard_query = '''
+                SELECT
+                    %s
+                FROM
+                    patch_sets
+                INNER JOIN
+                    changes
+                ON
+                    patch_sets.change_id=changes.change_id
+                WHERE
+                    MOD(CRC32(changes.dest_project_name), %%s) = %%s;
+                ''' % select_columns('patch_sets')
+
+# The size of a shard, used to decide whether its changesets fit in the
+# memory budget of an out-of-core run.
+
+changes_shard_count_query = '''
+                SELECT
+                    COUNT(*) AS changes,
+                    COUNT(DISTINCT changes.dest_project_name) AS projects
+                FROM
+                    changes
+                WHERE
+                    MOD(CRC32(changes.dest_project_name), %s) = %s;
                 '''
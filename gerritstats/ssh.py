@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import paramiko
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+
+class CommandError(Exception):
+    '''
+    Raised when a remote command writes to stderr or exits with a non-zero
+    exit status.
+    '''
+    def __init__(self, command, status, error):
+        Exception.__init__(self, '%s exited with status %s: %s' % (command, status, error.strip()))
+        self.command = command
+        self.status = status
+        self.error = error
+
+
+class SSHSession(object):
+    '''
+    Keeps a single authenticated connection to the Gerrit server open so that
+    many commands can be run without connecting and authenticating for every
+    command. Every command runs on its own channel of the same transport, the
+    connection is (re)opened when it is needed.
+    '''
+    def __init__(self, host, port, username=None, key_filename=None, password=None, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.key_filename = key_filename
+        self.password = password
+        self.timeout = timeout
+        self.client = None
+        self.connections = 0
+
+    def __str__(self):
+        return '%s@%s:%s' % (self.username, self.host, self.port)
+
+    def is_active(self):
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def connect(self):
+        if self.is_active():
+            return self.client.get_transport()
+        self.close()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(self.host, port=self.port,
+                       username=self.username,
+                       key_filename=self.key_filename,
+                       password=self.password,
+                       allow_agent=False,
+                       look_for_keys=self.key_filename is None and self.password is None,
+                       timeout=self.timeout)
+        self.client = client
+        self.connections += 1
+        logging.info('Opened SSH connection to %s' % self)
+        return client.get_transport()
+
+    def open_channel(self, command):
+        channel = self.connect().open_session()
+        channel.exec_command(command)
+        return channel
+
+    def read_channel(self, command, channel):
+        stdout = channel.makefile('rb', -1)
+        stderr = channel.makefile_stderr('rb', -1)
+        output = stdout.readlines()
+        error = stderr.read()
+        status = channel.recv_exit_status()
+        channel.close()
+        if status != 0 or error:
+            raise CommandError(command, status, error)
+        return output
+
+    def run(self, command):
+        '''
+        Run @command and return its output as a list of lines.
+        '''
+        return self.read_channel(command, self.open_channel(command))
+
+    def run_many(self, commands):
+        '''
+        Run all @commands at the same time, each on its own channel of the
+        same transport. Returns a list with the output of every command, in
+        the order of @commands.
+        '''
+        channels = [self.open_channel(command) for command in commands]
+        return [self.read_channel(command, channel) for command, channel in zip(commands, channels)]
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+class EventStream(object):
+    '''
+    Subscribes to gerrit stream-events on its own channel of @session and
+    returns the events, one JSON object per line, as they arrive.
+    '''
+    def __init__(self, session, command='gerrit stream-events'):
+        self.session = session
+        self.command = command
+        self.channel = None
+        self.buffer = ''
+
+    def __str__(self):
+        return '%s on %s' % (self.command, self.session)
+
+    def open(self):
+        self.close()
+        self.channel = self.session.open_channel(self.command)
+        self.buffer = ''
+        logging.info('Subscribed to %s' % self)
+        return self
+
+    def read(self, timeout):
+        '''
+        Return the lines that were received within @timeout seconds, an empty
+        list if there were none. Raises EOFError when the server closed the
+        stream.
+        '''
+        if self.channel is None:
+            self.open()
+        self.channel.settimeout(timeout)
+        try:
+            data = self.channel.recv(65536)
+        except socket.timeout:
+            return []
+        if not data:
+            error = ''
+            while self.channel.recv_stderr_ready():
+                error += self.channel.recv_stderr(65536)
+            status = self.channel.recv_exit_status()
+            self.close()
+            if status != 0 or error:
+                raise EOFError(str(CommandError(self.command, status, error)))
+            raise EOFError('%s was closed by the server.' % self.command)
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        return [line for line in lines if line.strip()]
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+
+class ProjectCache(object):
+    '''
+    Cache of the output of gerrit ls-projects so that runs do not have to
+    contact the Gerrit server when the list was fetched recently.
+
+    @param path: the absolute path of the cache file.
+    @type path: str
+
+    @param ttl: the number of seconds that a cached list can be used, a ttl of
+    0 disables the cache.
+    @type ttl: int
+
+    @param fingerprint: identifies the server and command that produced the
+    list, a cached list with a different fingerprint is not used.
+    @type fingerprint: str
+    '''
+    def __init__(self, path, ttl, host, port, query):
+        self.path = path
+        self.ttl = ttl
+        self.fingerprint = hashlib.sha1(repr((host, port, query))).hexdigest()
+
+    def __str__(self):
+        return self.path
+
+    def checksum(self, lines):
+        return hashlib.sha1(''.join(lines).encode('utf-8')).hexdigest()
+
+    def load(self, now=None):
+        '''
+        Return the cached list of projects or None if there is no valid list.
+        '''
+        if not self.ttl:
+            return None
+        now = now or time.time()
+        try:
+            fh = open(self.path, 'r')
+            cache = json.load(fh)
+            fh.close()
+        except IOError:
+            return None
+        except ValueError, e:
+            logging.warning('Could not read project cache %s. Error: %s' % (self.path, e))
+            return None
+
+        if cache.get('fingerprint') != self.fingerprint:
+            logging.info('Project cache %s belongs to another Gerrit server or query.' % self.path)
+            return None
+        if now - cache.get('fetched_on', 0) > self.ttl:
+            logging.info('Project cache %s has expired.' % self.path)
+            return None
+        lines = cache.get('lines', [])
+        if cache.get('checksum') != self.checksum(lines):
+            logging.warning('Project cache %s is corrupt.' % self.path)
+            return None
+        logging.info('Using cached list of %s Gerrit repositories from %s' % (len(lines), self.path))
+        return [line.encode('utf-8') for line in lines]
+
+    def save(self, lines, now=None):
+        if not self.ttl:
+            return
+        lines = [line.decode('utf-8') if isinstance(line, str) else line for line in lines]
+        cache = {
+            'fingerprint': self.fingerprint,
+            'fetched_on': now or time.time(),
+            'checksum': self.checksum(lines),
+            'lines': lines,
+        }
+        tmp_path = '%s.tmp' % self.path
+        fh = open(tmp_path, 'w')
+        json.dump(cache, fh)
+        fh.close()
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import os
+import logging
+import cPickle
+
+from metrics import registry
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+STATE_VERSION = 1
+
+
+def determine_fingerprint(settings):
+    '''
+    The settings and metrics that determine the counts, observations that
+    were counted with a different fingerprint cannot be combined.
+    '''
+    keys = ['creation_date', 'ignore_repos', 'parents', 'staff_emails',
+            'staff_domains', 'bots']
+    return (STATE_VERSION, tuple(registry.compile().columns)) + tuple([repr(settings.get(key)) for key in keys])
+
+
+class State(object):
+    '''
+    The State object contains everything that is needed to run gerrit-stats
+    incrementally. The next run only has to fetch the changesets that were
+    updated since the watermark and the changesets that are still open (as
+    those are counted up to yesterday), back out the intervals that these
+    changesets contributed during the previous run and apply their new
+    intervals. This requires the sweep engine.
+
+    @param path: the absolute path of the file that stores the state.
+    @type path: str
+
+    @param fingerprint: the settings that were used to create the state, if
+    these settings change then the state cannot be used.
+    @type fingerprint: tuple
+
+    @param watermark: the most recent last_updated_on of all the changesets
+    that have been counted.
+    @type watermark: datetime.datetime
+
+    @param yesterday: the yesterday of the run that saved this state, the
+    datafiles contain observations up to and including this date.
+    @type yesterday: datetime.datetime
+
+    @param intervals: a dictionary where the key is the change_id and the value
+    a (repo name, intervals) tuple, see Repo.determine_intervals.
+    @type intervals: dict
+
+    @param deltas: a dictionary where the key is the name of a repo and the
+    value the deltas of that repo.
+    @type deltas: dict
+
+    @param affected: the names of the repos whose counts have changed during
+    this run.
+    @type affected: set
+    '''
+    def __init__(self, gerrit, settings):
+        self.path = os.path.join(gerrit.dataset, 'gerrit-stats.state')
+        self.fingerprint = determine_fingerprint(settings)
+        self.watermark = None
+        self.yesterday = None
+        self.intervals = {}
+        self.deltas = {}
+        self.affected = set()
+
+    def __str__(self):
+        return '%s:%s' % (self.path, self.watermark)
+
+    def load(self):
+        '''
+        Load the state of the previous run. Returns False if there is no state
+        or if it was created with different settings, in that case a full run
+        is required.
+        '''
+        try:
+            fh = open(self.path, 'rb')
+            state = cPickle.load(fh)
+            fh.close()
+        except IOError:
+            logging.info('No previous state found at %s, a full run is required.' % self.path)
+            return False
+        except (cPickle.UnpicklingError, EOFError, AttributeError, ValueError), e:
+            logging.warning('Could not read state %s, a full run is required. Error: %s' % (self.path, e))
+            return False
+
+        if state.get('fingerprint') != self.fingerprint:
+            logging.info('Settings have changed since the previous run, a full run is required.')
+            return False
+
+        self.watermark = state['watermark']
+        self.yesterday = state['yesterday']
+        self.intervals = state['intervals']
+        self.deltas = state['deltas']
+        logging.info('Loaded state of previous run, watermark is %s.' % self.watermark)
+        return True
+
+    def save(self, gerrit, yesterday):
+        self.yesterday = yesterday
+        self.deltas = dict((name, repo.deltas) for name, repo in
+                           gerrit.repos.iteritems() if repo.deltas != {})
+        state = {
+            'fingerprint': self.fingerprint,
+            'watermark': self.watermark,
+            'yesterday': self.yesterday,
+            'intervals': self.intervals,
+            'deltas': self.deltas,
+        }
+        tmp_path = '%s.tmp' % self.path
+        fh = open(tmp_path, 'wb')
+        cPickle.dump(state, fh, cPickle.HIGHEST_PROTOCOL)
+        fh.close()
+        os.rename(tmp_path, self.path)
+        logging.info('Saved state to %s, watermark is %s.' % (self.path, self.watermark))
+
+    def remove(self):
+        '''
+        A state that is not kept up to date cannot be used anymore.
+        '''
+        try:
+            os.unlink(self.path)
+            logging.info('Removed outdated state %s' % self.path)
+        except OSError:
+            pass
+
+    def restore(self, gerrit):
+        for name, deltas in self.deltas.iteritems():
+            repo = gerrit.repos.get(name)
+            if repo:
+                repo.deltas = deltas
+
+    def update(self, gerrit, changeset, repo):
+        '''
+        Back out the intervals that @changeset contributed during a previous
+        run and apply its current intervals to @repo. @repo is None if the
+        changeset belongs to a repo that is ignored.
+        '''
+        old = self.intervals.pop(changeset.change_id, None)
+        new = None
+        if repo:
+            new = (repo.name, repo.determine_intervals(changeset))
+
+        if self.watermark is None or changeset.last_updated_on > self.watermark:
+            self.watermark = changeset.last_updated_on
+
+        if old == new:
+            if new:
+                self.intervals[changeset.change_id] = new
+            return
+
+        if old:
+            old_repo = gerrit.repos.get(old[0])
+            if old_repo:
+                old_repo.apply_intervals(old[1], -1)
+                self.affected.add(old_repo.name)
+        if new:
+            repo.apply_intervals(new[1])
+            self.intervals[changeset.change_id] = new
+            self.affected.add(repo.name)
+
+    def is_unchanged(self, repo):
+        '''
+        Determine whether the observations of @repo up to the yesterday of the
+        previous run are still the same, if so then only the new observations
+        have to be appended to its datafile. Repos without any observations
+        only contain a single line for yesterday and are always rewritten.
+        '''
+        if self.yesterday is None or repo.first_commit >= repo.yesterday.date():
+            return False
+        if repo.name in self.affected:
+            return False
+        if not os.path.exists(repo.full_csv_path):
+            return False
+        return True
+
+    def determine_affected_parents(self, gerrit):
+        for name in list(self.affected):
+            repo = gerrit.repos.get(name)
+            if repo:
+                self.affected.update(repo.parent_repos)
@@ -26,14 +26,27 @@ import MySQLdb
 import MySQLdb.cursors
 import _mysql_exceptions
 import logging
-
-from datetime import date
-from copy import deepcopy
+import tempfile
+import threading
+import traceback
+import multiprocessing
 
 from gerrit import Gerrit
 from changeset import Review, Changeset, Patchset
-from utils import determine_yesterday, successful_exit, unsuccessful_exit
-from sql_queries import approvals_query, changes_query, patch_sets_query
+from developer import AccountRegistry
+from utils import parse_date, parse_shard, successful_exit, unsuccessful_exit
+from state import State, determine_fingerprint
+from router import SkippedChangesets
+from realtime import EventProcessor
+from shards import Partition
+from evaluation import Evaluation, evaluate_concurrently, evaluate_in_pool, pool_timeout
+from spill import MemoryBudget, SpilledRuns, max_partitions
+from instrumentation import instrumentation, determine_rss
+from sql_queries import columns, accounts_query, approvals_query, changes_query, patch_sets_query
+from sql_queries import approvals_since_query, changes_since_query, patch_sets_since_query
+from sql_queries import approvals_window_query, changes_window_query, patch_sets_window_query
+from sql_queries import approvals_shard_query, changes_shard_query, patch_sets_shard_query
+from sql_queries import changes_shard_count_query
 
 from yaml import load
 try:
@@ -55,10 +68,18 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-def init_db(my_cnf):
+def init_db(my_cnf, stream=False):
+    '''
+    When @stream is True an unbuffered server side cursor is returned, rows
+    are then only transferred when they are fetched.
+    '''
+    if stream:
+        cursor_class = MySQLdb.cursors.SSDictCursor
+    else:
+        cursor_class = MySQLdb.cursors.DictCursor
     try:
         db = MySQLdb.connect(read_default_file=my_cnf)
-        cur = db.cursor(MySQLdb.cursors.DictCursor)
+        cur = db.cursor(cursor_class)
         logging.info('Successfully obtained database cursor.')
     except _mysql_exceptions.OperationalError, error:
         logging.warning(
@@ -67,103 +88,609 @@ def init_db(my_cnf):
     return cur
 
 
-def load_commit_data(cur, changesets):
+def open_cursor(gerrit):
+    '''
+    Return a cursor on the reviewdb or on the snapshot of the reviewdb, see
+    snapshot.py.
+    '''
+    if gerrit.snapshot and gerrit.snapshot.offline:
+        return gerrit.snapshot.cursor()
+    cur = init_db(gerrit.my_cnf, gerrit.stream)
+    if gerrit.snapshot:
+        return gerrit.snapshot.cursor(cur)
+    return cur
+
+
+def close_cursor(cur):
+    '''
+    Close @cur and, when it was opened by init_db, its database connection.
+    '''
+    connection = getattr(cur, 'connection', None)
+    cur.close()
+    if connection is not None:
+        connection.close()
+
+
+def check_schema(cur):
+    '''
+    Verify that all the columns that gerrit-stats reads are present in the
+    reviewdb tables, this detects Gerrit schema changes before any data is
+    loaded.
+    '''
+    missing = []
+    for table, required in columns.iteritems():
+        try:
+            cur.execute('SHOW COLUMNS FROM %s' % table)
+        except _mysql_exceptions.ProgrammingError, e:
+            logging.error('Could not inspect table %s: %s' % (table, e))
+            unsuccessful_exit()
+        present = set([row['Field'] for row in cur.fetchall()])
+        for column in required:
+            if column not in present:
+                missing.append('%s.%s' % (table, column))
+    if missing:
+        logging.error('The Gerrit database schema has changed, the following columns are missing: %s' % ', '.join(missing))
+        unsuccessful_exit()
+    logging.info('Database schema contains all required columns.')
+
+
+def fetch_rows(cur, batch_size=None):
+    '''
+    Iterate over the result of the last executed query. If @batch_size is set
+    then the rows are fetched in batches of @batch_size rows so that, in
+    combination with a server side cursor, only a single batch is kept in
+    memory.
+    '''
+    if not batch_size:
+        rows = cur.fetchall()
+        instrumentation.count_rows(len(rows))
+        for row in rows:
+            yield row
+        return
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        instrumentation.count_rows(len(rows))
+        for row in rows:
+            yield row
+
+
+# For every table the query that loads all rows, the query that loads the rows
+# of the changesets updated since the watermark, the query that loads the
+# rows of the changesets that overlap the window of a backfill and the query
+# that loads the rows of the changesets of a single shard.
+queries = {
+    'changes': (changes_query, changes_since_query, changes_window_query, changes_shard_query),
+    'patch_sets': (patch_sets_query, patch_sets_since_query, patch_sets_window_query, patch_sets_shard_query),
+    'patch_set_approvals': (approvals_query, approvals_since_query, approvals_window_query, approvals_shard_query),
+}
+
+
+def determine_query(table, since=None, backfill=None, shard=None):
+    '''
+    Return the query that loads @table and its arguments.
+    '''
+    query, since_query, window_query, shard_query = queries[table]
+    if shard:
+        return shard_query, (shard.count, shard.index)
+    elif backfill:
+        return window_query, (backfill.end, backfill.start)
+    elif since:
+        return since_query, (since,)
+    return query, None
+
+
+def load_account_data(cur, accounts, batch_size=None):
     try:
-        cur.execute(changes_query)
+        cur.execute(accounts_query)
     except _mysql_exceptions.ProgrammingError, e:
         logging.warning(
             'Encountered problem while running db operation: %s' % e)
         unsuccessful_exit()
 
-    changesets_raw = cur.fetchall()
-    logging.info('Successfully loaded changeset data from database.')
-    for changeset in changesets_raw:
-        changeset = Changeset(**changeset)
+    for account in fetch_rows(cur, batch_size):
+        accounts.add(**account)
+    logging.info('Successfully loaded %s accounts from database.' % len(accounts))
+    return accounts
+
+
+def load_commit_data(cur, changesets, accounts, batch_size=None, since=None, backfill=None, clock=None, shard=None):
+    try:
+        cur.execute(*determine_query('changes', since, backfill, shard))
+    except _mysql_exceptions.ProgrammingError, e:
+        logging.warning(
+            'Encountered problem while running db operation: %s' % e)
+        unsuccessful_exit()
+
+    for changeset in fetch_rows(cur, batch_size):
+        author = accounts.get(changeset['owner_account_id'])
+        if author is None:
+            logging.info('Could not find the account %s that owns change_id: %s' % (changeset['owner_account_id'], changeset['change_id']))
+            continue
+        changeset = Changeset(author, clock, **changeset)
         changesets[changeset.change_id] = changeset
+    logging.info('Successfully loaded changeset data from database.')
 
     return changesets
 
 
-def load_review_data(cur, changesets):
+def load_review_data(cur, changesets, accounts, batch_size=None, since=None, backfill=None, shard=None):
     try:
-        cur.execute(approvals_query)
+        cur.execute(*determine_query('patch_set_approvals', since, backfill, shard))
     except _mysql_exceptions.ProgrammingError, e:
         logging.warning(
             'Encountered problem while running db operation: %s' % e)
         unsuccessful_exit()
 
-    approvals = cur.fetchall()
+    for review in create_reviews(fetch_rows(cur, batch_size), accounts):
+        add_review(changesets, review)
     logging.info('Successfully loaded approval data from database.')
+    return changesets
+
+
+def create_reviews(approvals, accounts):
     for approval in approvals:
-        review = Review(**approval)
+        reviewer = accounts.get(approval['account_id'])
         #drop bot reviewers and drop reviews with +0 (this is a hack to make it more compatible with gerrit search quagmire)
-        if review.reviewer.human is True:
-            changeset = changesets.get(review.change_id)
-            if changeset:
-                changeset.patch_sets[review.patch_set_id].reviews['%s_%s_%s' % (review.granted, review.category_id, review.value)] = review
-            else:
-                logging.info('Could not find a commit that belongs to change_id: %s written by %s (%s) on %s' % (review.change_id, review.reviewer.full_name, review.reviewer.account_id, review.granted))
-    return changesets
+        if reviewer is None or reviewer.human is not True:
+            continue
+        yield Review(reviewer, **approval)
+
+
+def add_review(changesets, review):
+    changeset = changesets.get(review.change_id)
+    if changeset:
+        changeset.patch_sets[review.patch_set_id].reviews.add(review)
+    else:
+        logging.info('Could not find a commit that belongs to change_id: %s written by %s (%s) on %s' % (review.change_id, review.reviewer.full_name, review.reviewer.account_id, review.granted))
 
 
-def load_patch_set_data(cur, changesets):
+def load_patch_set_data(cur, changesets, batch_size=None, since=None, backfill=None, shard=None):
     try:
-        cur.execute(patch_sets_query)
+        cur.execute(*determine_query('patch_sets', since, backfill, shard))
     except _mysql_exceptions.ProgrammingError, e:
         logging.warning(
             'Encountered problem while running db operation: %s' % e)
         unsuccessful_exit()
 
-    patch_sets = cur.fetchall()
+    for patch_set in fetch_rows(cur, batch_size):
+        add_patch_set(changesets, Patchset(**patch_set))
     logging.info('Successfully loaded patch_sets data from database.')
-    for patch_set in patch_sets:
-        patch_set = Patchset(**patch_set)
-        changeset = changesets.get(patch_set.change_id)
-        if changeset:
-            changeset.patch_sets[patch_set.patch_set_id] = patch_set
-        else:
-            logging.info('Could not find a commit that belongs to patch_set_id: %s written by %s on %s' % (patch_set.change_id, patch_set.uploader_account_id, patch_set.created_on))
     return changesets
 
 
+def add_patch_set(changesets, patch_set):
+    changeset = changesets.get(patch_set.change_id)
+    if changeset:
+        changeset.patch_sets[patch_set.patch_set_id] = patch_set
+    else:
+        logging.info('Could not find a commit that belongs to patch_set_id: %s written by %s on %s' % (patch_set.change_id, patch_set.uploader_account_id, patch_set.created_on))
+
+
+def load_concurrently(gerrit, changesets, accounts, since=None, shard=None, connect=open_cursor):
+    '''
+    Run the changes, patch_sets and approvals queries at the same time, each
+    on its own database connection and thread, so the database I/O takes
+    about as long as the slowest query. The threads only create the
+    Changeset, Patchset and Review objects, the patch sets and reviews are
+    attached to the changesets afterwards in the order of the query results,
+    so the result is identical to loading them one after another. All patch
+    sets and reviews are held in memory until the changes have been loaded,
+    that is why --concurrent cannot be combined with --stream or
+    --memory-budget.
+
+    @param connect: returns a new cursor for @gerrit, every thread closes
+    its cursor when it is done.
+    @type connect: function
+    '''
+    def fetch_patch_sets(cur):
+        cur.execute(*determine_query('patch_sets', since, gerrit.backfill, shard))
+        return [Patchset(**patch_set) for patch_set in fetch_rows(cur, gerrit.batch_size)]
+
+    def fetch_reviews(cur):
+        cur.execute(*determine_query('patch_set_approvals', since, gerrit.backfill, shard))
+        return list(create_reviews(fetch_rows(cur, gerrit.batch_size), accounts))
+
+    tasks = [
+        ('changes', load_commit_data, (changesets, accounts, gerrit.batch_size, since, gerrit.backfill, gerrit.clock, shard)),
+        ('patch_sets', fetch_patch_sets, ()),
+        ('approvals', fetch_reviews, ()),
+    ]
+    results = {}
+    errors = {}
+
+    def run(name, func, args):
+        cur = None
+        try:
+            cur = connect(gerrit)
+            results[name] = func(cur, *args)
+        except SystemExit:
+            errors[name] = 'See the errors above.'
+        except Exception:
+            errors[name] = traceback.format_exc()
+        finally:
+            if cur is not None:
+                close_cursor(cur)
+
+    threads = [threading.Thread(target=run, args=task, name=task[0]) for task in tasks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        for name, error in sorted(errors.iteritems()):
+            logging.error('Could not load %s from database:\n%s' % (name, error))
+        unsuccessful_exit()
+
+    logging.info('Fetched %s patch sets and %s reviews, attaching them to changesets.' % (len(results['patch_sets']), len(results['approvals'])))
+    for patch_set in results['patch_sets']:
+        add_patch_set(changesets, patch_set)
+    for review in results['approvals']:
+        add_review(changesets, review)
+    logging.info('Successfully loaded changesets, patch_sets and approval data from database.')
+    return changesets
+
+
+def evaluate_changesets(gerrit, changesets, state=None):
+    '''
+    Determine the review metrics of every changeset and count them in the repo
+    the changeset belongs to. The intervals of the changesets of an
+    incremental or real-time run are recorded in @state, otherwise the
+    changesets of the sweep engine are evaluated by gerrit.workers processes.
+    '''
+    skipped = None
+    if state is None and gerrit.engine == 'sweep' and gerrit.workers > 1:
+        skipped = evaluate_concurrently(gerrit, changesets, gerrit.workers)
+    if skipped is None:
+        skipped = SkippedChangesets()
+        for changeset in changesets.itervalues():
+            changeset.evaluate()
+
+            route = gerrit.router.route(changeset.dest_project_name)
+            repo = route.repo
+            if state:
+                state.update(gerrit, changeset, repo)
+            elif repo:
+                repo.increment(changeset)
+            if not repo:
+                skipped.add(route)
+    skipped.log_summary()
+
+    for repo in gerrit.repos.itervalues():
+        repo.accumulate_deltas()
+
+    logging.info('Successfully parsed changesets data.')
+    return gerrit
+
+
+def determine_rollup_graph(gerrit):
+    '''
+    Build the graph of repos and the parent repos they are aggregated into.
+    The edges come from Repo.parent_repos. A regular repo already lists all
+    its ancestors, mediawiki/extensions/Cite lists both
+    mediawiki/all_extensions and mediawiki, and Repo.determine_parent never
+    assigns parents to a parent repo. The graph is therefore a single level
+    deep and cannot contain a cycle. Parent repos are not nested on purpose:
+    an extension is part of several parent repos that are all part of
+    mediawiki, so adding parents to their parents would count it more than
+    once. Returns a dictionary where the key is the name of a repo and the
+    value the sorted list of its parents, empty for a parent repo.
+    '''
+    graph = {}
+    for name, repo in gerrit.repos.iteritems():
+        parents = set()
+        if repo.is_parent:
+            graph[name] = []
+            continue
+        for parent in repo.parent_repos:
+            if parent == name:
+                logging.warning('Parent == child: %s: %s' % (parent, name))
+                unsuccessful_exit()
+            elif parent in gerrit.repos:
+                parents.add(parent)
+            else:
+                logging.warn('Parent repo %s does not exist, while repo %s expects there to be a parent repo.' % (parent, name))
+        graph[name] = sorted(parents)
+    return graph
+
+
 def create_aggregate_dataset(gerrit):
+    '''
+    Add the observations of every repo to its parent repos, see
+    determine_rollup_graph. The repos are visited in order of their name, so
+    the result does not depend on dictionary order. The stores are added in
+    place, the cost is linear in the number of repo days.
+    '''
     logging.info('Creating datasets for parent repositories.')
-    for name, repo in gerrit.repos.iteritems():
-        if repo.is_parent is False:
-            for parent in repo.parent_repos:
-                parent_repo = gerrit.repos.get(parent)
-                if parent_repo:
-                    if parent_repo.name == repo.name:
-                        logging.warning('Parent == child: %s: %s' % (parent_repo.name, repo.name))
-                        unsuccessful_exit()
-                    gerrit.repos[parent_repo.name] = merge(parent_repo, repo)
-                else:
-                    logging.warn('Parent repo %s does not exist, while repo %s expects there to be a parent repo.' % (parent, name))
+    graph = determine_rollup_graph(gerrit)
+    for name in sorted(graph):
+        repo = gerrit.repos[name]
+        for parent in graph[name]:
+            merge(gerrit.repos[parent], repo)
     return gerrit
 
 
 def merge(parent_repo, repo):
-    for date, obs in repo.observations.iteritems():
-        if date not in parent_repo.observations:
-            parent_repo.observations[date] = deepcopy(obs)
-        else:
-            for key, value in obs.iteritems():
-                parent_repo.observations[date] = parent_repo.observations[
-                    date].update(key, value)
+    parent_repo.store.merge(repo.store)
     return parent_repo
 
 
-def parse_commandline():
+def finalize_repo(gerrit, repo, state=None):
+    '''
+    Fill in the missing days, prune the observations and write the datafile
+    and datasource of @repo. During an incremental run, the observations of
+    unchanged repos are appended to their existing datafile.
+    '''
+    if gerrit.backfill:
+        return repo.backfill_dataset(gerrit, gerrit.backfill)
+    repo.fill_in_missing_days()
+    repo.prune_observations()
+    if state and state.is_unchanged(repo):
+        return repo.write_dataset(gerrit, state.yesterday.date())
+    else:
+        return repo.write_dataset(gerrit)
+
+
+# The worker processes are forked after the aggregation is done, so they
+# inherit the repos through this dictionary instead of having to unpickle them.
+worker_context = {}
+
+
+def finalize_worker(name):
+    gerrit = worker_context['gerrit']
+    try:
+        paths = finalize_repo(gerrit, gerrit.repos[name], worker_context['state'])
+    except Exception:
+        return name, [], traceback.format_exc()
+    return name, paths, None
+
+
+def finalize_repos(gerrit, state=None, workers=1, names=None):
+    '''
+    Finalize and write all repos, or only the repos in @names. The repos are
+    independent of each other once the aggregation is done, so with
+    @workers > 1 they are spread over a pool of processes. Each repo writes
+    its own files, hence the output does not depend on the number of workers.
+    If the pool cannot be started or does not finish within pool_timeout
+    seconds, the repos are finalized serially. The workers report which
+    files they wrote, so the DatasetWriter of this process knows which files
+    are stale.
+    '''
+    if names is None:
+        names = sorted(gerrit.repos.keys())
+    gerrit.writer.create_directories([directory for name in names
+                                      for directory in gerrit.repos[name].determine_directories()])
+    results = None
+    if workers > 1:
+        worker_context['gerrit'] = gerrit
+        worker_context['state'] = state
+        try:
+            pool = multiprocessing.Pool(workers)
+        except (OSError, ImportError), e:
+            logging.warning('Could not start %s worker processes, finalizing repos serially. Error: %s' % (workers, e))
+        else:
+            logging.info('Finalizing %s repos using %s worker processes.' % (len(names), workers))
+            chunksize = max(1, len(names) / (workers * 4))
+            try:
+                results = pool.map_async(finalize_worker, names, chunksize).get(pool_timeout)
+            except multiprocessing.TimeoutError:
+                pool.terminate()
+                logging.warning('The worker processes did not finish within %s seconds, finalizing repos serially.' % pool_timeout)
+            else:
+                pool.close()
+            pool.join()
+        worker_context.clear()
+
+    if results is None:
+        results = []
+        for name in names:
+            try:
+                results.append((name, finalize_repo(gerrit, gerrit.repos[name], state), None))
+            except Exception:
+                results.append((name, [], traceback.format_exc()))
+
+    for name, paths, error in results:
+        for path, changed in paths:
+            gerrit.writer.keep(path, changed)
+    errors = [(name, error) for name, paths, error in results if error]
+    for name, error in sorted(errors):
+        logging.error('Could not write dataset for repo %s:\n%s' % (name, error))
+    if errors:
+        logging.error('Failed to write %s out of %s datasets.' % (len(errors), len(names)))
+        unsuccessful_exit()
+
+
+def count_partition(cur, partition):
+    '''
+    Return the number of changesets and projects of @partition.
+    '''
+    try:
+        cur.execute(changes_shard_count_query, (partition.count, partition.index))
+        row = cur.fetchone()
+    except _mysql_exceptions.ProgrammingError, e:
+        logging.warning(
+            'Encountered problem while running db operation: %s' % e)
+        unsuccessful_exit()
+    return row['changes'], row['projects']
+
+
+def load_partition(gerrit, cur, accounts, partition):
+    '''
+    Load the changesets of the repos of @partition, a single partition
+    selects all changesets with the regular queries.
+    '''
+    shard = partition if partition.count > 1 else None
+    changesets = load_commit_data(cur, {}, accounts, gerrit.batch_size, None, None, gerrit.clock, shard)
+    changesets = load_patch_set_data(cur, changesets, gerrit.batch_size, None, None, shard)
+    return load_review_data(cur, changesets, accounts, gerrit.batch_size, None, None, shard)
+
+
+def evaluate_partitions(gerrit, cur, accounts, budget, runs):
+    '''
+    Load, evaluate and spill the changesets one partition of the repos at a
+    time. A partition is split in two until its changesets fit in @budget,
+    the estimated size of a changeset is refined with every partition that is
+    loaded. Returns the number of changesets.
+    '''
+    skipped = SkippedChangesets()
+    partitions = [Partition(0, 1)]
+    loaded = 0
+    while partitions:
+        partition = partitions.pop(0)
+        changes, projects = count_partition(cur, partition)
+        if changes == 0:
+            continue
+        if changes > budget.capacity():
+            if projects > 1 and partition.count < max_partitions:
+                partitions[:0] = partition.split()
+                continue
+            logging.warning('The %s changesets of partition %s exceed the memory budget of %s, but the partition cannot be split any further.'
+                            % (changes, partition, budget))
+        rss = determine_rss()
+        changesets = load_partition(gerrit, cur, accounts, partition)
+        budget.measure(len(changesets), determine_rss() - rss)
+
+        evaluation = Evaluation(gerrit, changesets.keys())
+        if gerrit.workers <= 1 or not evaluate_in_pool(evaluation, gerrit, changesets, gerrit.workers):
+            evaluation.evaluate(gerrit, changesets, 0, len(evaluation))
+        evaluation.determine_skipped(gerrit, changesets, skipped)
+        changes = evaluation.determine_changes()
+        records = runs.spill(changes) if changes is not None else 0
+        logging.info('Spilled %s deltas of the %s changesets of partition %s, a changeset takes about %s bytes.'
+                     % (records, len(changesets), partition, budget.changeset_size))
+        loaded += len(changesets)
+        # drop the changesets before the next partition is loaded
+        evaluation = changesets = changes = None
+    skipped.log_summary()
+    logging.info('Evaluated %s changesets in %s runs within the memory budget of %s.' % (loaded, len(runs), budget))
+    return loaded
+
+
+def finalize_from_runs(gerrit, budget, runs):
+    '''
+    Write the datasets a batch of repos at a time. The observations of a repo
+    are constructed from its deltas in all runs, the runs already contain the
+    deltas of the children of a parent repo, and are dropped once the dataset
+    of the repo has been written.
+    '''
+    names = sorted(gerrit.repos.keys())
+    if not names:
+        return
+    first = runs.first if runs.first is not None else gerrit.clock.yesterday.date().toordinal()
+    if gerrit.creation_date:
+        first = min(first, gerrit.creation_date.toordinal())
+    days = gerrit.clock.yesterday.date().toordinal() - first + 1
+    batch_size = budget.determine_batch_size(days, len(gerrit.repos[names[0]].determine_columns()))
+    logging.info('Writing the datasets of %s repos in batches of %s repos.' % (len(names), batch_size))
+    runs.open()
+    for x in xrange(0, len(names), batch_size):
+        batch = names[x:x + batch_size]
+        for name in batch:
+            records = runs.load(name)
+            if records is not None:
+                gerrit.repos[name].store.accumulate_changes(records['day'], records['column'], records['value'])
+        finalize_repos(gerrit, None, gerrit.workers, batch)
+        for name in batch:
+            gerrit.repos[name].reset_store()
+
+
+def run_out_of_core(gerrit, cur, accounts):
+    '''
+    Count the changesets and write the datasets within gerrit.memory_budget,
+    see spill.py. The runs are spilled next to the datasets and removed
+    afterwards. Returns the number of runs.
+    '''
+    budget = MemoryBudget(gerrit.memory_budget)
+    if budget.available() <= 0:
+        logging.error('The memory budget of %s is already used up after loading the accounts and repos (%.0f MB), please specify a larger --memory-budget.'
+                      % (budget, budget.baseline / 1048576.0))
+        unsuccessful_exit()
+    graph = determine_rollup_graph(gerrit)
+    runs = SpilledRuns(tempfile.mkdtemp(prefix='gerrit-stats.spill-', dir=gerrit.dataset), graph)
+    logging.info('Out-of-core run within a memory budget of %s, spilling the deltas to %s.' % (budget, runs.directory))
+    try:
+        instrumentation.measure('evaluate_partitions', evaluate_partitions, gerrit, cur, accounts, budget, runs)
+        instrumentation.measure('finalize', finalize_from_runs, gerrit, budget, runs)
+    finally:
+        runs.remove()
+    return len(runs)
+
+
+def update_datasets(gerrit, changesets, state):
+    '''
+    Count @changesets, the changesets that changed since the previous update,
+    again and rewrite the datasets of the repos whose counts have changed.
+    The deltas of all repos are kept between updates, only the observations
+    are constructed again. Returns the number of repos that were rewritten.
+    '''
+    for repo in gerrit.repos.itervalues():
+        repo.reset_store()
+    # the watermark stays at the last database load, so the next incremental
+    # run also fetches the changesets of events that were missed
+    watermark = state.watermark
+    evaluate_changesets(gerrit, changesets, state)
+    state.watermark = watermark
+    create_aggregate_dataset(gerrit)
+    state.determine_affected_parents(gerrit)
+    names = sorted(name for name in state.affected if name in gerrit.repos)
+    if names:
+        finalize_repos(gerrit, None, gerrit.workers, names)
+    if gerrit.incremental:
+        state.save(gerrit, gerrit.clock.yesterday)
+    state.affected.clear()
+    return len(names)
+
+
+def run_realtime(gerrit, stream, changesets, accounts, state):
+    processor = EventProcessor(gerrit, changesets, accounts, state, update_datasets)
+    logging.info('Applying events from %s, the datasets are updated every %s seconds.' % (stream, gerrit.flush_interval))
+    try:
+        processor.run(stream, gerrit.flush_interval)
+    except KeyboardInterrupt:
+        logging.info('Stopping, writing the events that were received so far.')
+        processor.flush()
+    stream.close()
+    stream.session.close()
+
+
+def parse_commandline(argv=None):
+    '''
+    Parse @argv, by default the arguments of the command line.
+    '''
     parser = argparse.ArgumentParser(description='Welcome to gerrit-stats. The mysql credentials should be stored in the .my.cnf file. By default, this file is read from the user\'s home directory. You can specify an alternative location using the --config option.')
     parser.add_argument('--sql', help='Specify the absolute path to tell gerrit-stats where it can find the MySQL my.cnf file.', action='store', required=False, default='~/.my.cnf')
     parser.add_argument('--settings', help='Specify the absolute path to the file settings.yaml that contains gerrit-stats settings.', action='store', required=False, default=os.path.join(os.getcwd(), 'settings.yaml'))
     parser.add_argument('--datasets', help='Specify the absolute path to store the gerrit-stats datasets.', required=True)
     parser.add_argument('--toolkit', help='Specify the visualization library you want to use. Valid choices are: dygraphs and d3.', action='store', default='d3')
+    parser.add_argument('--engine', help='Specify the engine that counts the number of changesets waiting for review. Valid choices are: sweep and daterange. Both engines generate identical datasets, daterange is the original (slower) engine.', action='store', choices=['sweep', 'daterange'], default='sweep')
+    parser.add_argument('--stream', help='Use an unbuffered server side database cursor and fetch the rows in batches instead of loading entire tables into memory.', action='store_true', default=False)
+    parser.add_argument('--batch-size', help='Specify the number of rows to fetch per batch when --stream is used.', action='store', type=int, default=10000)
+    parser.add_argument('--incremental', help='Only fetch the changesets that were updated since the previous run and only rewrite the datasets that have changed. The first run with this option is a full run. Requires the sweep engine.', action='store_true', default=False)
+    parser.add_argument('--append', help='Only rewrite the last days of existing datafiles and append the new days, instead of rewriting the datafiles completely. A datafile whose columns or first day have changed is still rewritten completely. Changes to days before the rewrite window are only picked up by a run without this option.', action='store_true', default=False)
+    parser.add_argument('--rewrite-days', help='Specify the number of days before the last day of an existing datafile that are rewritten when --append is used, to pick up reviews that arrived late.', action='store', type=int, default=7)
+    parser.add_argument('--concurrent', help='Fetch the changes, patch_sets and approvals at the same time using three database connections. All patch sets and reviews are kept in memory until the changes are loaded, so this cannot be combined with --stream or --memory-budget.', action='store_true', default=False)
+    parser.add_argument('--workers', help='Specify the number of processes that evaluate the changesets and that finalize and write the datasets.', action='store', type=int, default=1)
+    parser.add_argument('--memory-budget', help='Specify the number of megabytes of memory that a run may use. The changesets are then loaded and evaluated for a part of the repos at a time, their counts are spilled to disk next to the datasets and the datasets are written from there. Cannot be combined with --incremental, --realtime, --since, --until, --as-of, --shard, --concurrent or snapshots. Requires the sweep engine.', action='store', type=int, required=False)
+    parser.add_argument('--report', help='Specify the absolute path of the JSON run report that contains the timings and memory usage of every phase. Defaults to gerrit-stats.report.json in the datasets directory.', action='store', required=False)
+    parser.add_argument('--prometheus', help='Specify the absolute path of a .prom file for the textfile collector of the Prometheus node exporter. The run report is then also written in the Prometheus text format.', action='store', required=False)
+    parser.add_argument('--snapshot', help='Specify a directory to save the reviewdb tables and the list of Gerrit repositories to, this snapshot can be used by --from-snapshot. All rows are kept in memory until the snapshot is saved, so this cannot be combined with --stream.', action='store', required=False)
+    parser.add_argument('--from-snapshot', help='Specify the directory of a snapshot, gerrit-stats then runs without contacting the database and the Gerrit server.', action='store', required=False)
+    parser.add_argument('--projects-ttl', help='Specify the number of seconds that the list of Gerrit repositories is cached, by default the list is fetched from the Gerrit server on every run.', action='store', type=int, default=0)
+    parser.add_argument('--since', help='Only recompute the observations from this day on (YYYY-MM-DD) and merge them into the existing datafiles, the other days of the datafiles are kept. Only the changesets that overlap the days to recompute are loaded. Defaults to the creation date of Gerrit when --until or --as-of is used.', action='store', type=parse_date, required=False)
+    parser.add_argument('--until', help='Only recompute the observations up to and including this day (YYYY-MM-DD) and merge them into the existing datafiles. Defaults to the day before --as-of when --since or --as-of is used.', action='store', type=parse_date, required=False)
+    parser.add_argument('--as-of', help='Run as if today is this day (YYYY-MM-DD), the observations end the day before. The changesets are evaluated with their current status. Implies that the observations are merged into the existing datafiles, see --since and --until.', action='store', type=parse_date, required=False)
+    parser.add_argument('--shard', help='Run as worker I of N of a sharded run (for example 2/4): only the changesets of the repos whose name hashes to this shard are loaded and their observations are saved to --shard-directory instead of writing datasets.', action='store', type=parse_shard, required=False)
+    parser.add_argument('--merge-shards', help='Merge the observations that the workers of a sharded run saved to --shard-directory and write the datasets, this does not contact the database.', action='store_true', default=False)
+    parser.add_argument('--shard-directory', help='Specify the absolute path of the directory that is shared by the workers and the merge step of a sharded run.', action='store', required=False)
+    parser.add_argument('--realtime', help='Keep running after the datasets have been written and update them using the events of gerrit stream-events. Requires the sweep engine.', action='store_true', default=False)
+    parser.add_argument('--flush-interval', help='Specify the number of seconds between updates of the datasets when --realtime is used.', action='store', type=int, default=300)
     parser.add_argument('--ssh-username', help='Specify your SSH username if your username on your local box dev is different then the one you use on the remote box.', action='store', required=False)
     parser.add_argument('--ssh-identity', help='Specify the location of your SSH private key.', action='store', required=False)
     parser.add_argument('--ssh-password', help='Specify the password of the SSH private key (optional)', action='store', required=False)
     logging.info('Parsed commandline successfully.')
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def load_settings(args):
@@ -180,60 +707,178 @@ def load_settings(args):
     return settings
 
 
+def merge_shards(gerrit, settings):
+    '''
+    The merge step of a sharded run, the observations that the workers saved
+    are added up and the datasets of all repos are written, just like at the
+    end of a single run.
+    '''
+    instrumentation.measure('fetch_repos', gerrit.fetch_repos)
+    gerrit.close()
+    instrumentation.measure('merge_shards', gerrit.partials.merge, gerrit, determine_fingerprint(settings))
+    instrumentation.measure('aggregate', create_aggregate_dataset, gerrit)
+    instrumentation.measure('finalize', finalize_repos, gerrit, None, gerrit.workers)
+    instrumentation.measure('remove_stale', gerrit.writer.remove_stale)
+
+
+def write_reports(args, success=True):
+    instrumentation.success = success
+    instrumentation.write_report(args.report or os.path.join(args.datasets, 'gerrit-stats.report.json'))
+    if args.prometheus:
+        instrumentation.write_prometheus(args.prometheus)
+
+
 def main():
     logging.info('Launching gerrit-stats')
 
     args = parse_commandline()
+    try:
+        run(args)
+    except BaseException:
+        # unsuccessful_exit raises SystemExit, failed runs also write their
+        # report so that they can be alerted on.
+        try:
+            write_reports(args, success=False)
+        except (IOError, OSError), e:
+            logging.error('Could not write the run report: %s' % e)
+        raise
+
 
-    settings = load_settings(args)
+def run(args):
+    settings = instrumentation.measure('load_settings', load_settings, args)
 
     gerrit = Gerrit(args, settings)
-    cur = init_db(gerrit.my_cnf)
-    gerrit.fetch_repos()
+    if gerrit.shard or gerrit.partials:
+        if gerrit.incremental or gerrit.realtime or gerrit.backfill:
+            logging.error('--shard and --merge-shards cannot be combined with --incremental, --realtime, --since, --until or --as-of.')
+            unsuccessful_exit()
+        if gerrit.shard and gerrit.snapshot:
+            logging.error('A worker of a sharded run only loads the changesets of its shard and cannot use snapshots.')
+            unsuccessful_exit()
+    if gerrit.snapshot and not gerrit.snapshot.offline and gerrit.stream:
+        logging.error('--snapshot keeps all rows in memory until the snapshot is saved and cannot be combined with --stream.')
+        unsuccessful_exit()
+    if gerrit.concurrent and gerrit.stream:
+        logging.error('--concurrent keeps all patch sets and reviews in memory until the changes are loaded and cannot be combined with --stream.')
+        unsuccessful_exit()
+    if gerrit.memory_budget:
+        if gerrit.incremental or gerrit.realtime or gerrit.backfill or gerrit.shard or gerrit.partials or gerrit.snapshot or gerrit.concurrent:
+            logging.error('--memory-budget cannot be combined with --incremental, --realtime, --since, --until, --as-of, --shard, --merge-shards, --concurrent or snapshots.')
+            unsuccessful_exit()
+        if gerrit.engine != 'sweep':
+            logging.error('The out-of-core mode of --memory-budget requires the sweep engine.')
+            unsuccessful_exit()
+    if gerrit.partials:
+        merge_shards(gerrit, settings)
+        write_reports(args)
+        successful_exit()
+        return
+
+    cur = open_cursor(gerrit)
+    check_schema(cur)
+    instrumentation.measure('fetch_repos', gerrit.fetch_repos)
+    gerrit.close()
 
     start_date = settings.get('creation_date')
-    yesterday = determine_yesterday()
+    yesterday = gerrit.clock.yesterday
     changesets = {}
 
     logging.info(
         'Queries will span timeframe: %s - %s.' % (start_date, yesterday))
     logging.info('Queries will always run up to \'yesterday\', so that we always have counts for full days.')
 
-    changesets = load_commit_data(cur, changesets)
-    changesets = load_patch_set_data(cur, changesets)
-    changesets = load_review_data(cur, changesets)
-
-    for changeset in changesets.itervalues():
-        changeset.is_all_positive_reviews()
-        changeset.calculate_wait_first_review()
-        changeset.calculate_wait_plus2()
-        changeset.is_self_reviewed()
-
-        repo = gerrit.repos.get(changeset.dest_project_name)
-        if repo:
-            repo.increment(changeset)
+    if gerrit.backfill:
+        if gerrit.incremental or gerrit.append or gerrit.realtime:
+            logging.error('--since, --until and --as-of cannot be combined with --incremental, --append or --realtime.')
+            unsuccessful_exit()
+        if gerrit.snapshot:
+            logging.error('Snapshots contain all changesets and cannot be used to backfill a window.')
+            unsuccessful_exit()
+        logging.info('Backfilling %s as of %s, only changesets that overlap these days will be fetched.' % (gerrit.backfill, gerrit.clock))
+
+    stream = None
+    if gerrit.realtime:
+        if gerrit.engine != 'sweep':
+            logging.error('The real-time mode requires the sweep engine.')
+            unsuccessful_exit()
+        if gerrit.snapshot and gerrit.snapshot.offline:
+            logging.error('The real-time mode needs the Gerrit server and cannot be used with a snapshot.')
+            unsuccessful_exit()
+        # subscribe before loading so that no events are missed
+        stream = gerrit.open_event_stream()
+
+    state = None
+    if gerrit.incremental:
+        if gerrit.engine != 'sweep':
+            logging.error('Incremental runs require the sweep engine.')
+            unsuccessful_exit()
+        if gerrit.snapshot:
+            logging.error('Snapshots contain all changesets and cannot be used for incremental runs.')
+            unsuccessful_exit()
+        state = State(gerrit, settings)
+        if state.load():
+            state.restore(gerrit)
         else:
-            logging.info('Repo %s does not exist, ignored repos are: %s' % (changeset.dest_project_name, ','.join(gerrit.ignore_repos)))
+            state = State(gerrit, settings)
+    else:
+        State(gerrit, settings).remove()
+        if gerrit.realtime:
+            # the real-time mode backs out the intervals of changesets that
+            # change, this in-memory state is never saved
+            state = State(gerrit, settings)
+
+    since = state.watermark if state else None
+    if since:
+        logging.info('Incremental run, only changesets updated since %s or still open will be fetched.' % since)
+    if gerrit.shard:
+        logging.info('Worker %s of a sharded run, only changesets of the repos of this shard will be fetched.' % gerrit.shard)
+
+    accounts = instrumentation.measure('load_accounts', load_account_data, cur, AccountRegistry(settings), gerrit.batch_size)
+    if gerrit.memory_budget:
+        run_out_of_core(gerrit, cur, accounts)
+        instrumentation.measure('remove_stale', gerrit.writer.remove_stale)
+        write_reports(args)
+        successful_exit()
+        return
+
+    if gerrit.concurrent:
+        changesets = instrumentation.measure('load_concurrently', load_concurrently, gerrit, changesets, accounts, since, gerrit.shard)
+    else:
+        changesets = instrumentation.measure('load_changes', load_commit_data, cur, changesets, accounts, gerrit.batch_size, since, gerrit.backfill, gerrit.clock, gerrit.shard)
+        changesets = instrumentation.measure('load_patch_sets', load_patch_set_data, cur, changesets, gerrit.batch_size, since, gerrit.backfill, gerrit.shard)
+        changesets = instrumentation.measure('load_reviews', load_review_data, cur, changesets, accounts, gerrit.batch_size, since, gerrit.backfill, gerrit.shard)
+
+    if gerrit.snapshot and not gerrit.snapshot.offline:
+        instrumentation.measure('save_snapshot', gerrit.snapshot.save)
+
+    instrumentation.measure('evaluate', evaluate_changesets, gerrit, changesets, state)
+    if gerrit.shard:
+        # the merge step creates the parent repos and writes the datasets
+        instrumentation.measure('save_partial', gerrit.shard.save, gerrit, determine_fingerprint(settings))
+        write_reports(args)
+        successful_exit()
+        return
 
-    logging.info('Successfully parsed changesets data.')
     # create datasets that are collections of repositories
-    create_aggregate_dataset(gerrit)
+    instrumentation.measure('aggregate', create_aggregate_dataset, gerrit)
+    if state:
+        state.determine_affected_parents(gerrit)
 
-    for repo in gerrit.repos.itervalues():
-#        if repo.name == 'mediawiki':
-#            change_ids = list(repo.observations[yesterday.date()].changeset_ids)
-#            change_ids.sort()
-#            fh = open('/Users/diederik/Development/gerrit-stats/gerritstats/tests/backlog_gerrit-stats.txt','w')
-#            for change_id in change_ids:
-#                print change_id
-#                fh.write('%s\n' % change_id)
-#            fh.close()
-        repo.fill_in_missing_days()
-        repo.create_headings()
-        repo.prune_observations()
-        repo.write_dataset(gerrit)
+    instrumentation.measure('finalize', finalize_repos, gerrit, state, gerrit.workers)
+    # only now that every dataset has been written, remove the datasets of
+    # repos that no longer exist. A backfill does not write every dataset.
+    if not gerrit.backfill:
+        instrumentation.measure('remove_stale', gerrit.writer.remove_stale)
 
     # save results for future use.
+    if gerrit.incremental:
+        instrumentation.measure('save_state', state.save, gerrit, yesterday)
+
+    write_reports(args)
+
+    if stream:
+        state.affected.clear()
+        run_realtime(gerrit, stream, changesets, accounts, state)
     successful_exit()
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Check the --append mode against full runs over a synthetic reviewdb (see
+reviewdb.py):
+
+1. after a full run the reviewdb gets new changes with reviews and merges,
+   and reviews that arrived late for days inside --rewrite-days, a run with
+   --append a few days later has to write the same datasets as a full run.
+   Only changes that were last updated inside --rewrite-days get a late
+   review, an update of an older change can change the days since its
+   previous update and these are only picked up by a run without --append;
+2. datafiles whose header or first day no longer match the observations
+   have to be rewritten completely by a run with --append.
+
+For testing purposes only.
+
+Example:
+    python append.py --changes 20000 --days 3
+'''
+
+import os
+import sys
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+from developer import AccountRegistry
+from reviewdb import ReviewDb
+from phases import SyntheticGerrit, default_settings
+from events import EventGenerator
+from helpers import create_options, compare_directories, add_late_reviews
+
+
+def run(db, settings, options):
+    '''
+    Run gerrit-stats with the clock set to --as-of, without the window that
+    --as-of implies.
+    '''
+    gerrit = SyntheticGerrit(options, settings, db)
+    gerrit.backfill = None
+    gerrit.fetch_repos()
+    cur = db.cursor()
+    accounts = stats.load_account_data(cur, AccountRegistry(settings))
+    changesets = stats.load_commit_data(cur, {}, accounts, None, None, None, gerrit.clock)
+    changesets = stats.load_patch_set_data(cur, changesets)
+    changesets = stats.load_review_data(cur, changesets, accounts)
+    stats.evaluate_changesets(gerrit, changesets)
+    stats.create_aggregate_dataset(gerrit)
+    stats.finalize_repos(gerrit, None, gerrit.workers)
+    gerrit.writer.remove_stale()
+    return gerrit
+
+
+def list_datafiles(datasets):
+    paths = []
+    for root, dirnames, filenames in os.walk(os.path.join(datasets, 'datafiles')):
+        paths.extend(os.path.join(root, filename) for filename in filenames)
+    return sorted(paths)
+
+
+def damage(paths, rnd):
+    '''
+    Add a column to the header of some datafiles and drop the first row of
+    others, both have to be rewritten completely.
+    '''
+    damaged = []
+    for path in paths:
+        lines = open(path).readlines()
+        action = rnd.choice(['header', 'first_row', None, None])
+        if action == 'header':
+            lines[0] = lines[0].rstrip('\n') + ',removed_metric\n'
+        elif action == 'first_row' and len(lines) > 2:
+            del lines[1]
+        else:
+            continue
+        open(path, 'w').write(''.join(lines))
+        damaged.append(path)
+    return damaged
+
+
+def compare(left, right):
+    differences = []
+    for folder in ['datafiles', 'datasources']:
+        differences.extend(compare_directories(os.path.join(left, folder), os.path.join(right, folder)))
+    for path in differences:
+        print 'Different: %s' % path
+    assert not differences, '%s files are different.' % len(differences)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare datasets written with --append with full runs.')
+    parser.add_argument('--changes', type=int, default=20000)
+    parser.add_argument('--events', type=int, default=300)
+    parser.add_argument('--late-reviews', type=int, default=20)
+    parser.add_argument('--rewrite-days', type=int, default=7)
+    parser.add_argument('--days', help='Number of days between the full run and the run with --append.', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--settings', default=default_settings)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rnd = random.Random(args.seed)
+    end = datetime.combine(date.today() - timedelta(days=10), datetime.min.time())
+    db = ReviewDb(args.changes, args.seed, end)
+    updated = ReviewDb(args.changes, args.seed, end)
+    since = end - timedelta(days=args.rewrite_days)
+    generator = EventGenerator(updated, args.seed)
+    # the events only update the changes that they create
+    generator.open = []
+    generator.generate(args.events)
+    # the reviews arrive after the full run but are granted inside the days
+    # that --append rewrites
+    add_late_reviews(updated, end - timedelta(days=3), end + timedelta(days=1), args.late_reviews, rnd, since)
+    later = end.date() + timedelta(days=args.days)
+    assert updated.tables['changes'][-1][1] < datetime.combine(later, datetime.min.time()), 'Too many events for %s days.' % args.days
+
+    settings = stats.load_settings(argparse.Namespace(settings=args.settings))
+    directories = dict((name, tempfile.mkdtemp(prefix='gerrit-stats-%s-' % name))
+                       for name in ['append', 'full'])
+    try:
+        run(db, settings, create_options(directories['append'], as_of=end.date()))
+        paths = list_datafiles(directories['append'])
+        inodes = dict((path, os.stat(path).st_ino) for path in paths)
+        run(updated, settings, create_options(directories['append'], as_of=later, append=True, rewrite_days=args.rewrite_days))
+        run(updated, settings, create_options(directories['full'], as_of=later))
+        compare(directories['append'], directories['full'])
+        appended = len([path for path in paths if os.path.exists(path) and os.stat(path).st_ino == inodes[path]])
+        assert appended, 'No datafile was appended to.'
+        print 'Appended %s days in place to %s of %s datafiles, the others changed inside the rewritten days.' % (args.days, appended, len(paths))
+
+        damaged = damage(list_datafiles(directories['append']), rnd)
+        run(updated, settings, create_options(directories['append'], as_of=later, append=True, rewrite_days=args.rewrite_days))
+        compare(directories['append'], directories['full'])
+        print 'Rewrote the %s datafiles whose header or first day did not match.' % len(damaged)
+        print 'The datasets written with --append are identical to full runs.'
+    finally:
+        for directory in directories.itervalues():
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Check the backfill of a window of days against full runs over a synthetic
+reviewdb (see reviewdb.py):
+
+1. the rows of a window are damaged in the datafiles of a full run, a
+   backfill of that window has to restore the datafiles of the full run;
+2. a backfill --as-of an earlier date into an empty directory has to write
+   the same datasets as a full run with the clock set to that date over the
+   changesets that were created before that date.
+
+For testing purposes only.
+
+Example:
+    python backfill.py --changes 5000 --since 2012-06-01 --until 2012-06-14
+'''
+
+import os
+import sys
+import copy
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+from utils import parse_date
+from developer import AccountRegistry
+from reviewdb import ReviewDb
+from phases import SyntheticGerrit, default_settings
+from helpers import create_options, compare_directories
+
+
+def run(db, settings, options, full=False):
+    '''
+    Run gerrit-stats, with @full the window that --as-of implies is dropped
+    so that only the clock is set.
+    '''
+    gerrit = SyntheticGerrit(options, settings, db)
+    if full:
+        gerrit.backfill = None
+    gerrit.fetch_repos()
+    cur = db.cursor()
+    accounts = stats.load_account_data(cur, AccountRegistry(settings))
+    changesets = stats.load_commit_data(cur, {}, accounts, None, None, gerrit.backfill, gerrit.clock)
+    changesets = stats.load_patch_set_data(cur, changesets, None, None, gerrit.backfill)
+    changesets = stats.load_review_data(cur, changesets, accounts, None, None, gerrit.backfill)
+    stats.evaluate_changesets(gerrit, changesets)
+    stats.create_aggregate_dataset(gerrit)
+    stats.finalize_repos(gerrit, None, gerrit.workers)
+    return gerrit, len(changesets)
+
+
+def truncate(db, as_of):
+    '''
+    Drop the changes that were created on or after @as_of from @db.
+    '''
+    end = datetime.combine(as_of, datetime.min.time())
+    created_on = db.index['changes']['created_on']
+    change_id = db.index['changes']['change_id']
+    change_ids = set([row[change_id] for row in db.tables['changes'] if row[created_on] < end])
+    truncated = copy.copy(db)
+    truncated.tables = dict((table, db.filter(table, change_ids) if table != 'accounts' else rows)
+                            for table, rows in db.tables.iteritems())
+    return truncated
+
+
+def damage(datasets, since, until, rnd):
+    '''
+    Zero, remove or duplicate the rows of the days from @since up to and
+    including @until in every datafile.
+    '''
+    first = since.strftime('%Y/%m/%d')
+    last = until.strftime('%Y/%m/%d')
+    damaged = 0
+    for root, dirnames, filenames in os.walk(os.path.join(datasets, 'datafiles')):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            lines = open(path).readlines()
+            result = lines[:1]
+            for line in lines[1:]:
+                if first <= line[:10] <= last:
+                    damaged += 1
+                    action = rnd.choice(['zero', 'remove', 'duplicate'])
+                    if action == 'zero':
+                        line = line[:10] + ',0' * line.count(',') + '\n'
+                    elif action == 'duplicate':
+                        result.append(line)
+                    else:
+                        continue
+                result.append(line)
+            open(path, 'w').write(''.join(result))
+    return damaged
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare backfilled datasets with full runs.')
+    parser.add_argument('--changes', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--since', type=parse_date, default=date(2012, 6, 1))
+    parser.add_argument('--until', type=parse_date, default=date(2012, 6, 14))
+    parser.add_argument('--as-of', type=parse_date, default=date(2012, 9, 1))
+    parser.add_argument('--settings', default=default_settings)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    db = ReviewDb(args.changes, args.seed)
+    settings = stats.load_settings(argparse.Namespace(settings=args.settings))
+    directories = dict((name, tempfile.mkdtemp(prefix='gerrit-stats-%s-' % name))
+                       for name in ['full', 'backfill', 'as-of-full', 'as-of-backfill'])
+    try:
+        full, loaded = run(db, settings, create_options(directories['full']))
+        shutil.rmtree(directories['backfill'])
+        shutil.copytree(directories['full'], directories['backfill'])
+        damaged = damage(directories['backfill'], args.since, args.until, random.Random(args.seed))
+        backfill, backfilled = run(db, settings, create_options(directories['backfill'], since=args.since, until=args.until))
+        print 'Damaged %s rows, the backfill loaded %s of %s changesets and wrote %s files.' % (damaged, backfilled, loaded, backfill.writer.written)
+        differences = []
+        for folder in ['datafiles', 'datasources']:
+            differences.extend(compare_directories(os.path.join(directories['full'], folder),
+                                                   os.path.join(directories['backfill'], folder)))
+
+        run(truncate(db, args.as_of), settings, create_options(directories['as-of-full'], as_of=args.as_of), full=True)
+        as_of, backfilled = run(db, settings, create_options(directories['as-of-backfill'], as_of=args.as_of))
+        print 'The backfill as of %s loaded %s of %s changesets.' % (args.as_of, backfilled, loaded)
+        for folder in ['datafiles', 'datasources']:
+            differences.extend(compare_directories(os.path.join(directories['as-of-full'], folder),
+                                                   os.path.join(directories['as-of-backfill'], folder)))
+        for path in differences:
+            print 'Different: %s' % path
+        assert not differences, '%s files are different.' % len(differences)
+        print 'The backfilled datasets are identical to the full runs.'
+    finally:
+        for directory in directories.itervalues():
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
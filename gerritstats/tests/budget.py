@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Check that an out-of-core run over a synthetic reviewdb (see reviewdb.py)
+writes the same datasets as a regular run. The memory budget is set to the
+current memory usage plus --spare megabytes, so the changesets have to be
+split over several partitions. For testing purposes only.
+
+Example:
+    python budget.py --changes 20000 --spare 8 --workers 2
+'''
+
+import os
+import sys
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+from developer import AccountRegistry
+from instrumentation import determine_rss
+from reviewdb import ReviewDb
+from phases import SyntheticGerrit, default_settings
+from helpers import create_options, compare_directories
+
+
+def run(db, settings, options):
+    gerrit = SyntheticGerrit(options, settings, db)
+    gerrit.fetch_repos()
+    cur = db.cursor()
+    accounts = stats.load_account_data(cur, AccountRegistry(settings))
+    changesets = stats.load_commit_data(cur, {}, accounts, None, None, None, gerrit.clock)
+    changesets = stats.load_patch_set_data(cur, changesets)
+    changesets = stats.load_review_data(cur, changesets, accounts)
+    stats.evaluate_changesets(gerrit, changesets)
+    stats.create_aggregate_dataset(gerrit)
+    stats.finalize_repos(gerrit, None, gerrit.workers)
+
+
+def run_out_of_core(db, settings, options):
+    gerrit = SyntheticGerrit(options, settings, db)
+    gerrit.fetch_repos()
+    cur = db.cursor()
+    accounts = stats.load_account_data(cur, AccountRegistry(settings))
+    return stats.run_out_of_core(gerrit, cur, accounts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the datasets of an out-of-core run with a regular run.')
+    parser.add_argument('--changes', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--spare', type=int, default=8, help='The number of megabytes of the budget on top of the current memory usage.')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--settings', default=default_settings)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    db = ReviewDb(args.changes, args.seed)
+    settings = stats.load_settings(argparse.Namespace(settings=args.settings))
+    directories = dict((name, tempfile.mkdtemp(prefix='gerrit-stats-%s-' % name))
+                       for name in ['regular', 'budget'])
+    try:
+        run(db, settings, create_options(directories['regular']))
+        memory_budget = determine_rss() / 1048576 + args.spare
+        runs = run_out_of_core(db, settings, create_options(directories['budget'], memory_budget=memory_budget, workers=args.workers))
+        print 'The out-of-core run with a memory budget of %s MB spilled %s runs.' % (memory_budget, runs)
+        assert runs > 1, 'The changesets were not split, lower --spare.'
+        assert sorted(os.listdir(directories['budget'])) == ['datafiles', 'datasources', 'my.cnf'], 'The runs were not removed.'
+        differences = []
+        for folder in ['datafiles', 'datasources']:
+            differences.extend(compare_directories(os.path.join(directories['regular'], folder),
+                                                   os.path.join(directories['budget'], folder)))
+        for path in differences:
+            print 'Different: %s' % path
+        assert not differences, '%s files are different.' % len(differences)
+        print 'The datasets of the out-of-core run are identical to the regular run.'
+    finally:
+        for directory in directories.itervalues():
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
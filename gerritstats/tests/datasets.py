@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Check how the DatasetWriter (see writer.py) treats existing datasets, using a
+synthetic reviewdb (see reviewdb.py):
+
+1. a second run over the same reviewdb does not write any file, the
+   modification times stay the same and every file is counted as unchanged;
+2. the files of a repo that no longer exists are only removed by
+   remove_stale, together with the directories that become empty;
+3. a run that fails while writing the datasets leaves the existing files
+   of the failed repo and of the removed repos in place and does not leave
+   partial files behind.
+
+For testing purposes only.
+
+Example:
+    python datasets.py --changes 5000
+'''
+
+import os
+import sys
+import copy
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+from developer import AccountRegistry
+from reviewdb import ReviewDb
+from phases import SyntheticGerrit, default_settings
+from helpers import create_options
+
+# an arbitrary modification time in the past
+mtime = 1000000000
+
+
+def run(db, settings, datasets, broken=None):
+    '''
+    Run gerrit-stats without removing the stale files, writing the datasets
+    of repo @broken fails halfway.
+    '''
+    gerrit = SyntheticGerrit(create_options(datasets), settings, db)
+    gerrit.fetch_repos()
+    cur = db.cursor()
+    accounts = stats.load_account_data(cur, AccountRegistry(settings))
+    changesets = stats.load_commit_data(cur, {}, accounts, None, None, None, gerrit.clock)
+    changesets = stats.load_patch_set_data(cur, changesets)
+    changesets = stats.load_review_data(cur, changesets, accounts)
+    stats.evaluate_changesets(gerrit, changesets)
+    stats.create_aggregate_dataset(gerrit)
+    if broken:
+        repo = gerrit.repos[broken]
+        create_dataset = repo.create_dataset
+
+        def fail(since=None):
+            rows = create_dataset(since)
+            yield rows.next()
+            raise IOError('No space left on device')
+        repo.create_dataset = fail
+    stats.finalize_repos(gerrit)
+    return gerrit
+
+
+def list_files(datasets):
+    paths = []
+    for folder in ['datafiles', 'datasources']:
+        for root, dirnames, filenames in os.walk(os.path.join(datasets, folder)):
+            paths.extend(os.path.join(root, filename) for filename in filenames)
+    return sorted(paths)
+
+
+def read_files(paths):
+    return dict((path, open(path, 'rb').read()) for path in paths)
+
+
+def find_repo(gerrit):
+    '''
+    A repo that is not a parent and has a datafile.
+    '''
+    for name, repo in sorted(gerrit.repos.iteritems()):
+        if not repo.is_parent and os.path.exists(repo.full_csv_path):
+            return repo
+    raise AssertionError('No repo has a datafile.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that unchanged datasets are kept and stale datasets are removed.')
+    parser.add_argument('--changes', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--settings', default=default_settings)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    db = ReviewDb(args.changes, args.seed)
+    settings = stats.load_settings(argparse.Namespace(settings=args.settings))
+    datasets = tempfile.mkdtemp(prefix='gerrit-stats-datasets-')
+    try:
+        gerrit = run(db, settings, datasets)
+        gerrit.writer.remove_stale()
+        paths = list_files(datasets)
+        for path in paths:
+            os.utime(path, (mtime, mtime))
+
+        gerrit = run(db, settings, datasets)
+        assert gerrit.writer.remove_stale() == 0, 'The second run removed files.'
+        assert gerrit.writer.written == 0, 'The second run wrote %s files.' % gerrit.writer.written
+        assert gerrit.writer.unchanged == len(paths), '%s of %s files were unchanged.' % (gerrit.writer.unchanged, len(paths))
+        touched = [path for path in paths if os.path.getmtime(path) != mtime]
+        assert not touched, '%s files were written: %s' % (len(touched), ', '.join(touched))
+        print 'A second run kept all %s files.' % len(paths)
+
+        repo = find_repo(gerrit)
+        vanished = [repo.full_csv_path, os.path.join(repo.yaml_directory, '%s.yaml' % repo.determine_filename())]
+        directories = repo.determine_directories()
+        removed = copy.copy(db)
+        removed.projects = [project for project in db.projects if project != repo.name]
+        gerrit = run(removed, settings, datasets)
+        assert all([os.path.exists(path) for path in vanished]), 'The files of %s were removed before remove_stale.' % repo.name
+        assert gerrit.writer.remove_stale() == len(vanished), 'remove_stale did not only remove the files of %s.' % repo.name
+        assert not any([os.path.exists(path) for path in vanished]), 'The files of %s were not removed.' % repo.name
+        assert not any([os.path.exists(directory) for directory in directories]), 'The directories of %s were not removed.' % repo.name
+        assert list_files(datasets) == sorted(set(paths) - set(vanished)), 'Other files were added or removed.'
+        print 'remove_stale removed the files and directories of %s.' % repo.name
+
+        before = read_files(list_files(datasets))
+        repo = find_repo(gerrit)
+        # other changes in the same repos
+        changed = ReviewDb(args.changes, args.seed + 1)
+        changed.projects = removed.projects
+        try:
+            run(changed, settings, datasets, repo.name)
+            raise AssertionError('Writing the datasets of %s did not fail.' % repo.name)
+        except SystemExit:
+            pass
+        after = read_files(list_files(datasets))
+        assert sorted(after) == sorted(before), 'The failed run added or removed files.'
+        assert after[repo.full_csv_path] == before[repo.full_csv_path], 'The failed run changed the datafile of %s.' % repo.name
+        print 'The failed run left the existing files in place, %s of %s files were replaced.' % (len([path for path in before if before[path] != after[path]]), len(before))
+    finally:
+        shutil.rmtree(datasets)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Check the real-time mode against a batch run. A synthetic reviewdb (see
+reviewdb.py) ends a couple of days ago, a stream of gerrit stream-events
+covering the days since then is generated and the same changes are applied to
+a copy of the reviewdb. The events are served by the fake Gerrit server of
+fakessh.py in small chunks while the datasets are flushed a couple of times.
+The datasets written by the real-time mode have to be identical to the
+datasets of a batch run over the updated reviewdb. For testing purposes only.
+
+Example:
+    python events.py --changes 2000 --events 300
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import calendar
+import tempfile
+
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+from state import State
+from developer import AccountRegistry
+from realtime import EventProcessor
+from reviewdb import ReviewDb, bots
+from phases import SyntheticGerrit, default_settings
+from fakessh import FakeGerritServer
+from helpers import create_options, compare_directories
+
+
+def to_timestamp(moment):
+    return calendar.timegm(moment.utctimetuple())
+
+
+class EventGenerator(object):
+    '''
+    Generates events and applies the same changes to the tables of @db, the
+    way Gerrit would update the reviewdb.
+    '''
+    def __init__(self, db, seed):
+        self.db = db
+        self.rnd = random.Random(seed)
+        self.moment = db.end
+        self.changes = db.index['changes']
+        self.accounts = dict((row[15], {'name': row[1], 'email': row[2]}) for row in db.tables['accounts'])
+        self.votes = set((row[4], row[5], row[6], row[7]) for row in db.tables['patch_set_approvals'])
+        self.open = [row[self.changes['change_id']] for row in db.tables['changes']
+                     if row[self.changes['status']] == 'n']
+
+    def get_change(self, change_id):
+        return self.db.tables['changes'][change_id - 1]
+
+    def update_change(self, change_id, **values):
+        row = list(self.get_change(change_id))
+        for column, value in values.iteritems():
+            row[self.changes[column]] = value
+        self.db.tables['changes'][change_id - 1] = tuple(row)
+
+    def describe_change(self, change_id):
+        row = self.get_change(change_id)
+        return {
+            'project': row[self.changes['dest_project_name']],
+            'branch': row[self.changes['dest_branch_name']],
+            'id': row[self.changes['change_key']],
+            'number': str(change_id),
+            'subject': row[self.changes['subject']],
+            'owner': self.accounts[row[self.changes['owner_account_id']]],
+        }
+
+    def describe_patch_set(self, change_id):
+        row = self.get_change(change_id)
+        return {'number': str(row[self.changes['nbr_patch_sets']]),
+                'revision': '%040x' % self.rnd.getrandbits(160)}
+
+    def tick(self):
+        self.moment += timedelta(seconds=self.rnd.randint(60, 600))
+        return to_timestamp(self.moment)
+
+    def create_change(self):
+        timestamp = self.tick()
+        change_id = len(self.db.tables['changes']) + 1
+        owner = self.rnd.choice(self.db.humans)
+        project = self.rnd.choice(self.db.projects)
+        self.db.tables['changes'].append(('I%040x' % self.rnd.getrandbits(160),
+            self.moment, self.moment, '%016x' % change_id, owner, project,
+            'master', 'Y', 'n', 1, 1, 'Realtime change %s' % change_id, None,
+            1, change_id, None, 'Y'))
+        self.open.append(change_id)
+        return self.create_patch_set(change_id, timestamp)
+
+    def create_patch_set(self, change_id, timestamp):
+        row = self.get_change(change_id)
+        patch_set = self.describe_patch_set(change_id)
+        patch_set['createdOn'] = timestamp
+        patch_set['uploader'] = self.accounts[row[self.changes['owner_account_id']]]
+        self.db.tables['patch_sets'].append((patch_set['revision'],
+            row[self.changes['owner_account_id']], self.moment, change_id,
+            int(patch_set['number']), 'N'))
+        return {'type': 'patchset-created', 'change': self.describe_change(change_id),
+                'patchSet': patch_set, 'uploader': patch_set['uploader']}
+
+    def add_patch_set(self, change_id):
+        timestamp = self.tick()
+        nbr_patch_sets = self.get_change(change_id)[self.changes['nbr_patch_sets']] + 1
+        self.update_change(change_id, nbr_patch_sets=nbr_patch_sets,
+                           current_patch_set_id=nbr_patch_sets, last_updated_on=self.moment)
+        return self.create_patch_set(change_id, timestamp)
+
+    def add_comment(self, change_id):
+        timestamp = self.tick()
+        account_id = self.rnd.randint(1, len(self.accounts))
+        patch_set = self.describe_patch_set(change_id)
+        patch_set_id = int(patch_set['number'])
+        category_id = 'VRIF' if account_id <= len(bots) else self.rnd.choice(['CRVW', 'CRVW', 'VRIF', None])
+        approvals = []
+        # a vote that replaces an earlier vote replaces its row in the
+        # reviewdb, this is only corrected by the next batch run
+        if category_id and (change_id, patch_set_id, account_id, category_id) not in self.votes:
+            value = self.rnd.choice([-2, -1, 1, 2, 2]) if category_id == 'CRVW' else self.rnd.choice([-1, 1])
+            self.votes.add((change_id, patch_set_id, account_id, category_id))
+            self.db.tables['patch_set_approvals'].append((value, self.moment, 'Y',
+                '%016x' % change_id, change_id, patch_set_id, account_id, category_id))
+            approvals.append({'type': 'Code-Review' if category_id == 'CRVW' else 'Verified',
+                              'value': str(value), 'oldValue': '0'})
+        self.update_change(change_id, last_updated_on=self.moment)
+        return {'type': 'comment-added', 'change': self.describe_change(change_id),
+                'patchSet': patch_set, 'author': self.accounts[account_id],
+                'approvals': approvals, 'comment': 'Patch Set %s' % patch_set_id,
+                'eventCreatedOn': timestamp}
+
+    def close_change(self, change_id, status):
+        timestamp = self.tick()
+        self.update_change(change_id, status=status, open='N', last_updated_on=self.moment)
+        self.open.remove(change_id)
+        return {'type': 'change-merged' if status == 'M' else 'change-abandoned',
+                'change': self.describe_change(change_id),
+                'patchSet': self.describe_patch_set(change_id),
+                'eventCreatedOn': timestamp}
+
+    def generate(self, number):
+        events = []
+        for x in xrange(number):
+            kind = self.rnd.choice(['create', 'patch_set', 'comment', 'comment',
+                                    'comment', 'merge', 'abandon', 'ref'])
+            if kind == 'create' or not self.open:
+                events.append(self.create_change())
+                continue
+            change_id = self.rnd.choice(self.open)
+            if kind == 'patch_set':
+                events.append(self.add_patch_set(change_id))
+            elif kind == 'comment':
+                events.append(self.add_comment(change_id))
+            elif kind == 'merge':
+                events.append(self.close_change(change_id, 'M'))
+            elif kind == 'abandon':
+                events.append(self.close_change(change_id, 'A'))
+            else:
+                # events that do not change a changeset are ignored
+                events.append({'type': 'ref-updated', 'refUpdate': {'project': 'mediawiki/core'},
+                               'eventCreatedOn': self.tick()})
+        self.db.tables['patch_set_approvals'].sort(key=lambda row: row[1])
+        return events
+
+
+def stream_events(events, rnd):
+    '''
+    Send the events in chunks that do not respect line boundaries, with a
+    pause now and then so that the datasets are flushed in between.
+    '''
+    output = ''.join(['%s\n' % json.dumps(event) for event in events])
+    while output:
+        size = rnd.randint(1, 600)
+        yield output[:size]
+        output = output[size:]
+        if rnd.random() < 0.05:
+            time.sleep(0.1)
+
+
+def run(db, settings, options):
+    gerrit = SyntheticGerrit(options, settings, db)
+    gerrit.fetch_repos()
+    stream = gerrit.open_event_stream() if gerrit.realtime else None
+    cur = db.cursor()
+    accounts = stats.load_account_data(cur, AccountRegistry(settings))
+    changesets = stats.load_commit_data(cur, {}, accounts, clock=gerrit.clock)
+    changesets = stats.load_patch_set_data(cur, changesets)
+    changesets = stats.load_review_data(cur, changesets, accounts)
+    state = State(gerrit, settings) if stream else None
+    stats.evaluate_changesets(gerrit, changesets, state)
+    stats.create_aggregate_dataset(gerrit)
+    stats.finalize_repos(gerrit, state, gerrit.workers)
+    gerrit.writer.remove_stale()
+    if stream:
+        state.affected.clear()
+        processor = EventProcessor(gerrit, changesets, accounts, state, stats.update_datasets)
+        processor.run(stream, gerrit.flush_interval, reconnect=False)
+        stream.session.close()
+        return processor
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the datasets of the real-time mode with a batch run.')
+    parser.add_argument('--changes', type=int, default=2000)
+    parser.add_argument('--events', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--flush-interval', type=float, default=0.2)
+    parser.add_argument('--settings', default=default_settings)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # the events happen during the last two full days
+    end = datetime.combine(date.today() - timedelta(days=3), datetime.min.time())
+    db = ReviewDb(args.changes, args.seed, end)
+    updated = ReviewDb(args.changes, args.seed, end)
+    events = EventGenerator(updated, args.seed).generate(args.events)
+    assert updated.tables['changes'][-1][1] < end + timedelta(days=2), 'Too many events for two days.'
+
+    rnd = random.Random(args.seed)
+    server = FakeGerritServer({'gerrit stream-events': lambda: stream_events(events, rnd)}).start()
+    settings = stats.load_settings(argparse.Namespace(settings=args.settings))
+    settings.update({'host': server.host, 'port': server.port})
+    realtime = tempfile.mkdtemp(prefix='gerrit-stats-realtime-')
+    batch = tempfile.mkdtemp(prefix='gerrit-stats-batch-')
+    try:
+        start = time.time()
+        processor = run(db, settings, create_options(realtime, realtime=True, flush_interval=args.flush_interval, ssh_username='gerrit-stats', ssh_password='secret'))
+        print 'Applied %s events in %.2fs, %s unknown accounts.' % (len(events), time.time() - start, processor.accounts.unknown)
+        run(updated, settings, create_options(batch))
+        differences = []
+        for folder in ['datafiles', 'datasources']:
+            differences.extend(compare_directories(os.path.join(realtime, folder), os.path.join(batch, folder)))
+        for path in differences:
+            print 'Different: %s' % path
+        assert not differences, '%s files are different.' % len(differences)
+        print 'The real-time datasets are identical to the batch datasets.'
+    finally:
+        shutil.rmtree(realtime)
+        shutil.rmtree(batch)
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
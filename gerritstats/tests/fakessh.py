@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+A local SSH server that stands in for the Gerrit server. It accepts any
+username and password and answers commands from a dictionary of command ->
+output, so SSHSession, ProjectCache and Gerrit.fetch_repos can be exercised
+without access to gerrit.wikimedia.org. Running this file starts the server,
+connects to it a couple of times and checks that all commands share a single
+connection and that a cached project list skips SSH altogether. For testing
+purposes only.
+'''
+
+import os
+import sys
+import time
+import socket
+import shutil
+import logging
+import tempfile
+import threading
+import argparse
+import paramiko
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ssh import SSHSession, CommandError
+from gerrit import Gerrit
+from helpers import create_options
+
+projects = [
+    'analytics/gerrit-stats - Gerrit statistics',
+    'mediawiki/core - MediaWiki core',
+    'mediawiki/extensions/Cite - Cite extension',
+    'operations/puppet - Puppet manifests',
+]
+
+
+class CommandHandler(paramiko.ServerInterface):
+    def __init__(self, server):
+        self.server = server
+        self.commands = {}
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.server.answer, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class FakeGerritServer(object):
+    '''
+    @param commands: a dictionary where the key is a command and the value
+    its output, either a string or a callable that returns a string or an
+    iterable of strings. An iterable is sent a string at a time, which is how
+    gerrit stream-events behaves. Unknown commands write an error to stderr
+    and exit with status 1, like Gerrit.
+    @type commands: dict
+
+    @param connections: the number of SSH connections that were accepted.
+    @type connections: int
+
+    @param executed: the commands that were run, in the order they arrived.
+    @type executed: list
+    '''
+    def __init__(self, commands=None, host='127.0.0.1', port=0):
+        self.commands = commands or {}
+        self.key = paramiko.RSAKey.generate(1024)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(5)
+        self.host, self.port = self.socket.getsockname()
+        self.connections = 0
+        self.executed = []
+        self.transports = []
+        self.running = False
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def serve(self):
+        while self.running:
+            try:
+                client, address = self.socket.accept()
+            except socket.error:
+                break
+            self.connections += 1
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.key)
+            transport.start_server(server=CommandHandler(self))
+            self.transports.append(transport)
+
+    def answer(self, channel, command):
+        # paramiko only confirms the exec request after check_channel_exec_request
+        # returns, closing the channel before that makes the client fail.
+        time.sleep(0.05)
+        self.executed.append(command)
+        output = self.commands.get(command)
+        if output is None:
+            channel.sendall_stderr('fatal: %s: not found\n' % command)
+            channel.send_exit_status(1)
+        else:
+            if callable(output):
+                output = output()
+            if isinstance(output, basestring):
+                output = [output]
+            for chunk in output:
+                channel.sendall(chunk)
+            channel.send_exit_status(0)
+        channel.close()
+
+    def stop(self):
+        self.running = False
+        for transport in self.transports:
+            transport.close()
+        self.socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exercise SSHSession and the project cache against a local fake Gerrit server.')
+    parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    listing = ''.join(['%s\n' % project for project in projects])
+    server = FakeGerritServer({
+        'gerrit ls-projects -d': listing,
+        'gerrit version': 'gerrit version 2.4.2\n',
+    }).start()
+
+    session = SSHSession(server.host, server.port, username='gerrit-stats', password='secret')
+    outputs = session.run_many(['gerrit ls-projects -d', 'gerrit version', 'gerrit version'])
+    assert ''.join(outputs[0]) == listing
+    assert outputs[1] == ['gerrit version 2.4.2\n']
+    try:
+        session.run('gerrit unknown-command')
+        raise AssertionError('gerrit unknown-command should have failed')
+    except CommandError:
+        pass
+    assert server.connections == 1, server.connections
+    print 'Ran %s commands over %s connection.' % (len(server.executed), server.connections)
+
+    datasets = tempfile.mkdtemp(prefix='gerrit-stats-fakessh-')
+    try:
+        args = create_options(datasets, projects_ttl=3600, ssh_username='gerrit-stats', ssh_password='secret')
+        settings = {'host': server.host, 'port': server.port, 'ignore_repos': ['operations'],
+                    'parents': [], 'creation_date': None}
+        for run in xrange(2):
+            gerrit = Gerrit(args, settings)
+            gerrit.fetch_repos()
+            gerrit.close()
+            assert sorted(gerrit.repos) == ['analytics/gerrit-stats', 'mediawiki/core', 'mediawiki/extensions/Cite'], sorted(gerrit.repos)
+        assert server.connections == 2, server.connections
+        print 'Second run used the cached project list, %s connections in total.' % server.connections
+    finally:
+        shutil.rmtree(datasets)
+        session.close()
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
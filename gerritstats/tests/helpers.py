@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Helpers that are shared by the test scripts in this directory. For testing
+purposes only.
+'''
+
+import os
+import sys
+import filecmp
+
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+
+
+def create_options(datasets, **overrides):
+    '''
+    Construct the options of a run that writes its datasets to @datasets. The
+    options are the defaults of the command line of stats.py, an empty my.cnf
+    and the datafiles and datasources folders are created in @datasets.
+
+    @param overrides: the options that differ from the defaults, by their
+    attribute name, for example workers=2 for --workers 2.
+    @type overrides: dict
+    '''
+    my_cnf = os.path.join(datasets, 'my.cnf')
+    open(my_cnf, 'w').close()
+    for folder in ['datafiles', 'datasources']:
+        if not os.path.exists(os.path.join(datasets, folder)):
+            os.mkdir(os.path.join(datasets, folder))
+    options = stats.parse_commandline(['--datasets', datasets, '--sql', my_cnf])
+    for key, value in overrides.iteritems():
+        if not hasattr(options, key):
+            raise AttributeError('stats.py has no option %s' % key)
+        setattr(options, key, value)
+    return options
+
+
+def compare_directories(left, right):
+    '''
+    Return the paths of the files that are only present in, or differ between,
+    the directories @left and @right and their subdirectories.
+    '''
+    differences = []
+    comparison = filecmp.dircmp(left, right)
+    differences.extend(os.path.join(left, name) for name in comparison.left_only)
+    differences.extend(os.path.join(right, name) for name in comparison.right_only)
+    differences.extend(os.path.join(left, name) for name in comparison.funny_files)
+    match, mismatch, errors = filecmp.cmpfiles(left, right, comparison.common_files, shallow=False)
+    differences.extend(os.path.join(left, name) for name in mismatch + errors)
+    for name in comparison.common_dirs:
+        differences.extend(compare_directories(os.path.join(left, name), os.path.join(right, name)))
+    return differences
+
+
+def add_late_reviews(db, granted, arrived, number, rnd, since=None):
+    '''
+    Add @number code reviews that were granted on the day of @granted to the
+    first patch set of open changes that were created before @granted, but
+    only reached @db at @arrived: the changes are updated at @arrived, like a
+    replica of the reviewdb that catches up. Closed changes are left alone,
+    their last update ends the days on which they are counted. With @since
+    only the changes that were last updated on or after @since get a review,
+    so that no day before @since changes.
+    '''
+    changes = db.index['changes']
+    votes = set((row[4], row[5], row[6], row[7]) for row in db.tables['patch_set_approvals'])
+    candidates = [row[changes['change_id']] for row in db.tables['changes']
+                  if row[changes['created_on']] < granted and row[changes['open']] == 'Y'
+                  and (since is None or row[changes['last_updated_on']] >= since)]
+    added = 0
+    while added < number:
+        change_id = rnd.choice(candidates)
+        account_id = rnd.choice(db.humans)
+        if (change_id, 1, account_id, 'CRVW') in votes:
+            continue
+        votes.add((change_id, 1, account_id, 'CRVW'))
+        change = list(db.tables['changes'][change_id - 1])
+        moment = granted + timedelta(seconds=rnd.randint(0, 3600))
+        db.tables['patch_set_approvals'].append((rnd.choice([-2, -1, 1, 2]), moment,
+            change[changes['open']], change[changes['sort_key']], change_id, 1,
+            account_id, 'CRVW'))
+        change[changes['last_updated_on']] = max(change[changes['last_updated_on']], arrived)
+        db.tables['changes'][change_id - 1] = tuple(change)
+        added += 1
+    db.tables['patch_set_approvals'].sort(key=lambda row: row[1])
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Check incremental runs against full runs over a synthetic reviewdb (see
+reviewdb.py):
+
+1. after an incremental run without a previous state, which is a full run
+   that saves its state, the reviewdb gets new changes, reviews, merges,
+   abandons and reviews that arrived late. The next incremental run a few
+   days later only loads the changesets that were updated since the
+   watermark or are still open, and has to write the same datasets as a
+   full run;
+2. when the settings change, the state of the previous run cannot be used
+   and an incremental run has to do a full run.
+
+For testing purposes only.
+
+Example:
+    python incremental.py --changes 5000 --days 3
+'''
+
+import os
+import sys
+import copy
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+from state import State
+from developer import AccountRegistry
+from reviewdb import ReviewDb
+from phases import SyntheticGerrit, default_settings
+from events import EventGenerator
+from helpers import create_options, compare_directories, add_late_reviews
+
+
+def run(db, settings, options):
+    '''
+    Run gerrit-stats the way main does, with the clock set to --as-of but
+    without the window that --as-of implies. Returns whether the state of
+    the previous run was used and the number of changesets that were loaded.
+    '''
+    gerrit = SyntheticGerrit(options, settings, db)
+    gerrit.backfill = None
+    gerrit.fetch_repos()
+    state = None
+    loaded = False
+    if gerrit.incremental:
+        state = State(gerrit, settings)
+        loaded = state.load()
+        if loaded:
+            state.restore(gerrit)
+        else:
+            state = State(gerrit, settings)
+    else:
+        State(gerrit, settings).remove()
+    since = state.watermark if state else None
+    cur = db.cursor()
+    accounts = stats.load_account_data(cur, AccountRegistry(settings))
+    changesets = stats.load_commit_data(cur, {}, accounts, None, since, None, gerrit.clock)
+    changesets = stats.load_patch_set_data(cur, changesets, None, since)
+    changesets = stats.load_review_data(cur, changesets, accounts, None, since)
+    stats.evaluate_changesets(gerrit, changesets, state)
+    stats.create_aggregate_dataset(gerrit)
+    if state:
+        state.determine_affected_parents(gerrit)
+    stats.finalize_repos(gerrit, state, gerrit.workers)
+    gerrit.writer.remove_stale()
+    if state:
+        state.save(gerrit, gerrit.clock.yesterday)
+    return loaded, len(changesets)
+
+
+def compare(left, right):
+    differences = []
+    for folder in ['datafiles', 'datasources']:
+        differences.extend(compare_directories(os.path.join(left, folder), os.path.join(right, folder)))
+    for path in differences:
+        print 'Different: %s' % path
+    assert not differences, '%s files are different.' % len(differences)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the datasets of incremental runs with full runs.')
+    parser.add_argument('--changes', type=int, default=5000)
+    parser.add_argument('--events', type=int, default=300)
+    parser.add_argument('--late-reviews', type=int, default=50)
+    parser.add_argument('--days', help='Number of days between the two incremental runs.', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--settings', default=default_settings)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rnd = random.Random(args.seed)
+    end = datetime.combine(date.today() - timedelta(days=10), datetime.min.time())
+    db = ReviewDb(args.changes, args.seed, end)
+    updated = ReviewDb(args.changes, args.seed, end)
+    EventGenerator(updated, args.seed).generate(args.events)
+    # reviews of earlier days that only reach the reviewdb after the first run
+    add_late_reviews(updated, end - timedelta(days=20), end + timedelta(days=1), args.late_reviews, rnd)
+    later = end.date() + timedelta(days=args.days)
+    assert updated.tables['changes'][-1][1] < datetime.combine(later, datetime.min.time()), 'Too many events for %s days.' % args.days
+    total = len(updated.tables['changes'])
+
+    settings = stats.load_settings(argparse.Namespace(settings=args.settings))
+    directories = dict((name, tempfile.mkdtemp(prefix='gerrit-stats-%s-' % name))
+                       for name in ['incremental', 'full', 'changed-full'])
+    try:
+        loaded, number = run(db, settings, create_options(directories['incremental'], as_of=end.date(), incremental=True))
+        assert not loaded, 'The first incremental run found a state.'
+        loaded, number = run(updated, settings, create_options(directories['incremental'], as_of=later, incremental=True))
+        assert loaded, 'The second incremental run did not use the state of the first run.'
+        assert number < total, 'The second incremental run loaded all %s changesets.' % total
+        run(updated, settings, create_options(directories['full'], as_of=later))
+        compare(directories['incremental'], directories['full'])
+        print 'The incremental run %s days later loaded %s of %s changesets.' % (args.days, number, total)
+
+        changed = copy.deepcopy(settings)
+        changed['staff_emails'] = list(changed.get('staff_emails') or []) + ['developer%s@gmail.com' % account_id for account_id in updated.humans[:20]]
+        loaded, number = run(updated, changed, create_options(directories['incremental'], as_of=later, incremental=True))
+        assert not loaded and number == total, 'The incremental run used a state that was saved with other settings.'
+        run(updated, changed, create_options(directories['changed-full'], as_of=later))
+        compare(directories['incremental'], directories['changed-full'])
+        print 'The incremental run with changed settings was a full run.'
+        print 'The datasets of the incremental runs are identical to full runs.'
+    finally:
+        for directory in directories.itervalues():
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
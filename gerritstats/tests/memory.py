@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Measure how many bytes the Changeset object graph (including its patchsets,
+reviews and developers) takes per changeset. The rows only contain the columns
+that the queries in sql_queries.py select.
+
+For comparison the same changesets are also built as the object graph of the
+original loader: objects with an instance dictionary, every column of the
+SELECT * rows including the joined accounts columns, a Developer per
+changeset and per review, reviews in an OrderedDict keyed by a formatted
+string and no interned strings. For benchmarking purposes only.
+'''
+
+import os
+import sys
+import random
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from changeset import Changeset, Patchset, Review
+from developer import AccountRegistry
+from sql_queries import columns
+
+projects = ['mediawiki/core', 'mediawiki/extensions/Cite',
+            'mediawiki/extensions/Translate', 'operations/puppet',
+            'analytics/gerrit-stats']
+
+
+def project_row(row, *tables):
+    '''
+    Only keep the columns that the queries actually fetch. The values are
+    copied so every row has its own string objects, just like rows that come
+    from the database.
+    '''
+    selected = {}
+    for table in tables:
+        for column in columns[table]:
+            value = row.get(column)
+            if isinstance(value, str):
+                value = ''.join(list(value))
+            selected.setdefault(column, value)
+    return selected
+
+
+def create_account_rows(number):
+    rows = {}
+    for account_id in xrange(1, number + 1):
+        rows[account_id] = {
+            'account_id': account_id,
+            'full_name': 'Developer %s' % account_id,
+            'preferred_email': 'developer%s@%s' % (account_id, ['wikimedia.org', 'gmail.com'][account_id % 2]),
+            'registered_on': datetime(2011, 9, 7),
+        }
+    return rows
+
+
+def generate_rows(number, accounts, seed=0):
+    '''
+    Generate the rows of @number changesets as (change, [(patch_set,
+    [approval])]) tuples. The rows contain every column the original SELECT *
+    queries returned, including the columns of the joined accounts.
+    '''
+    rnd = random.Random(seed)
+    start = datetime(2011, 9, 7)
+    for change_id in xrange(1, number + 1):
+        created_on = start + timedelta(seconds=rnd.randint(0, 365 * 86400))
+        nbr_patch_sets = rnd.randint(1, 4)
+        change = dict(accounts[rnd.randint(1, len(accounts))])
+        change.update({
+            'change_id': change_id,
+            'change_key': 'I%040x' % rnd.getrandbits(160),
+            'created_on': created_on,
+            'last_updated_on': created_on + timedelta(days=rnd.randint(0, 30)),
+            'owner_account_id': change['account_id'],
+            'dest_project_name': rnd.choice(projects),
+            'dest_branch_name': 'master',
+            'open': 'N',
+            'status': rnd.choice(['M', 'A', 'n']),
+            'nbr_patch_sets': nbr_patch_sets,
+            'subject': 'Fix bug %s in the parser' % change_id,
+        })
+        patch_sets = []
+        for patch_set_id in xrange(1, nbr_patch_sets + 1):
+            patch_set = {
+                'change_id': change_id,
+                'patch_set_id': patch_set_id,
+                'revision': '%040x' % rnd.getrandbits(160),
+                'uploader_account_id': change['owner_account_id'],
+                'created_on': created_on + timedelta(hours=patch_set_id),
+                'draft': 'N',
+            }
+            approvals = []
+            for x in xrange(rnd.randint(0, 3)):
+                approval = dict(accounts[rnd.randint(1, len(accounts))])
+                approval.update({
+                    'change_id': change_id,
+                    'patch_set_id': patch_set_id,
+                    'category_id': rnd.choice(['CRVW', 'VRIF']),
+                    'value': rnd.choice([-2, -1, 1, 2]),
+                    'granted': created_on + timedelta(hours=patch_set_id, minutes=x),
+                })
+                approvals.append(approval)
+            patch_sets.append((patch_set, approvals))
+        yield change, patch_sets
+
+
+def create_changesets(number, seed=0, nbr_accounts=2000):
+    rows = create_account_rows(nbr_accounts)
+    accounts = AccountRegistry()
+    for row in rows.itervalues():
+        accounts.add(**project_row(row, 'accounts'))
+    changesets = {}
+    for change, patch_sets in generate_rows(number, rows, seed):
+        changeset = Changeset(accounts.get(change['account_id']), **project_row(change, 'changes'))
+        changesets[changeset.change_id] = changeset
+        for row, approvals in patch_sets:
+            patch_set = Patchset(**project_row(row, 'patch_sets'))
+            changeset.patch_sets[patch_set.patch_set_id] = patch_set
+            for approval in approvals:
+                review = Review(accounts.get(approval['account_id']), **project_row(approval, 'patch_set_approvals'))
+                patch_set.reviews.add(review)
+    return changesets
+
+
+class BaselineDeveloper(object):
+    def __init__(self, **kwargs):
+        self.full_name = kwargs.get('full_name')
+        self.preferred_email = kwargs.get('preferred_email', '')
+        self.registered_on = kwargs.get('registered_on')
+        self.account_id = kwargs.get('account_id')
+        self.staff = self.preferred_email.endswith('wikimedia.org')
+        self.human = True
+
+
+class BaselineChangeset(object):
+    def __init__(self, **kwargs):
+        self.created_on = kwargs.get('created_on')
+        self.owner_account_id = kwargs.get('owner_account_id')
+        self.dest_project_name = kwargs.get('dest_project_name')
+        self.dest_branch_name = kwargs.get('dest_branch_name')
+        self.change_id = kwargs.get('change_id')
+        self.last_updated_on = kwargs.get('last_updated_on')
+        self.change_key = kwargs.get('change_key')
+        self.subject = kwargs.get('subject')
+        self.nbr_patch_sets = kwargs.get('nbr_patch_sets')
+        self.status = kwargs.get('status')
+        self.patch_sets = OrderedDict()
+        self.open = kwargs.get('open') == 'Y'
+        self.merged = kwargs.get('status') == 'M'
+        self.self_review = False
+        self.repo_has_review = True
+        self.yesterday = datetime(2012, 9, 6, 23, 59, 59)
+        self.waiting_first_review = self.yesterday
+        self.waiting_plus2 = self.yesterday
+        self.merge_review = None
+        self.all_positive_reviews = None
+        self.author = BaselineDeveloper(**kwargs)
+
+
+class BaselinePatchset(object):
+    def __init__(self, **kwargs):
+        self.revision = kwargs.get('revision')
+        self.uploader_account_id = kwargs.get('uploader_account_id')
+        self.created_on = kwargs.get('created_on')
+        self.change_id = kwargs.get('change_id')
+        self.patch_set_id = kwargs.get('patch_set_id')
+        self.draft = kwargs.get('draft')
+        self.change_open = kwargs.get('change_open')
+        self.change_sort_key = kwargs.get('change_sort_key')
+        self.reviews = OrderedDict()
+
+
+class BaselineReview(object):
+    def __init__(self, **kwargs):
+        self.change_id = kwargs.get('change_id')
+        self.granted = kwargs.get('granted')
+        self.value = kwargs.get('value')
+        self.account_id = kwargs.get('account_id')
+        self.patch_set_id = kwargs.get('patch_set_id')
+        self.category_id = kwargs.get('category_id')
+        self.reviewer = BaselineDeveloper(**kwargs)
+
+
+def copy_row(row):
+    '''
+    Give every row its own string objects, just like rows that come from the
+    database.
+    '''
+    return dict((column, ''.join(list(value)) if isinstance(value, str) else value)
+                for column, value in row.iteritems())
+
+
+def create_baseline_changesets(number, seed=0, nbr_accounts=2000):
+    rows = create_account_rows(nbr_accounts)
+    changesets = {}
+    for change, patch_sets in generate_rows(number, rows, seed):
+        changeset = BaselineChangeset(**copy_row(change))
+        changesets[changeset.change_id] = changeset
+        for row, approvals in patch_sets:
+            patch_set = BaselinePatchset(**copy_row(row))
+            changeset.patch_sets[patch_set.patch_set_id] = patch_set
+            for approval in approvals:
+                review = BaselineReview(**copy_row(approval))
+                patch_set.reviews['%s_%s_%s' % (review.granted, review.category_id, review.value)] = review
+    return changesets
+
+
+def sizeof(obj, seen):
+    '''
+    Determine the size of @obj and all the objects it refers to, objects that
+    are shared are only counted once.
+    '''
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += sizeof(key, seen) + sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += sizeof(value, seen)
+    if hasattr(obj, '__dict__'):
+        size += sizeof(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, slot):
+                size += sizeof(getattr(obj, slot), seen)
+    return size
+
+
+def measure(changesets):
+    # objects such as small ints and None are shared by the interpreter
+    seen = set([id(None), id(True), id(False)])
+    seen.update([id(x) for x in xrange(-5, 257)])
+    # shared objects, like the Developer instances of the accounts, are
+    # counted once
+    return sizeof(changesets, seen)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    baseline = measure(create_baseline_changesets(number))
+    size = measure(create_changesets(number))
+    print 'changesets: %s' % number
+    print 'baseline bytes per changeset: %s' % (baseline / number)
+    print 'bytes per changeset: %s' % (size / number)
+    print 'reduction: %.1f%%' % (100.0 * (baseline - size) / baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Run the full gerrit-stats pipeline against a synthetic reviewdb (see
+reviewdb.py) and report the wall time and peak memory of every phase. Every
+size runs in its own process so the peak memory of one size does not carry
+over to the next. The results can be stored as baseline and later runs are
+compared against it, the script exits with status 1 if a phase regressed.
+For benchmarking purposes only.
+
+Example:
+    python phases.py --sizes 10000,100000 --save-baseline
+    python phases.py --sizes 10000,100000
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+from gerrit import Gerrit
+from developer import AccountRegistry
+from reviewdb import ReviewDb
+from helpers import create_options
+
+# with --concurrent the load_changes, load_patch_sets and load_reviews phases
+# are replaced by a single load_concurrently phase
+phases = ['load_accounts', 'load_changes', 'load_patch_sets', 'load_reviews',
+          'load_concurrently', 'evaluate', 'aggregate', 'finalize', 'serialize']
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+default_settings = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'settings.yaml')
+
+
+class SyntheticGerrit(Gerrit):
+    '''
+    The list of repos comes from the synthetic reviewdb instead of from the
+    Gerrit server.
+    '''
+    def __init__(self, args, settings, db):
+        self.db = db
+        super(SyntheticGerrit, self).__init__(args, settings)
+
+    def list_repos(self):
+        return ['%s - Synthetic repo %s' % (project, project) for project in self.db.projects]
+
+
+def serialize_repos(gerrit):
+    '''
+    Format the datafiles of all repos again without writing them, this is the
+    formatting overhead of the finalize phase.
+    '''
+    size = 0
+    for repo in gerrit.repos.itervalues():
+        for rows in repo.create_dataset():
+            size += len(rows)
+    return size
+
+
+def peak_rss():
+    '''
+    Peak resident set size of this process in kilobytes (Linux reports
+    ru_maxrss in kilobytes, OS X in bytes).
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+
+class Timer(object):
+    def __init__(self):
+        self.results = {}
+
+    def measure(self, phase, func, *args):
+        rss = peak_rss()
+        start = time.time()
+        result = func(*args)
+        self.results[phase] = {
+            'wall': round(time.time() - start, 3),
+            'peak_rss': peak_rss(),
+            'rss_growth': peak_rss() - rss,
+        }
+        return result
+
+
+def run_pipeline(args, number, queue):
+    logging.getLogger().setLevel(logging.WARNING)
+    timer = Timer()
+    start = time.time()
+    db = ReviewDb(number, args.seed)
+    generate = round(time.time() - start, 3)
+
+    datasets = tempfile.mkdtemp(prefix='gerrit-stats-benchmark-')
+    try:
+        settings = stats.load_settings(argparse.Namespace(settings=args.settings))
+        options = create_options(datasets, engine=args.engine, stream=args.stream,
+            batch_size=args.batch_size, workers=args.workers, concurrent=args.concurrent)
+        gerrit = SyntheticGerrit(options, settings, db)
+        gerrit.fetch_repos()
+        cur = db.cursor()
+        stats.check_schema(cur)
+
+        accounts = timer.measure('load_accounts', stats.load_account_data, cur, AccountRegistry(settings), gerrit.batch_size)
+        if gerrit.concurrent:
+            changesets = timer.measure('load_concurrently', stats.load_concurrently, gerrit, {}, accounts, None, None, lambda gerrit: db.cursor())
+        else:
+            changesets = timer.measure('load_changes', stats.load_commit_data, cur, {}, accounts, gerrit.batch_size, None, None, gerrit.clock)
+            changesets = timer.measure('load_patch_sets', stats.load_patch_set_data, cur, changesets, gerrit.batch_size)
+            changesets = timer.measure('load_reviews', stats.load_review_data, cur, changesets, accounts, gerrit.batch_size)
+        timer.measure('evaluate', stats.evaluate_changesets, gerrit, changesets)
+        timer.measure('aggregate', stats.create_aggregate_dataset, gerrit)
+        timer.measure('finalize', stats.finalize_repos, gerrit, None, gerrit.workers)
+        timer.measure('serialize', serialize_repos, gerrit)
+    finally:
+        shutil.rmtree(datasets)
+
+    queue.put({'generate': generate, 'rows': str(db), 'phases': timer.results})
+
+
+def run_size(args, number):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_pipeline, args=(args, number, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def compare(baseline, results, tolerance, min_wall):
+    '''
+    A phase has regressed if it takes more than @tolerance (fraction) longer
+    than the baseline, differences below @min_wall seconds are noise. The same
+    goes for the peak memory of a phase.
+    '''
+    regressions = []
+    for number, result in sorted(results.iteritems()):
+        expected = baseline.get(number)
+        if not expected:
+            print 'No baseline for %s changes.' % number
+            continue
+        for phase in phases:
+            actual = result['phases'].get(phase)
+            base = expected['phases'].get(phase)
+            if not actual or not base:
+                continue
+            if actual['wall'] > base['wall'] * (1 + tolerance) and actual['wall'] - base['wall'] > min_wall:
+                regressions.append('%s changes, %s: wall time %.3fs, baseline %.3fs' % (number, phase, actual['wall'], base['wall']))
+            if actual['peak_rss'] > base['peak_rss'] * (1 + tolerance):
+                regressions.append('%s changes, %s: peak memory %s kB, baseline %s kB' % (number, phase, actual['peak_rss'], base['peak_rss']))
+    return regressions
+
+
+def print_results(results):
+    for number, result in sorted(results.iteritems(), key=lambda item: int(item[0])):
+        print '%s changes (%s), generated in %.3fs' % (number, result['rows'], result['generate'])
+        print '    %-18s %10s %14s %14s' % ('phase', 'wall (s)', 'peak (kB)', 'growth (kB)')
+        for phase in phases:
+            values = result['phases'].get(phase)
+            if not values:
+                continue
+            print '    %-18s %10.3f %14s %14s' % (phase, values['wall'], values['peak_rss'], values['rss_growth'])
+
+
+def parse_commandline():
+    parser = argparse.ArgumentParser(description='Benchmark the gerrit-stats pipeline phases against a synthetic reviewdb.')
+    parser.add_argument('--sizes', help='Comma separated list of the number of changes, for example 10000,100000,1000000.', default='10000')
+    parser.add_argument('--seed', help='Seed of the synthetic reviewdb.', type=int, default=0)
+    parser.add_argument('--settings', help='Specify the absolute path to settings.yaml.', default=default_settings)
+    parser.add_argument('--engine', choices=['sweep', 'daterange'], default='sweep')
+    parser.add_argument('--stream', action='store_true', default=False)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrent', help='Load the changes, patch sets and reviews using stats.load_concurrently.', action='store_true', default=False)
+    parser.add_argument('--baseline', help='Specify the file that contains the baselines.', default=default_baseline)
+    parser.add_argument('--save-baseline', help='Store the results as the new baseline instead of comparing against it.', action='store_true', default=False)
+    parser.add_argument('--tolerance', help='Fraction a phase may be slower or bigger than its baseline.', type=float, default=0.3)
+    parser.add_argument('--min-wall', help='Differences in wall time below this number of seconds are ignored.', type=float, default=0.25)
+    args = parser.parse_args()
+    if args.concurrent and args.stream:
+        parser.error('--concurrent cannot be combined with --stream.')
+    return args
+
+
+def main():
+    args = parse_commandline()
+    results = {}
+    for number in [int(size) for size in args.sizes.split(',')]:
+        results[str(number)] = run_size(args, number)
+    print_results(results)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            baseline = json.load(open(args.baseline))
+        baseline.update(results)
+        fh = open(args.baseline, 'w')
+        json.dump(baseline, fh, indent=2, sort_keys=True)
+        fh.write('\n')
+        fh.close()
+        print 'Saved baseline to %s' % args.baseline
+    elif os.path.exists(args.baseline):
+        regressions = compare(json.load(open(args.baseline)), results, args.tolerance, args.min_wall)
+        for regression in regressions:
+            print 'REGRESSION: %s' % regression
+        if regressions:
+            sys.exit(1)
+        print 'No regressions compared to %s' % args.baseline
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Generate a synthetic reviewdb and serve it through an in-process stand-in for
+a MySQLdb DictCursor. The accounts, changes, patch_sets and
+patch_set_approvals tables have the columns defined in
+sql/database_design.sql and the stand-in answers the queries in
+sql_queries.py. The same seed always generates the same database. For
+benchmarking purposes only.
+'''
+
+import os
+import sys
+import random
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import extensions
+from sql_queries import accounts_query, changes_query, patch_sets_query, approvals_query
+from sql_queries import changes_since_query, patch_sets_since_query, approvals_since_query
+from sql_queries import changes_window_query, patch_sets_window_query, approvals_window_query
+from sql_queries import changes_shard_query, patch_sets_shard_query, approvals_shard_query
+from sql_queries import changes_shard_count_query
+from shards import determine_shard
+
+# The columns of the reviewdb tables as defined in sql/database_design.sql
+schema = {
+    'accounts': ['registered_on', 'full_name', 'preferred_email',
+                 'contact_filed_on', 'maximum_page_size', 'show_site_header',
+                 'use_flash_clipboard', 'download_url', 'download_command',
+                 'copy_self_on_email', 'date_format', 'time_format',
+                 'display_patch_sets_in_reverse_order',
+                 'display_person_name_in_review_category', 'inactive',
+                 'account_id'],
+    'changes': ['change_key', 'created_on', 'last_updated_on', 'sort_key',
+                'owner_account_id', 'dest_project_name', 'dest_branch_name',
+                'open', 'status', 'nbr_patch_sets', 'current_patch_set_id',
+                'subject', 'topic', 'row_version', 'change_id',
+                'last_sha1_merge_tested', 'mergeable'],
+    'patch_sets': ['revision', 'uploader_account_id', 'created_on',
+                   'change_id', 'patch_set_id', 'draft'],
+    'patch_set_approvals': ['value', 'granted', 'change_open',
+                            'change_sort_key', 'change_id', 'patch_set_id',
+                            'account_id', 'category_id'],
+}
+
+bots = ['jenkins-bot', 'L10n-bot', 'gerrit2']
+
+creation_date = date(2011, 9, 7)
+
+
+class ProgrammingError(Exception):
+    pass
+
+
+def determine_projects(number, rnd):
+    '''
+    Roughly one project per 200 changes, at least 20. Most projects are
+    extensions so that the parent repos in settings.yaml get children.
+    '''
+    nbr_projects = max(20, number / 200)
+    projects = ['mediawiki/core', 'operations/puppet', 'operations/debs',
+                'analytics/gerrit-stats', 'analytics/limn', 'test/sandbox']
+    names = sorted(extensions)
+    rnd.shuffle(names)
+    for name in names[:nbr_projects - len(projects)]:
+        projects.append('mediawiki/extensions/%s' % name)
+    for x in xrange(nbr_projects - len(projects)):
+        projects.append('mediawiki/tools/tool%s' % x)
+    return projects
+
+
+class ReviewDb(object):
+    '''
+    A synthetic reviewdb with @number changes. The rows are stored as tuples
+    in the column order of schema, the stand-in cursor turns them into
+    dictionaries when they are fetched, just like MySQLdb does.
+    '''
+    def __init__(self, number, seed=0, end=None):
+        self.number = number
+        self.seed = seed
+        self.end = end or datetime.combine(date.today(), datetime.min.time())
+        self.tables = dict((table, []) for table in schema)
+        self.index = dict((table, dict((column, x) for x, column in enumerate(columns)))
+                          for table, columns in schema.iteritems())
+        self.generate()
+
+    def __str__(self):
+        return ', '.join(['%s: %s rows' % (table, len(self.tables[table])) for table in sorted(self.tables)])
+
+    def generate(self):
+        rnd = random.Random(self.seed)
+        self.projects = determine_projects(self.number, rnd)
+        self.generate_accounts(rnd)
+        self.generate_changes(rnd)
+
+    def generate_accounts(self, rnd):
+        nbr_accounts = max(50, self.number / 20)
+        registered_on = datetime.combine(creation_date, datetime.min.time())
+        for account_id in xrange(1, nbr_accounts + 1):
+            if account_id <= len(bots):
+                full_name = bots[account_id - 1]
+                email = '%s@wikimedia.org' % full_name.lower()
+            else:
+                full_name = 'Developer %s' % account_id
+                domain = rnd.choice(['wikimedia.org', 'wikimedia.org', 'gmail.com', 'gmail.com', 'xs4all.nl'])
+                email = 'developer%s@%s' % (account_id, domain)
+            self.tables['accounts'].append((registered_on, full_name, email,
+                None, 0, 'Y', 'N', None, None, 'N', None, None, 'N', 'N',
+                'N', account_id))
+        self.humans = range(len(bots) + 1, nbr_accounts + 1)
+
+    def generate_changes(self, rnd):
+        '''
+        The changes are created at increasing timestamps between the creation
+        date of Gerrit and the end date, so the changes table is already
+        sorted by created_on.
+        '''
+        start = datetime.combine(creation_date, datetime.min.time())
+        span = int((self.end - start).total_seconds())
+        step = float(span) / (self.number + 1)
+        approvals = []
+        for change_id in xrange(1, self.number + 1):
+            created_on = start + timedelta(seconds=int(change_id * step))
+            owner = rnd.choice(self.humans)
+            project = rnd.choice(self.projects)
+            status = rnd.choice(['M', 'M', 'M', 'M', 'A', 'n', 'd'])
+            is_open = 'Y' if status in ('n', 'd') else 'N'
+            nbr_patch_sets = min(rnd.randint(1, 3), rnd.randint(1, 6))
+            last_updated_on = min(created_on + timedelta(seconds=rnd.randint(0, 45 * 86400)), self.end - timedelta(seconds=1))
+            sort_key = '%016x' % change_id
+            change = ['I%040x' % rnd.getrandbits(160),
+                created_on, last_updated_on, sort_key, owner, project,
+                'master', is_open, status, nbr_patch_sets, nbr_patch_sets,
+                'Fix bug %s' % change_id, None, 1, change_id, None, 'Y']
+
+            for patch_set_id in xrange(1, nbr_patch_sets + 1):
+                uploaded_on = created_on + timedelta(seconds=(patch_set_id - 1) * rnd.randint(0, 3 * 86400))
+                self.tables['patch_sets'].append(('%040x' % rnd.getrandbits(160),
+                    owner, uploaded_on, change_id, patch_set_id, 'N'))
+                reviewers = set()
+                for x in xrange(rnd.randint(0, 4)):
+                    account_id = rnd.randint(1, len(self.humans) + len(bots))
+                    category_id = 'VRIF' if account_id <= len(bots) else rnd.choice(['CRVW', 'CRVW', 'VRIF'])
+                    if (account_id, category_id) in reviewers:
+                        continue
+                    reviewers.add((account_id, category_id))
+                    value = rnd.choice([-2, -1, 0, 1, 1, 2, 2]) if category_id == 'CRVW' else rnd.choice([-1, 1])
+                    granted = min(uploaded_on + timedelta(seconds=rnd.randint(60, 20 * 86400)), self.end - timedelta(seconds=1))
+                    approvals.append((value, granted, is_open, sort_key,
+                        change_id, patch_set_id, account_id, category_id))
+                    # like in Gerrit, a review updates the change
+                    change[2] = max(change[2], granted)
+            self.tables['changes'].append(tuple(change))
+        approvals.sort(key=lambda row: row[1])
+        self.tables['patch_set_approvals'] = approvals
+
+    def connect(self):
+        return self
+
+    def cursor(self, cursor_class=None):
+        return Cursor(self)
+
+    def select(self, table, columns, rows):
+        index = self.index[table]
+        positions = [index[column] for column in columns]
+        for row in rows:
+            yield dict(zip(columns, [row[x] for x in positions]))
+
+    def changed_since(self, since):
+        column = self.index['changes']['last_updated_on']
+        is_open = self.index['changes']['open']
+        change_id = self.index['changes']['change_id']
+        return set([row[change_id] for row in self.tables['changes']
+                    if row[column] >= since or row[is_open] == 'Y'])
+
+    def overlapping(self, end, start):
+        created_on = self.index['changes']['created_on']
+        last_updated_on = self.index['changes']['last_updated_on']
+        is_open = self.index['changes']['open']
+        change_id = self.index['changes']['change_id']
+        return set([row[change_id] for row in self.tables['changes']
+                    if row[created_on] < end and (row[last_updated_on] >= start or row[is_open] == 'Y')])
+
+    def sharded(self, count, index):
+        project = self.index['changes']['dest_project_name']
+        change_id = self.index['changes']['change_id']
+        return set([row[change_id] for row in self.tables['changes']
+                    if determine_shard(row[project], count) == index])
+
+    def filter(self, table, change_ids):
+        column = self.index[table]['change_id']
+        return [row for row in self.tables[table] if row[column] in change_ids]
+
+
+def determine_selected_columns(query):
+    '''
+    Extract table.column names from the SELECT clause of @query.
+    '''
+    clause = query.split('SELECT', 1)[1].split('FROM', 1)[0]
+    return [column.strip().split('.')[1] for column in clause.split(',')]
+
+
+class Cursor(object):
+    '''
+    Stand-in for MySQLdb.cursors.DictCursor and SSDictCursor, it only
+    understands the queries that gerrit-stats sends.
+    '''
+    queries = {
+        accounts_query: ('accounts', None),
+        changes_query: ('changes', None),
+        patch_sets_query: ('patch_sets', None),
+        approvals_query: ('patch_set_approvals', None),
+        changes_since_query: ('changes', 'changed_since'),
+        patch_sets_since_query: ('patch_sets', 'changed_since'),
+        approvals_since_query: ('patch_set_approvals', 'changed_since'),
+        changes_window_query: ('changes', 'overlapping'),
+        patch_sets_window_query: ('patch_sets', 'overlapping'),
+        approvals_window_query: ('patch_set_approvals', 'overlapping'),
+        changes_shard_query: ('changes', 'sharded'),
+        patch_sets_shard_query: ('patch_sets', 'sharded'),
+        approvals_shard_query: ('patch_set_approvals', 'sharded'),
+    }
+
+    def __init__(self, db):
+        self.db = db
+        self.rows = iter([])
+        self.rowcount = 0
+
+    def execute(self, query, args=None):
+        if query.startswith('SHOW COLUMNS FROM '):
+            table = query.split()[-1]
+            if table not in schema:
+                raise ProgrammingError('Table %s does not exist' % table)
+            self.rows = iter([{'Field': column} for column in schema[table]])
+            return
+        if query == changes_shard_count_query:
+            project = self.db.index['changes']['dest_project_name']
+            rows = self.db.filter('changes', self.db.sharded(*args))
+            self.rowcount = 1
+            self.rows = iter([{'changes': len(rows), 'projects': len(set([row[project] for row in rows]))}])
+            return
+
+        if query not in self.queries:
+            raise ProgrammingError('Unknown query: %s' % query)
+        columns = determine_selected_columns(query)
+        table, selection = self.queries[query]
+        rows = self.db.tables[table]
+        if selection:
+            rows = self.db.filter(table, getattr(self.db, selection)(*args))
+        self.rowcount = len(rows)
+        self.rows = self.db.select(table, columns, rows)
+
+    def fetchone(self):
+        for row in self.rows:
+            return row
+        return None
+
+    def fetchmany(self, size=1):
+        rows = []
+        for row in self.rows:
+            rows.append(row)
+            if len(rows) == size:
+                break
+        return rows
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        self.rows = iter([])
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    db = ReviewDb(number)
+    print db
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Check that a sharded run over a synthetic reviewdb (see reviewdb.py), N
+workers followed by the merge step, writes the same datasets as a single
+run. For testing purposes only.
+
+Example:
+    python sharded.py --changes 5000 --shards 4
+'''
+
+import os
+import sys
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+from state import determine_fingerprint
+from developer import AccountRegistry
+from reviewdb import ReviewDb
+from phases import SyntheticGerrit, default_settings
+from helpers import create_options, compare_directories
+
+
+def load(db, gerrit, settings):
+    gerrit.fetch_repos()
+    cur = db.cursor()
+    accounts = stats.load_account_data(cur, AccountRegistry(settings))
+    changesets = stats.load_commit_data(cur, {}, accounts, None, None, None, gerrit.clock, gerrit.shard)
+    changesets = stats.load_patch_set_data(cur, changesets, None, None, None, gerrit.shard)
+    changesets = stats.load_review_data(cur, changesets, accounts, None, None, None, gerrit.shard)
+    stats.evaluate_changesets(gerrit, changesets)
+    return changesets
+
+
+def run(db, settings, options):
+    gerrit = SyntheticGerrit(options, settings, db)
+    changesets = load(db, gerrit, settings)
+    stats.create_aggregate_dataset(gerrit)
+    stats.finalize_repos(gerrit, None, gerrit.workers)
+    return len(changesets)
+
+
+def run_worker(db, settings, options):
+    gerrit = SyntheticGerrit(options, settings, db)
+    changesets = load(db, gerrit, settings)
+    repos = gerrit.shard.save(gerrit, determine_fingerprint(settings))
+    return len(changesets), repos
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the datasets of a sharded run with a single run.')
+    parser.add_argument('--changes', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--settings', default=default_settings)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    db = ReviewDb(args.changes, args.seed)
+    settings = stats.load_settings(argparse.Namespace(settings=args.settings))
+    directories = dict((name, tempfile.mkdtemp(prefix='gerrit-stats-%s-' % name))
+                       for name in ['single', 'workers', 'merged', 'partials'])
+    try:
+        loaded = run(db, settings, create_options(directories['single']))
+        total = 0
+        for index in xrange(args.shards):
+            options = create_options(directories['workers'], shard=(index, args.shards), shard_directory=directories['partials'])
+            changesets, repos = run_worker(db, settings, options)
+            print 'Worker %s/%s loaded %s of %s changesets of %s repos.' % (index + 1, args.shards, changesets, loaded, repos)
+            total += changesets
+        assert total == loaded, 'The workers loaded %s changesets instead of %s.' % (total, loaded)
+
+        options = create_options(directories['merged'], merge_shards=True, shard_directory=directories['partials'])
+        gerrit = SyntheticGerrit(options, settings, db)
+        stats.merge_shards(gerrit, settings)
+
+        differences = []
+        for folder in ['datafiles', 'datasources']:
+            differences.extend(compare_directories(os.path.join(directories['single'], folder),
+                                                   os.path.join(directories['merged'], folder)))
+        for path in differences:
+            print 'Different: %s' % path
+        assert not differences, '%s files are different.' % len(differences)
+        print 'The merged datasets are identical to the datasets of a single run.'
+    finally:
+        for directory in directories.itervalues():
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Check that a run from a snapshot (see snapshot.py) of a synthetic reviewdb
+(see reviewdb.py) writes the same datasets as the run that recorded the
+snapshot. One account gets a full name that is not valid UTF-8, the database
+returns such names as raw bytes. For testing purposes only.
+
+Example:
+    python snapshot.py --changes 20000
+'''
+
+import os
+import sys
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+from developer import AccountRegistry
+from snapshot import Snapshot, SnapshotWriter
+from sql_queries import accounts_query
+from reviewdb import ReviewDb
+from phases import SyntheticGerrit, default_settings
+from helpers import create_options, compare_directories
+
+
+def run(db, settings, datasets, cur):
+    gerrit = SyntheticGerrit(create_options(datasets), settings, db)
+    gerrit.fetch_repos()
+    accounts = stats.load_account_data(cur, AccountRegistry(settings))
+    changesets = stats.load_commit_data(cur, {}, accounts, None, None, None, gerrit.clock)
+    changesets = stats.load_patch_set_data(cur, changesets)
+    changesets = stats.load_review_data(cur, changesets, accounts)
+    stats.evaluate_changesets(gerrit, changesets)
+    stats.create_aggregate_dataset(gerrit)
+    stats.finalize_repos(gerrit)
+    return gerrit
+
+
+def fetch_accounts(cur):
+    cur.execute(accounts_query)
+    return sorted(cur.fetchall(), key=lambda row: row['account_id'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the datasets of a run from a snapshot with the run that recorded it.')
+    parser.add_argument('--changes', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--settings', default=default_settings)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    db = ReviewDb(args.changes, args.seed)
+    full_name = db.index['accounts']['full_name']
+    account = list(db.tables['accounts'][0])
+    account[full_name] = 'D\xe9veloppeur'
+    db.tables['accounts'][0] = tuple(account)
+
+    settings = stats.load_settings(argparse.Namespace(settings=args.settings))
+    directories = dict((name, tempfile.mkdtemp(prefix='gerrit-stats-%s-' % name))
+                       for name in ['recorded', 'snapshot', 'replayed'])
+    try:
+        writer = SnapshotWriter(directories['snapshot'])
+        gerrit = run(db, settings, directories['recorded'], writer.cursor(db.cursor()))
+        writer.projects = gerrit.list_repos()
+        writer.save()
+
+        snapshot = Snapshot(directories['snapshot'])
+        assert snapshot.projects == writer.projects, 'The snapshot has different repositories.'
+        assert fetch_accounts(snapshot.cursor()) == fetch_accounts(db.cursor()), 'The snapshot has different accounts.'
+        run(db, settings, directories['replayed'], snapshot.cursor())
+        print 'Recorded a snapshot of %s changesets and replayed it.' % args.changes
+
+        differences = []
+        for folder in ['datafiles', 'datasources']:
+            differences.extend(compare_directories(os.path.join(directories['recorded'], folder),
+                                                   os.path.join(directories['replayed'], folder)))
+        for path in differences:
+            print 'Different: %s' % path
+        assert not differences, '%s files are different.' % len(differences)
+        print 'The datasets of the run from the snapshot are identical to the recorded run.'
+    finally:
+        for directory in directories.itervalues():
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
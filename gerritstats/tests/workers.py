@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+'''
+Check that evaluating the changesets of a synthetic reviewdb (see
+reviewdb.py) with a pool of worker processes writes the same datasets as
+evaluating them serially. For testing purposes only.
+
+Example:
+    python workers.py --changes 20000 --workers 4
+'''
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+from developer import AccountRegistry
+from reviewdb import ReviewDb
+from phases import SyntheticGerrit, default_settings
+from helpers import create_options, compare_directories
+
+
+def run(db, settings, datasets, workers):
+    options = create_options(datasets, workers=workers)
+    gerrit = SyntheticGerrit(options, settings, db)
+    gerrit.fetch_repos()
+    cur = db.cursor()
+    accounts = stats.load_account_data(cur, AccountRegistry(settings))
+    changesets = stats.load_commit_data(cur, {}, accounts, None, None, None, gerrit.clock)
+    changesets = stats.load_patch_set_data(cur, changesets)
+    changesets = stats.load_review_data(cur, changesets, accounts)
+    start = time.time()
+    stats.evaluate_changesets(gerrit, changesets)
+    evaluate = time.time() - start
+    stats.create_aggregate_dataset(gerrit)
+    stats.finalize_repos(gerrit)
+    return evaluate
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the datasets of a parallel and a serial evaluation.')
+    parser.add_argument('--changes', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--settings', default=default_settings)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    db = ReviewDb(args.changes, args.seed)
+    settings = stats.load_settings(argparse.Namespace(settings=args.settings))
+    directories = dict((name, tempfile.mkdtemp(prefix='gerrit-stats-%s-' % name))
+                       for name in ['serial', 'parallel'])
+    try:
+        serial = run(db, settings, directories['serial'], 1)
+        parallel = run(db, settings, directories['parallel'], args.workers)
+        print 'Evaluated %s changesets in %.3fs serially and in %.3fs using %s workers.' % (args.changes, serial, parallel, args.workers)
+        differences = []
+        for folder in ['datafiles', 'datasources']:
+            differences.extend(compare_directories(os.path.join(directories['serial'], folder),
+                                                   os.path.join(directories['parallel'], folder)))
+        for path in differences:
+            print 'Different: %s' % path
+        assert not differences, '%s files are different.' % len(differences)
+        print 'The datasets of the parallel evaluation are identical to the serial evaluation.'
+    finally:
+        for directory in directories.itervalues():
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
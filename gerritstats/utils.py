@@ -19,6 +19,7 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 import sys
+import argparse
 import logging
 from datetime import datetime, date, timedelta
 
@@ -38,6 +39,108 @@ def determine_yesterday(relative_to=None):
     return yesterday
 
 
+class Clock(object):
+    '''
+    The reference date of a run. Changesets, repos and datasources ask the
+    clock for today and yesterday instead of reading the system date, so a run
+    that crosses midnight counts every changeset up to the same day and a run
+    can be done as of an earlier date.
+
+    @param today: the date the run behaves as if it is, observations are
+    counted up to and including the day before.
+    @type today: datetime.date
+
+    @param yesterday: the last second of the day before @today.
+    @type yesterday: datetime.datetime
+
+    @param fixed: True if the date was chosen, a fixed clock never advances.
+    @type fixed: boolean
+    '''
+    def __init__(self, today=None):
+        self.fixed = today is not None
+        self.set(today or date.today())
+
+    def __str__(self):
+        return self.today.strftime('%Y-%m-%d')
+
+    def set(self, today):
+        self.today = today
+        self.tomorrow = today + timedelta(days=1)
+        self.yesterday = determine_yesterday(today)
+
+    def advance(self):
+        '''
+        Move the clock to the current date, used by long running processes.
+        Returns True if a new day has started.
+        '''
+        today = date.today()
+        if self.fixed or today == self.today:
+            return False
+        self.set(today)
+        return True
+
+
+class Window(object):
+    '''
+    The days from @first up to and including @last for which observations are
+    recomputed and merged into the existing datafiles.
+
+    @param start: the first second of the window.
+    @type start: datetime.datetime
+
+    @param end: the first second after the window.
+    @type end: datetime.datetime
+    '''
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        self.start = datetime(first.year, first.month, first.day)
+        self.end = datetime(last.year, last.month, last.day) + timedelta(days=1)
+
+    def __str__(self):
+        return '%s - %s' % (self.first, self.last)
+
+    def __len__(self):
+        return (self.last - self.first).days + 1
+
+
+def parse_date(value):
+    '''
+    Parse a YYYY-MM-DD date given on the command line.
+    '''
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a date formatted as YYYY-MM-DD' % value)
+
+
+def parse_shard(value):
+    '''
+    Parse a shard I/N given on the command line, returns the (index, count)
+    tuple where index counts from 0.
+    '''
+    try:
+        number, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a shard formatted as I/N' % value)
+    if not 1 <= number <= count:
+        raise argparse.ArgumentTypeError('Shard %s does not exist, I has to be between 1 and N' % value)
+    return number - 1, count
+
+
+def intern_string(value):
+    '''
+    Return a shared copy of @value so that frequently repeated strings, like
+    project and branch names, are only stored once. The interpreter drops an
+    interned string once nothing refers to it anymore, so the long running
+    real-time mode does not keep every name it has seen. The builtin intern
+    does not accept unicode strings, these are returned as they are.
+    '''
+    if type(value) is not str:
+        return value
+    return intern(value)
+
+
 def successful_exit():
     logging.info('Closing down gerrit-stats, no errors.')
     logging.info('Mission accomplished, beanz have been counted.')
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gerrit-stats: Generate codereview stats based from Gerrit commits
+Copyright (C) 2012  Diederik van Liere, Wikimedia Foundation
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import os
+import errno
+import hashlib
+import logging
+
+from datetime import datetime
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+
+def write_atomically(path, contents):
+    '''
+    Write @contents under a temporary name first and rename it to @path, so
+    readers either see the old or the new file but never a partial file.
+    '''
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    fh = open(tmp_path, 'w')
+    fh.write(contents)
+    fh.close()
+    os.rename(tmp_path, path)
+
+
+def determine_checksum(path, chunk_size=1024 * 1024):
+    checksum = hashlib.sha1()
+    fh = open(path, 'rb')
+    while True:
+        chunk = fh.read(chunk_size)
+        if not chunk:
+            break
+        checksum.update(chunk)
+    fh.close()
+    return checksum.hexdigest()
+
+
+def copy_bytes(source, destination, size, chunk_size=1024 * 1024):
+    while size > 0:
+        chunk = source.read(min(size, chunk_size))
+        if not chunk:
+            break
+        destination.write(chunk)
+        size -= len(chunk)
+
+
+class DatafileTail(object):
+    '''
+    Reads the header, the first row and the last rows of an existing datafile
+    without reading the rows in between. The rows of a datafile are sorted by
+    date and start with the date formatted as %Y/%m/%d.
+
+    @param header: the first line of the datafile, without the newline.
+    @type header: str
+
+    @param size: the size of the datafile in bytes.
+    @type size: int
+    '''
+    date_format = '%Y/%m/%d'
+
+    def __init__(self, path, block_size=8192):
+        self.path = path
+        self.block_size = block_size
+        self.fh = open(path, 'rb')
+        self.size = os.fstat(self.fh.fileno()).st_size
+        self.header = self.fh.readline()
+        self.rows_offset = len(self.header)
+        self.first_row = self.fh.readline()
+        self.header = self.header.rstrip('\n')
+
+    def __str__(self):
+        return self.path
+
+    def close(self):
+        self.fh.close()
+
+    def parse_date(self, row):
+        try:
+            return datetime.strptime(row[:10], self.date_format).date()
+        except ValueError:
+            return None
+
+    def first_date(self):
+        return self.parse_date(self.first_row)
+
+    def last_date(self):
+        start = self.size
+        while start > self.rows_offset:
+            start = max(self.rows_offset, start - self.block_size)
+            self.fh.seek(start)
+            lines = self.fh.read(self.size - start).rstrip('\n').split('\n')
+            if len(lines) > 1 or start == self.rows_offset:
+                return self.parse_date(lines[-1])
+        return None
+
+    def is_complete(self):
+        '''
+        A datafile that was written by gerrit-stats ends with a newline.
+        '''
+        if self.size == 0:
+            return False
+        self.fh.seek(self.size - 1)
+        return self.fh.read(1) == '\n'
+
+    def read_rows(self, since):
+        '''
+        Read the file backwards, a block at a time, until a row on or before
+        @since is found. Returns the offset of the first row after @since and
+        the contents of the file from that offset.
+        '''
+        key = since.strftime(self.date_format)
+        end = self.size
+        tail = ''
+        while end > self.rows_offset:
+            start = max(self.rows_offset, end - self.block_size)
+            self.fh.seek(start)
+            tail = self.fh.read(end - start) + tail
+            end = start
+            lines = tail.split('\n')
+            offset = end
+            if end > self.rows_offset:
+                # the first line is incomplete, unless it is the first row
+                offset += len(lines[0]) + 1
+                lines = lines[1:]
+            for x, line in enumerate(lines):
+                if line and line[:10] <= key:
+                    offset += len(line) + 1
+                elif x > 0 or end == self.rows_offset:
+                    return offset, tail[offset - end:]
+                else:
+                    # the rows before this block could be after @since as well
+                    break
+        return self.rows_offset, tail
+
+
+class DatasetWriter(object):
+    '''
+    Writes the datafiles and datasources. Files are replaced atomically and a
+    file whose contents did not change is not written at all, so dashboards
+    never see a missing or half written file and the modification time of
+    unchanged datasets stays the same. Files in @locations that were not
+    written or kept during a run belong to repos that no longer exist and are
+    removed by remove_stale once the run has succeeded.
+
+    @param locations: the directories that contain the datasets.
+    @type locations: list
+
+    @param kept: the absolute paths of the files that belong to this run.
+    @type kept: set
+
+    @param directories: the directories that are known to exist.
+    @type directories: set
+    '''
+    buffer_size = 1024 * 1024
+
+    def __init__(self, locations):
+        self.locations = [os.path.abspath(location) for location in locations]
+        self.kept = set()
+        self.directories = set()
+        self.written = 0
+        self.unchanged = 0
+
+    def __str__(self):
+        return ', '.join(self.locations)
+
+    def create_directories(self, directories):
+        '''
+        Create all @directories that do not exist yet in one go, parents
+        before their children.
+        '''
+        for directory in sorted(set([os.path.abspath(directory) for directory in directories])):
+            if directory in self.directories:
+                continue
+            try:
+                os.makedirs(directory)
+                logging.info('Created %s' % directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            while directory not in self.directories and directory != os.path.dirname(directory):
+                self.directories.add(directory)
+                directory = os.path.dirname(directory)
+
+    def is_unchanged(self, path, size, checksum):
+        try:
+            if os.path.getsize(path) != size:
+                return False
+        except OSError:
+            return False
+        return determine_checksum(path) == checksum
+
+    def keep(self, path, changed):
+        self.kept.add(os.path.abspath(path))
+        if changed:
+            self.written += 1
+        else:
+            self.unchanged += 1
+
+    def write(self, path, contents):
+        '''
+        Replace @path with @contents, a string or an iterable of strings,
+        unless it already has these contents. The contents are streamed to a
+        temporary file while their checksum is calculated, so they never have
+        to be in memory at once. Returns True if the file was written. The
+        caller passes the path to keep, possibly from another process.
+        '''
+        if isinstance(contents, basestring):
+            contents = [contents]
+        self.create_directories([os.path.dirname(path)])
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        checksum = hashlib.sha1()
+        size = 0
+        fh = open(tmp_path, 'wb', self.buffer_size)
+        try:
+            for chunk in contents:
+                fh.write(chunk)
+                checksum.update(chunk)
+                size += len(chunk)
+        except Exception:
+            # @path is left alone, do not leave the partial file behind
+            fh.close()
+            os.unlink(tmp_path)
+            raise
+        fh.close()
+        if self.is_unchanged(path, size, checksum.hexdigest()):
+            os.unlink(tmp_path)
+            return False
+        os.rename(tmp_path, path)
+        return True
+
+    def append(self, path, contents):
+        '''
+        Add @contents, complete lines, to the end of @path using a single
+        write so readers never see a partial line. The cost only depends on
+        the size of @contents.
+        '''
+        if not contents:
+            return False
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, contents)
+        finally:
+            os.close(fd)
+        return True
+
+    def replace_tail(self, path, offset, tail, contents):
+        '''
+        Replace everything after byte @offset of @path, currently @tail, with
+        @contents. If @contents only adds lines to @tail then these lines are
+        appended, otherwise the start of the file is copied to a temporary
+        file that replaces @path atomically.
+        '''
+        if contents.startswith(tail):
+            return self.append(path, contents[len(tail):])
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        fh = open(tmp_path, 'wb')
+        existing = open(path, 'rb')
+        copy_bytes(existing, fh, offset)
+        existing.close()
+        fh.write(contents)
+        fh.close()
+        os.rename(tmp_path, path)
+        return True
+
+    def remove_stale(self):
+        '''
+        Remove the files in the dataset locations that were not written or
+        kept during this run, and the directories that become empty because of
+        it. Only call this after all datasets have been written successfully.
+        '''
+        removed = 0
+        for location in self.locations:
+            for root, dirnames, filenames in os.walk(location, topdown=False):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    if path in self.kept:
+                        continue
+                    logging.info('Removing stale file %s' % path)
+                    try:
+                        os.unlink(path)
+                        removed += 1
+                    except OSError, e:
+                        logging.warning('Failed to remove %s but got error %s' % (path, e))
+                if root != location and not os.listdir(root):
+                    os.rmdir(root)
+                    self.directories.discard(root)
+        logging.info('Wrote %s files, %s files were unchanged and %s stale files were removed.' % (self.written, self.unchanged, removed))
+        return removed
@@ -20,7 +20,6 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 import os
 from cStringIO import StringIO
-from datetime import datetime, timedelta
 
 
 class YamlConfig(object):
@@ -65,7 +64,7 @@ class YamlConfig(object):
         self.buffer.write('\n')
 
     def set_timespan(self):
-        yesterday = datetime.today() - timedelta(days=1)
+        yesterday = self.gerrit.clock.yesterday
         self.buffer.write('timespan:\n')
         self.buffer.write('    end: %s/%s/%s\n' % (yesterday.year,
                                                    yesterday.month, yesterday.day))
@@ -74,8 +73,7 @@ class YamlConfig(object):
         self.buffer.write('\n')
 
     def set_columns(self, repo):
-        headings = repo.generate_headings()
-        headings = headings.split(',')
+        headings = repo.schema.labels
         num_headings = len(headings)
         self.buffer.write('columns:\n')
         self.buffer.write('    labels:\n')
@@ -99,6 +97,5 @@ class YamlConfig(object):
 
         filename = '%s.yaml' % (self.repo.determine_filename())
         full_path = os.path.join(self.repo.yaml_directory, filename)
-        fh = open(full_path, 'w')
-        fh.write(self.buffer.getvalue())
-        fh.close()
+        changed = self.gerrit.writer.write(full_path, self.buffer.getvalue())
+        return full_path, changed
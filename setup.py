@@ -28,7 +28,7 @@ setup(
     packages         = find_packages(),
     entry_points     = { 'console_scripts':['gerrit-stats = gerritstats:main'] },
 	install_requires = [
-		'MySQL-python','paramiko','pycrypto','argparse','yaml',
+		'MySQL-python','paramiko','pycrypto','argparse','yaml','numpy>=1.8',
 	],
 
     # install_requires = [